@@ -0,0 +1,147 @@
+import time
+import asyncio
+import contextvars
+from datetime import datetime
+import pandas as pd
+import bson
+from DB.instrumentation import record_phase
+
+# pymongoarrow decodes raw BSON batches straight into typed Arrow arrays,
+# without building a Python object per document or per value. Without it
+# the batches are decoded into per-document dicts whose values are gathered
+# into column lists, which is several times slower.
+try:
+    import pyarrow as pa
+    from pymongoarrow.api import Schema
+    from pymongoarrow.context import PyMongoArrowContext
+    from pymongoarrow.lib import process_bson_stream
+except ImportError:
+    pa = Schema = PyMongoArrowContext = process_bson_stream = None
+
+# Column kinds and the dtype of the array they are decoded into
+COLUMN_DTYPES = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'boolean',
+    'datetime': 'datetime64[ns]',
+    'str': object,
+}
+
+# Python types used to build a pymongoarrow schema for each column kind
+ARROW_TYPES = {'int': int, 'float': float, 'bool': bool, 'datetime': datetime, 'str': str}
+
+def _to_array(values, kind):
+    try:
+        return pd.array(values, dtype=COLUMN_DTYPES[kind])
+    except (TypeError, ValueError):
+        # Missing values in a non-nullable column, let pandas pick the dtype
+        return pd.array(values)
+
+def _arrow_column(column, kind):
+    # pandas column of the same dtype as _to_array gives for the values of the column
+    if kind == 'bool':
+        return column.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get).array
+    if kind == 'int' and column.null_count:
+        return column.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get).array
+    if kind == 'datetime':
+        return column.to_pandas().to_numpy(dtype='datetime64[ns]')
+    return column.to_numpy(zero_copy_only=False)
+
+def _decode_with_arrow(batches, columns):
+    schema = Schema({field: ARROW_TYPES[kind] for field, kind in columns.items()})
+    context = PyMongoArrowContext.from_schema(schema)
+    for batch in batches:
+        process_bson_stream(batch, context)
+    table = context.finish()
+    return {field: _arrow_column(table.column(field), kind) for field, kind in columns.items()}
+
+def _decode_with_bson(batches, columns):
+    values = {field: [] for field in columns}
+    appenders = [(field, values[field].append) for field in columns]
+    for batch in batches:
+        for document in bson.decode_all(batch):
+            for field, append in appenders:
+                append(document.get(field))
+    return {field: _to_array(values[field], kind) for field, kind in columns.items()}
+
+def frame_from_raw_batches(batches, columns):
+    """
+    Decode raw BSON batches into a DataFrame with one typed column per field.
+
+    The batches are decoded by pymongoarrow when it is installed, and into
+    per-document dicts otherwise.
+
+    Args:
+        batches : Iterable of raw BSON batches, e.g. a find_raw_batches cursor.
+        columns : Dict mapping field names to their kind.
+
+    Returns:
+        pd.DataFrame: One column per field, in the order of columns.
+    """
+    decode = _decode_with_arrow if process_bson_stream is not None else _decode_with_bson
+    # Time spent decoding, as opposed to waiting for the next batch from the server
+    waiting = 0.0
+
+    def timed_batches():
+        nonlocal waiting
+        iterator = iter(batches)
+        while True:
+            start = time.perf_counter()
+            batch = next(iterator, None)
+            waiting += time.perf_counter() - start
+            if batch is None:
+                return
+            yield batch
+
+    start = time.perf_counter()
+    frame = pd.DataFrame(decode(timed_batches(), columns), copy=False)
+    record_phase('build_frame', time.perf_counter() - start - waiting)
+    return frame
+
+def _projection(columns):
+    projection = dict.fromkeys(columns, 1)
+    projection['_id'] = 0
+    return projection
+
+def fetch_columns(collection, columns, query=None):
+    """
+    Fetch selected fields of the matching documents as a DataFrame of typed columns.
+
+    Only the requested fields are sent by the server (the _id is excluded)
+    and the raw BSON batches are decoded into columns, by pymongoarrow
+    without a Python object per value when it is installed, see
+    frame_from_raw_batches.
+
+    Args:
+        collection : MongoDB collection instance.
+        columns : Dict mapping field names to their kind: int, float, bool,
+            datetime or str.
+        query : Filter of the documents to fetch. Defaults to all documents.
+
+    Returns:
+        pd.DataFrame: One column per requested field, in the requested order.
+    """
+    return frame_from_raw_batches(collection.find_raw_batches(query or {}, _projection(columns)), columns)
+
+async def fetch_columns_async(collection, columns, query=None, executor=None):
+    """
+    Async counterpart of fetch_columns for a motor collection.
+
+    The raw BSON batches are awaited on the event loop and decoded into
+    columns on the executor, so neither the network round trips nor the
+    decoding block the loop.
+
+    Args:
+        collection : Motor collection instance.
+        columns : Dict mapping field names to their kind.
+        query : Filter of the documents to fetch. Defaults to all documents.
+        executor : Executor running the decoding. Defaults to the loop's one.
+
+    Returns:
+        pd.DataFrame: One column per requested field, in the requested order.
+    """
+    batches = [batch async for batch in collection.find_raw_batches(query or {}, _projection(columns))]
+    loop = asyncio.get_running_loop()
+    # The decoding is recorded as a phase of the calling service
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, context.run, frame_from_raw_batches, batches, columns)
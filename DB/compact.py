@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+# Compact in-memory type of the fields of the sales and dimension frames:
+# the narrowest integer type holding the ids and counts, bool for the Y/N
+# flags, categories for the repeated labels, and seconds since midnight for
+# the time of day. Amounts and prices stay float64, float32 sums drift.
+COMPACT_SCHEMA = {
+    # Sales line items
+    'transaction_id': 'int32', 'sales_outlet_id': 'int16', 'staff_id': 'int16', 'customer_id': 'int32',
+    'order': 'int8', 'line_item_id': 'int8', 'product_id': 'int16', 'quantity': 'int16',
+    'instore_yn': 'bool', 'promo_item_yn': 'bool',
+    'transaction_date': 'datetime', 'transaction_time': 'seconds',
+    # Dimension tables
+    'home_store': 'int16', 'manager': 'int16', 'quantity_sold': 'int16', 'waste': 'int16',
+    'tax_exempt_yn': 'bool', 'promo_yn': 'bool', 'year_month': 'datetime',
+    'beans_goal': 'int32', 'beverage_goal': 'int32', 'food_goal': 'int32', 'merchandise _goal': 'int32',
+    'store_city': 'category', 'sales_outlet_type': 'category', 'generation': 'category', 'gender': 'category',
+    'product_group': 'category', 'product_category': 'category', 'product_type': 'category',
+    'unit_of_measure': 'category',
+}
+
+# Nullable pandas counterpart of each integer type, for columns with gaps
+NULLABLE_INTS = {'int8': 'Int8', 'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64'}
+
+# Values of the Y/N flags
+FLAG_VALUES = {'Y': True, 'N': False}
+
+# Memory footprint of the last compacted frame of each name, in bytes
+FOOTPRINTS = {}
+
+def frame_bytes(df):
+    """
+    Return the memory used by a DataFrame, including the Python objects of its object columns.
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def fits_int_type(values, dtype):
+    # Whether every value of an integer column is in the range of dtype
+    if len(values) == 0:
+        return True
+    info = np.iinfo(dtype)
+    return info.min <= values.min() and values.max() <= info.max
+
+def _compact_int(series, dtype):
+    if str(series.dtype) in (dtype, NULLABLE_INTS[dtype]):
+        return series
+    if not pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return series
+    values = series.dropna()
+    if not fits_int_type(values, dtype):
+        # A value out of range would wrap around, keep the wider type
+        return series
+    if len(values) < len(series):
+        return series.astype(NULLABLE_INTS[dtype])
+    return series.astype(dtype)
+
+def _compact_bool(series):
+    if series.dtype == bool:
+        return series
+    if series.dtype == object:
+        series = series.map(lambda value: FLAG_VALUES.get(value.strip().upper()) if isinstance(value, str) else value)
+    if series.isna().any():
+        return series.astype('boolean')
+    return series.astype(bool)
+
+def seconds_since_midnight(series):
+    """
+    Convert 'HH:MM:SS' times of day to int32 seconds since midnight.
+
+    Numeric values are taken to be seconds already, also in a column mixing
+    them with 'HH:MM:SS' strings. Unparseable values become missing values.
+    """
+    if str(series.dtype) in ('int32', 'Int32'):
+        return series
+    if pd.api.types.is_numeric_dtype(series):
+        seconds = series
+    else:
+        text = series.map(lambda value: isinstance(value, str)).astype(bool)
+        seconds = pd.to_timedelta(series.where(text), errors='coerce').dt.total_seconds()
+        if not text.all():
+            seconds = seconds.fillna(pd.to_numeric(series.where(~text), errors='coerce'))
+    if seconds.isna().any():
+        return seconds.astype('Int32')
+    return seconds.astype('int32')
+
+def compact_column(series, compact_type):
+    """
+    Convert a column to its compact type.
+
+    Args:
+        series : The column as fetched.
+        compact_type : int8, int16, int32, bool, category, datetime or seconds.
+
+    Returns:
+        pd.Series: The converted column, or the column itself when it does
+        not fit the compact type.
+    """
+    if compact_type in NULLABLE_INTS:
+        return _compact_int(series, compact_type)
+    if compact_type == 'bool':
+        return _compact_bool(series)
+    if compact_type == 'category':
+        return series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype('category')
+    if compact_type == 'datetime':
+        return series if pd.api.types.is_datetime64_dtype(series) else pd.to_datetime(series, errors='coerce')
+    if compact_type == 'seconds':
+        return seconds_since_midnight(series)
+    raise ValueError(f"Unsupported compact type '{compact_type}' for column {series.name}")
+
+def compact_frame(df, name=None, schema=COMPACT_SCHEMA):
+    """
+    Convert the columns of a frame to their compact types.
+
+    Columns without a compact type are left as they are and the '_id' column
+    is dropped. The footprint of the frame before and after is recorded in
+    FOOTPRINTS under name.
+
+    Args:
+        df : Frame to convert.
+        name : Name the footprint is recorded under. Not recorded when None.
+        schema : Dict mapping column names to their compact type.
+
+    Returns:
+        pd.DataFrame: The converted frame.
+    """
+    before = frame_bytes(df) if name is not None else None
+    if '_id' in df.columns:
+        df = df.drop(columns='_id')
+    for column in df.columns:
+        compact_type = schema.get(column)
+        if compact_type is not None and not df.empty:
+            series = df[column]
+            converted = compact_column(series, compact_type)
+            if converted is not series:
+                df[column] = converted
+    if name is not None:
+        after = frame_bytes(df)
+        FOOTPRINTS[name] = {'rows': len(df), 'bytes_before': before, 'bytes_after': after}
+    return df
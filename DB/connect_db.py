@@ -1,15 +1,235 @@
 import os
-from pymongo import MongoClient
+import threading
+from pymongo import MongoClient, monitoring
+from motor.motor_asyncio import AsyncIOMotorClient
 from prefect import task
+from DB.instrumentation import command_metrics
+
+def client_options():
+    """
+    Connection pool, timeout, compression and read preference settings of the
+    MongoDB clients, read from the environment.
+
+    Returns:
+        dict: Keyword arguments for MongoClient and AsyncIOMotorClient.
+    """
+    options = {
+        'maxPoolSize': int(os.getenv('MONGODB_MAX_POOL_SIZE', '50')),
+        'minPoolSize': int(os.getenv('MONGODB_MIN_POOL_SIZE', '0')),
+        'maxIdleTimeMS': int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000')),
+        'connectTimeoutMS': int(os.getenv('MONGODB_CONNECT_TIMEOUT_MS', '5000')),
+        'serverSelectionTimeoutMS': int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+        'readPreference': os.getenv('MONGODB_READ_PREFERENCE', 'primary'),
+        'retryWrites': True,
+    }
+    socket_timeout = os.getenv('MONGODB_SOCKET_TIMEOUT_MS')
+    if socket_timeout:
+        options['socketTimeoutMS'] = int(socket_timeout)
+    # zlib ships with Python, zstd and snappy need the zstandard and python-snappy packages
+    compressors = os.getenv('MONGODB_COMPRESSORS', 'zlib')
+    if compressors:
+        options['compressors'] = compressors
+    return options
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener counting the connections of a client.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.checkout_failures = 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failures')
+
+    def connection_checked_out(self, event):
+        self._count('checked_out')
+
+    def connection_checked_in(self, event):
+        self._count('checked_in')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'open': self.created - self.closed,
+                'in_use': self.checked_out - self.checked_in,
+                'created': self.created,
+                'closed': self.closed,
+                'checkouts': self.checked_out,
+                'checkout_failures': self.checkout_failures,
+            }
+
+class MongoConnectionManager:
+    """
+    Process-wide MongoDB client shared by the ingestion, the ETL tasks and the API.
+
+    The client is created on first use and then reused, so the TCP/TLS
+    handshakes and the server discovery happen once per process instead of
+    once per call. MongoClient is thread-safe; a process forked after the
+    client was created gets a client of its own. The motor client of the
+    async API handlers is owned the same way, with the same pool options,
+    and has its own connection counters.
+    """
+
+    def __init__(self, connection_string=None, db_name=None, sales_collection_name=None, **options):
+        self.connection_string = connection_string or os.getenv('MONGODB_CONNECTION_STRING')
+        self.db_name = db_name or os.getenv('DB_NAME')
+        self.sales_collection_name = sales_collection_name or os.getenv('COLLECTION_NAME')
+        self.options = {**client_options(), **options}
+        self.pool_stats = PoolStats()
+        self.async_pool_stats = PoolStats()
+        self._client = None
+        self._pid = None
+        self._async_client = None
+        self._async_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = MongoClient(self.connection_string,
+                                               event_listeners=[self.pool_stats, command_metrics], **self.options)
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None or self._async_pid != os.getpid():
+            with self._lock:
+                if self._async_client is None or self._async_pid != os.getpid():
+                    self._async_client = AsyncIOMotorClient(
+                        self.connection_string, event_listeners=[self.async_pool_stats, command_metrics],
+                        **self.options)
+                    self._async_pid = os.getpid()
+        return self._async_client
+
+    @property
+    def db(self):
+        return self.client[self.db_name]
+
+    @property
+    def async_db(self):
+        return self.async_client[self.db_name]
+
+    def collection(self, name):
+        return self.db[name]
+
+    def sales_collection(self):
+        return self.db[self.sales_collection_name]
+
+    def stats(self):
+        """
+        Return the pool settings and the connection counters of the client.
+        """
+        return {
+            'max_pool_size': self.options['maxPoolSize'],
+            'min_pool_size': self.options['minPoolSize'],
+            'compressors': self.options.get('compressors'),
+            'read_preference': self.options['readPreference'],
+            'connected': self._client is not None,
+            **self.pool_stats.snapshot(),
+            'async': {'connected': self._async_client is not None, **self.async_pool_stats.snapshot()},
+        }
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            if self._async_client is not None:
+                self._async_client.close()
+                self._async_client = None
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_connection_manager():
+    """
+    Return the process-wide connection manager, creating it on first use.
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = MongoConnectionManager()
+    return _manager
+
+def get_database():
+    return get_connection_manager().db
+
+def get_collection(name):
+    return get_connection_manager().collection(name)
+
+def get_sales_collection():
+    return get_connection_manager().sales_collection()
+
+def get_pool_stats():
+    return get_connection_manager().stats()
+
+def close_connections():
+    """
+    Close the clients of the process-wide connection manager, e.g. when the API shuts down.
+    """
+    if _manager is not None:
+        _manager.close()
 
 @task
 def get_mongo_connection():
     try:
-        connection_string = os.getenv('MONGODB_CONNECTION_STRING')
-        client = MongoClient(connection_string)
-        db = client[os.getenv('DB_NAME')]
-        sales_collection = db[os.getenv('COLLECTION_NAME')]
-        return client, db, sales_collection
+        manager = get_connection_manager()
+        return manager.client, manager.db, manager.sales_collection()
+    except Exception as e:
+        print(f"Error connecting to MongoDB: {e}")
+        return None, None, None
+
+def get_async_mongo_connection():
+    """
+    Connect with the asyncio driver, for code running on an event loop.
+
+    The motor client is owned by the process-wide connection manager, which
+    reports its pool in get_pool_stats and closes it.
+
+    Returns:
+        tuple: The motor client, database and sales collection.
+    """
+    try:
+        manager = get_connection_manager()
+        return manager.async_client, manager.async_db, manager.async_db[manager.sales_collection_name]
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
         return None, None, None
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+
+def _values(series):
+    # Numpy values of a column: NaN floats for nullable numbers, objects for nullable flags
+    if not series.isna().any():
+        dtype = getattr(series.dtype, 'numpy_dtype', None)
+        return series.to_numpy(dtype=dtype) if dtype is not None else series.to_numpy()
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return series.to_numpy(dtype='float64', na_value=np.nan)
+    return series.to_numpy(dtype=object, na_value=None)
+
+class DimensionTable:
+    """
+    Attributes of a dimension table held in dense arrays indexed by integer id.
+
+    Every attribute is stored at the position of its id, labels as category
+    codes, so the attributes of a column of fact ids are gathered with one
+    array lookup instead of a merge. Flags derived from the attributes are
+    computed once per dimension row. Ids that are missing, negative or not
+    in the table all point to a trailing sentinel row: no attributes, codes
+    of -1 and unset flags. The arrays have one entry per id up to the largest
+    one, which suits the small consecutive ids of products, outlets and
+    customers.
+
+    Args:
+        dimension_df : One row per id.
+        id_field : Integer id column of dimension_df.
+        flags : Optional dict mapping flag names to functions returning a
+            boolean Series for the rows of dimension_df.
+    """
+
+    def __init__(self, dimension_df, id_field, flags=None):
+        dimension_df = dimension_df[dimension_df[id_field].notna()]
+        ids = dimension_df[id_field].to_numpy(dtype='int64')
+        if len(ids) and ids.min() < 0:
+            raise ValueError(f"{id_field} must not be negative")
+        self.id_field = id_field
+        self.size = int(ids.max()) + 1 if len(ids) else 0
+        self.rows = len(ids)
+        self.present = np.zeros(self.size + 1, dtype=bool)
+        self.present[ids] = True
+
+        self.columns = {}
+        self.categories = {}
+        for column in dimension_df.columns:
+            if column == id_field:
+                continue
+            series = dimension_df[column]
+            if isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == object:
+                values = series.astype('category')
+                self.categories[column] = values.cat.categories
+                self.columns[column] = self._dense(ids, values.cat.codes.to_numpy(dtype='int32'), -1)
+            else:
+                self.columns[column] = self._dense(ids, _values(series))
+        self.flags = {
+            name: self._dense(ids, flag(dimension_df).to_numpy(dtype=bool, na_value=False), False)
+            for name, flag in (flags or {}).items()
+        }
+
+    def _dense(self, ids, values, fill=None):
+        if fill is None:
+            fill = np.nan if values.dtype.kind == 'f' else None if values.dtype == object else 0
+        dense = np.full(self.size + 1, fill, dtype=values.dtype)
+        dense[ids] = values
+        return dense
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def nbytes(self):
+        arrays = [self.present, *self.columns.values(), *self.flags.values()]
+        return sum(array.nbytes for array in arrays)
+
+    def positions(self, ids):
+        """
+        Return the positions of a column of ids in the dense arrays.
+        """
+        ids = pd.Series(ids).to_numpy(dtype='int64', na_value=-1)
+        return np.where((ids >= 0) & (ids < self.size), ids, self.size)
+
+    def known(self, ids):
+        # Whether each id has a row in the table
+        return self.present[self.positions(ids)]
+
+    def codes(self, column, ids):
+        # Category codes of a label column for each id, -1 when unknown
+        return self.columns[column][self.positions(ids)]
+
+    def flag(self, name, ids):
+        return self.flags[name][self.positions(ids)]
+
+    def gather(self, ids, columns=None):
+        """
+        Return the attributes of each id, in the order of ids.
+
+        Args:
+            ids : Integer ids, e.g. a fact table column.
+            columns : Attribute columns to return, all of them when None.
+
+        Returns:
+            pd.DataFrame: One row per id, label columns as categories. Ids
+            that are not in the table get missing values.
+        """
+        positions = self.positions(ids)
+        known = self.present[positions]
+        gathered = {}
+        for column in (columns or list(self.columns)):
+            values = self.columns[column][positions]
+            if column in self.categories:
+                gathered[column] = pd.Categorical.from_codes(values, self.categories[column])
+            elif not known.all():
+                gathered[column] = pd.Series(values).where(known)
+            else:
+                gathered[column] = values
+        return pd.DataFrame(gathered)
+
+def _sum_by_key(keys, values, size):
+    # Totals and row counts of the keys 0..size-1. Integers are summed exactly with
+    # np.bincount, floats with the compensated summation of a pandas groupby, so
+    # that the totals match those of the merges they replace to the last digit.
+    counts = np.bincount(keys, minlength=size)
+    if values.dtype.kind in 'iub':
+        return np.bincount(keys, weights=values, minlength=size).astype('int64'), counts
+    # Keys given as category codes are grouped without hashing them
+    groups = pd.Categorical.from_codes(keys, categories=pd.RangeIndex(size))
+    return pd.Series(values).groupby(groups, observed=False).sum().to_numpy(), counts
+
+def totals_by_code(codes, values, categories):
+    """
+    Sum values per category code, the array counterpart of a groupby on a
+    category column with observed=True.
+
+    Args:
+        codes : Category code of each row, -1 for rows left out.
+        values : NumPy values of each row.
+        categories : Labels of the codes.
+
+    Returns:
+        pd.Series: Totals of the categories having rows, in category order.
+    """
+    known = codes >= 0
+    if not known.all():
+        codes, values = codes[known], values[known]
+    totals, counts = _sum_by_key(codes, values, len(categories))
+    observed = counts > 0
+    return pd.Series(totals[observed], index=categories[observed])
+
+def totals_by_id(ids, values):
+    """
+    Sum values per integer id into arrays indexed by id.
+
+    Args:
+        ids : Integer ids of the rows, missing or negative ids are left out.
+        values : Values of the rows, missing values count as 0.
+
+    Returns:
+        tuple: The totals and the number of rows of each id.
+    """
+    ids = pd.Series(ids).to_numpy(dtype='int64', na_value=-1)
+    values = pd.Series(values).to_numpy(dtype='float64', na_value=0.0)
+    known = ids >= 0
+    if not known.all():
+        ids, values = ids[known], values[known]
+    return _sum_by_key(ids, values, int(ids.max()) + 1 if len(ids) else 0)
@@ -0,0 +1,72 @@
+from pymongo import IndexModel
+
+def ensure_indexes(collection, indexes):
+    """
+    Create the indexes declared for a collection in the configuration.
+
+    Indexes that already exist are left untouched, so this is cheap to run on
+    every ingestion.
+
+    Args:
+        collection : MongoDB collection instance.
+        indexes : List of dicts with the index 'keys' as [field, direction]
+            pairs and optional index options such as 'name' or 'unique'.
+
+    Returns:
+        list: Names of the declared indexes.
+    """
+    models = [
+        IndexModel([(field, direction) for field, direction in index['keys']],
+                   **{option: value for option, value in index.items() if option != 'keys'})
+        for index in indexes or []
+    ]
+    if not models:
+        return []
+    return collection.create_indexes(models)
+
+def _plan_stages(plan):
+    # Flatten a winning plan into its stage names, outermost stage first
+    stages = []
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        if 'inputStages' in plan:
+            stages.append('(' + ', '.join(' > '.join(_plan_stages(child)) for child in plan['inputStages']) + ')')
+            break
+        plan = plan.get('inputStage') or plan.get('queryPlan')
+    return stages
+
+def explain_query(db, query):
+    """
+    Run a query with the executionStats explain verbosity and summarize it.
+
+    Args:
+        db : MongoDB database instance.
+        query : Dict with the 'collection' name and either a find 'filter'
+            (plus an optional 'projection') or an aggregation 'pipeline'.
+
+    Returns:
+        dict: The winning plan stages, documents returned and examined, and
+        the examined/returned ratio.
+    """
+    if 'pipeline' in query:
+        command = {'aggregate': query['collection'], 'pipeline': query['pipeline'], 'cursor': {}}
+    else:
+        command = {'find': query['collection'], 'filter': query.get('filter', {})}
+        if query.get('projection'):
+            command['projection'] = query['projection']
+    explain = db.command('explain', command, verbosity='executionStats')
+
+    # Aggregations that are not fully pushed down report the plan inside their first stage
+    if 'queryPlanner' not in explain and explain.get('stages'):
+        explain = explain['stages'][0].get('$cursor', {})
+    stats = explain.get('executionStats', {})
+    plan = ' > '.join(_plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {})))
+    returned = stats.get('nReturned', 0)
+    examined = stats.get('totalDocsExamined', 0)
+    return {
+        'plan': plan,
+        'collection_scan': 'COLLSCAN' in plan,
+        'returned': returned,
+        'examined': examined,
+        'ratio': examined / returned if returned else (float('inf') if examined else 0.0),
+    }
@@ -0,0 +1,256 @@
+import os
+import time
+import inspect
+import threading
+import contextvars
+from contextlib import ContextDecorator
+from functools import wraps
+from fastapi import HTTPException
+from pymongo import monitoring
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, write_to_textfile)
+
+# File the ETL flow writes its task metrics to, appended to the API's /metrics.
+# At the project root by default, wherever the ETL flow and the API are started from.
+ETL_METRICS_FILE = os.getenv(
+    'ETL_METRICS_FILE',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'etl_metrics.prom'),
+)
+
+# Bucket bounds in seconds, from sub-millisecond queries to minute-long ETL stages
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 120.0, 300.0)
+DOCUMENT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'pos_http_request_duration_seconds', 'Time to handle an API request, serialization included.',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+SERVICE_PHASE_DURATION = Histogram(
+    'pos_service_phase_duration_seconds',
+    'Time spent by a service function in each phase: fetch (MongoDB and cache lookups), build_frame '
+    '(decoding documents into columns), compute and serialize. A phase excludes the phases nested in it.',
+    ['service', 'phase'], buckets=LATENCY_BUCKETS)
+SERVICE_ERRORS = Counter(
+    'pos_service_errors_total', 'Service function calls that raised, by HTTP status.', ['service', 'status'])
+MONGO_COMMAND_DURATION = Histogram(
+    'pos_mongo_command_duration_seconds', 'Latency of the MongoDB commands, as measured by the driver.',
+    ['command', 'collection', 'outcome'], buckets=LATENCY_BUCKETS)
+MONGO_DOCUMENTS_RETURNED = Histogram(
+    'pos_mongo_documents_returned', 'Documents returned by each batch of a find, aggregate or getMore command.',
+    ['command', 'collection'], buckets=DOCUMENT_BUCKETS)
+
+# The ETL runs in processes of its own, its metrics are written to ETL_METRICS_FILE
+ETL_REGISTRY = CollectorRegistry()
+ETL_TASK_DURATION = Histogram(
+    'pos_etl_task_duration_seconds', 'Run time of the ETL flow tasks.', ['task', 'outcome'],
+    buckets=LATENCY_BUCKETS, registry=ETL_REGISTRY)
+
+# Service name and innermost open span of the current call, per thread and per asyncio task
+_service = contextvars.ContextVar('service', default=None)
+_span = contextvars.ContextVar('span', default=None)
+
+class _Span:
+    def __init__(self, phase, parent):
+        self.phase = phase
+        self.parent = parent
+        self.nested = 0.0
+        self.lock = threading.Lock()
+
+    def add_nested(self, seconds):
+        with self.lock:
+            self.nested += seconds
+
+def record_phase(phase, seconds):
+    """
+    Record time spent in a phase of the current service call, outside of a span.
+
+    The time is subtracted from the enclosing span, so that nested phases are
+    not counted twice.
+    """
+    service = _service.get()
+    if service is None:
+        return
+    parent = _span.get()
+    if parent is not None:
+        parent.add_nested(seconds)
+    SERVICE_PHASE_DURATION.labels(service, phase).observe(seconds)
+
+class span(ContextDecorator):
+    """
+    Context manager timing one phase of the current service call.
+
+    Usage:
+        with span('serialize'):
+            result = df.to_dict()
+
+    It also decorates plain and async functions, e.g. @span('fetch').
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def _recreate_cm(self):
+        # A fresh span for every call of a decorated function, calls may overlap
+        return span(self.phase)
+
+    def __call__(self, fn):
+        if not inspect.iscoroutinefunction(fn):
+            return super().__call__(fn)
+
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            with self._recreate_cm():
+                return await fn(*args, **kwargs)
+        return inner
+
+    def __enter__(self):
+        self._span = _Span(self.phase, _span.get())
+        self._token = _span.set(self._span)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        _span.reset(self._token)
+        service = _service.get()
+        if service is not None:
+            SERVICE_PHASE_DURATION.labels(service, self.phase).observe(max(elapsed - self._span.nested, 0.0))
+        if self._span.parent is not None:
+            self._span.parent.add_nested(elapsed)
+        return False
+
+def _service_error(service, error):
+    # Count the error under its HTTP status, unexpected errors becoming a 500
+    if isinstance(error, HTTPException):
+        SERVICE_ERRORS.labels(service, str(error.status_code)).inc()
+        return error
+    SERVICE_ERRORS.labels(service, '500').inc()
+    return HTTPException(status_code=500, detail=str(error))
+
+def instrumented(fn):
+    """
+    Decorate a service function so that its spans are labelled with its name
+    and the calls that raise are counted.
+
+    The time of the call outside of the spans opened in it is recorded as
+    its compute phase. The HTTPExceptions raised by the service (400, 404,
+    503...) are passed on as they are, and any other error is answered with
+    a 500. Works for plain and async functions.
+    """
+    service = fn.__name__
+
+    if inspect.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            token = _service.set(service)
+            try:
+                with span('compute'):
+                    return await fn(*args, **kwargs)
+            except Exception as e:
+                error = _service_error(service, e)
+                if error is e:
+                    raise
+                raise error from e
+            finally:
+                _service.reset(token)
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _service.set(service)
+        try:
+            with span('compute'):
+                return fn(*args, **kwargs)
+        except Exception as e:
+            error = _service_error(service, e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            _service.reset(token)
+    return wrapper
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Command listener recording the latency and returned documents of every
+    MongoDB command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    @staticmethod
+    def _key(event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            target = event.command.get('collection')
+        collection = target if isinstance(target, str) else ''
+        with self._lock:
+            self._collections[self._key(event)] = collection
+
+    def _collection(self, event):
+        with self._lock:
+            return self._collections.pop(self._key(event), '')
+
+    def succeeded(self, event):
+        collection = self._collection(event)
+        MONGO_COMMAND_DURATION.labels(event.command_name, collection, 'succeeded').observe(
+            event.duration_micros / 1e6)
+        if event.command_name in ('find', 'aggregate', 'getMore'):
+            try:
+                cursor = event.reply.get('cursor') or {}
+                batch = cursor.get('firstBatch', cursor.get('nextBatch'))
+                if batch is not None:
+                    MONGO_DOCUMENTS_RETURNED.labels(event.command_name, collection).observe(len(batch))
+            except (AttributeError, TypeError):
+                # Raw batch replies are not decoded, their documents are not counted
+                pass
+
+    def failed(self, event):
+        collection = self._collection(event)
+        MONGO_COMMAND_DURATION.labels(event.command_name, collection, 'failed').observe(event.duration_micros / 1e6)
+
+# One listener per process, shared by the pymongo and motor clients
+command_metrics = CommandMetrics()
+
+def timed_task(fn):
+    """
+    Record the run time of an ETL task function, for use under @task.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'failed'
+        try:
+            result = fn(*args, **kwargs)
+            outcome = 'completed'
+            return result
+        finally:
+            ETL_TASK_DURATION.labels(fn.__name__, outcome).observe(time.perf_counter() - start)
+    return wrapper
+
+def write_etl_metrics(path=ETL_METRICS_FILE):
+    """
+    Write the ETL task metrics of this process in the Prometheus text format.
+    """
+    try:
+        write_to_textfile(path, ETL_REGISTRY)
+    except OSError as e:
+        print(f"Could not write the ETL metrics to {path}: {e}")
+
+def metrics_payload(etl_metrics_path=ETL_METRICS_FILE):
+    """
+    Return the Prometheus exposition of this process, followed by the metrics
+    of the last ETL run, and its content type.
+    """
+    payload = generate_latest(REGISTRY)
+    try:
+        with open(etl_metrics_path, 'rb') as metrics_file:
+            payload += metrics_file.read()
+    except OSError:
+        pass
+    return payload, CONTENT_TYPE_LATEST
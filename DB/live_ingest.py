@@ -0,0 +1,289 @@
+import os
+import json
+import math
+from collections import defaultdict
+import pandas as pd
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from DB.manifest import DATA_VERSIONS_COLLECTION, bump_data_version
+from DB.schema import apply_schema, to_records
+from DB.locks import ROLLUPS_LOCK, held_lock
+from DB.sketches import SKETCH_FIELDS, add_to_store_day_sketches
+from DB.rollups import (ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_DAY_HOUR, ROLLUP_STORE_HOUR_WEEKDAY,
+                        ROLLUP_STORE_MONTH, ROLLUPS_VERSION_ID)
+
+# Fields every posted line item must have, after conversion to the ingestion schema
+REQUIRED_FIELDS = [
+    'transaction_id', 'transaction_date', 'transaction_time', 'sales_outlet_id', 'line_item_id',
+    'product_id', 'quantity', 'line_item_amount',
+]
+
+# Measures added up by the rollups
+MEASURES = ('quantity', 'amount', 'line_items', 'receipts')
+
+# Error code of an insert rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+# How long a post waits for the ROLLUPS_LOCK before it is turned away, much
+# shorter than the wait of the ETL flow so that a till is not kept hanging
+INGEST_LOCK_WAIT_SECONDS = float(os.getenv('INGEST_LOCK_WAIT_SECONDS', '2'))
+
+# Seconds a till is told to wait before posting again after being turned away
+INGEST_RETRY_AFTER_SECONDS = max(1, math.ceil(INGEST_LOCK_WAIT_SECONDS))
+
+# Field marking the line items posted to the API, which a full reload of the
+# sales file leaves in place. The line items of the file do not have it.
+SOURCE_FIELD = 'source'
+LIVE_SOURCE = 'live'
+
+def sales_file_config(config_path, collection_name):
+    """
+    Return the ingestion schema and natural key of a collection from the ETL configuration.
+
+    Args:
+        config_path : Path to the data files configuration.
+        collection_name : Name of the collection.
+
+    Returns:
+        tuple: The schema and key fields of the collection, both None when it is not configured.
+    """
+    with open(config_path, 'r') as file:
+        config = json.load(file)
+    for file_config in config['data_files']:
+        if os.path.basename(file_config['path']).split('.')[0].replace(' ', '_') == collection_name:
+            return file_config.get('schema'), file_config.get('key')
+    return None, None
+
+def prepare_line_items(line_items, schema):
+    """
+    Convert posted line items to the types they are stored as.
+
+    Args:
+        line_items : List of line item dicts, with the fields of the sales CSV file.
+        schema : Ingestion schema of the sales collection.
+
+    Returns:
+        pd.DataFrame: The converted line items.
+
+    Raises:
+        ValueError: When there are no line items, or some of them lack a
+            required field or hold a value that cannot be converted.
+    """
+    if not line_items:
+        raise ValueError("No line items were posted")
+    df = apply_schema(pd.DataFrame(line_items), schema)
+    for field in REQUIRED_FIELDS:
+        if field not in df.columns:
+            raise ValueError(f"Line items lack the field '{field}'")
+        invalid = df.index[df[field].isna()].tolist()
+        if invalid:
+            raise ValueError(f"Line items {invalid} have a missing or invalid '{field}'")
+    return df
+
+def insert_line_items(collection, records):
+    """
+    Insert line items, skipping the ones already stored.
+
+    A line item is already stored when its insert is rejected by the unique
+    index on the natural key, which the ETL flow creates on the sales collection.
+
+    Returns:
+        list: Positions of the inserted records.
+    """
+    try:
+        collection.insert_many(records, ordered=False)
+        return list(range(len(records)))
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        return [position for position in range(len(records)) if position not in duplicates]
+
+def _receipt_key(record):
+    return record['sales_outlet_id'], record['transaction_date'], record['transaction_id']
+
+def stored_receipt_lines(collection, records):
+    """
+    Fetch the hour and product of the stored line items of the receipts of some records.
+
+    Returns:
+        dict: Sets of hours and of product ids keyed by (store, date, transaction id).
+    """
+    receipts = {_receipt_key(record) for record in records}
+    query = {"$or": [
+        {"sales_outlet_id": store_id, "transaction_date": date, "transaction_id": transaction_id}
+        for store_id, date, transaction_id in receipts
+    ]}
+    projection = {"_id": 0, "sales_outlet_id": 1, "transaction_date": 1, "transaction_id": 1,
+                  "transaction_time": 1, "product_id": 1}
+    lines = defaultdict(lambda: (set(), set()))
+    for line in collection.find(query, projection):
+        hours, products = lines[_receipt_key(line)]
+        if line.get('transaction_time') is not None:
+            hours.add(line['transaction_time'] // 3600)
+        products.add(line.get('product_id'))
+    return lines
+
+def rollup_increments(records, stored_lines):
+    """
+    Add up new line items into increments of the rollup documents.
+
+    A receipt is counted in a day x hour (or day x product) document when it
+    had no line item in that hour (or of that product) yet, as the rollup
+    pipelines of DB/rollups.py count the distinct transaction ids of a group.
+
+    Args:
+        records : New line items.
+        stored_lines : Hours and products of the stored line items of their
+            receipts, see stored_receipt_lines. Updated with the new line items.
+
+    Returns:
+        tuple: Increments of the day x hour, day x product and month
+        documents, keyed by the _id of the document.
+    """
+    day_hour, day_product, month = (defaultdict(lambda: dict.fromkeys(MEASURES, 0)) for _ in range(3))
+    for record in records:
+        store_id, date = record['sales_outlet_id'], record['transaction_date']
+        hour = record['transaction_time'] // 3600
+        product_id = record['product_id']
+        hours, products = stored_lines[_receipt_key(record)]
+        new_in_hour, new_in_product = hour not in hours, product_id not in products
+        hours.add(hour)
+        products.add(product_id)
+        keys = (
+            (day_hour, (store_id, date, hour), new_in_hour),
+            (day_product, (store_id, date, product_id), new_in_product),
+            # Receipts of a month add up the receipts of its day x hour documents
+            (month, (store_id, date.year, date.month), new_in_hour),
+        )
+        for increments, key, new_receipt in keys:
+            totals = increments[key]
+            totals['quantity'] += record['quantity']
+            totals['amount'] += record['line_item_amount']
+            totals['line_items'] += 1
+            totals['receipts'] += int(new_receipt)
+    return day_hour, day_product, month
+
+def _upsert(key_fields, key, increments, extra=None):
+    _id = dict(zip(key_fields, key))
+    return UpdateOne({'_id': _id}, {'$inc': increments, '$setOnInsert': dict(_id, **(extra or {}))}, upsert=True)
+
+def update_rollups(db, records, stored_lines):
+    """
+    Add new line items to the rollup collections with $inc updates.
+
+    Each line item changes one day x hour, one day x product, one month and
+    one weekday x hour document, whatever the number of line items stored.
+    """
+    day_hour, day_product, month = rollup_increments(records, stored_lines)
+
+    day_hour_keys = list(day_hour)
+    result = db[ROLLUP_STORE_DAY_HOUR].bulk_write([
+        _upsert(('sales_outlet_id', 'transaction_date', 'hour'), key, day_hour[key], {'weekday': key[1].weekday()})
+        for key in day_hour_keys
+    ], ordered=False)
+    created = {(_id['sales_outlet_id'], _id['transaction_date'], _id['hour']) for _id in result.upserted_ids.values()}
+    # The weekday x hour documents count the day x hour documents they add up
+    weekday_hour = defaultdict(lambda: dict.fromkeys(MEASURES + ('days',), 0))
+    for store_id, date, hour in day_hour_keys:
+        totals = weekday_hour[(store_id, date.weekday(), hour)]
+        for measure in MEASURES:
+            totals[measure] += day_hour[(store_id, date, hour)][measure]
+        totals['days'] += int((store_id, date, hour) in created)
+
+    updates = (
+        (ROLLUP_STORE_HOUR_WEEKDAY, ('sales_outlet_id', 'weekday', 'hour'), weekday_hour),
+        (ROLLUP_STORE_DAY_PRODUCT, ('sales_outlet_id', 'transaction_date', 'product_id'), day_product),
+        (ROLLUP_STORE_MONTH, ('sales_outlet_id', 'year', 'month'), month),
+    )
+    for collection_name, key_fields, increments in updates:
+        db[collection_name].bulk_write([_upsert(key_fields, key, totals) for key, totals in increments.items()],
+                                       ordered=False)
+
+def advance_versions(db, sales_collection_name, touched_dates):
+    """
+    Record the new line items in the data versions.
+
+    The version of the sales collection is incremented. When the rollups
+    were built from the previous version they now reflect the new one too
+    and follow it, otherwise the touched dates are left to the next rollup
+    refresh like the dates written by the ETL flow.
+
+    Returns:
+        dict: The new data versions of the sales collection and of the rollups.
+    """
+    versions = db[DATA_VERSIONS_COLLECTION]
+    rollups = versions.find_one({'_id': ROLLUPS_VERSION_ID}) or {}
+    previous = versions.find_one_and_update(
+        {'_id': sales_collection_name},
+        {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}},
+        upsert=True, return_document=ReturnDocument.BEFORE
+    ) or {}
+    version = (previous.get('version') or 0) + 1
+    rollups_current = (rollups.get('version') is not None and rollups.get('version') == previous.get('version')
+                       and not previous.get('pending_dates'))
+    if rollups_current:
+        versions.update_one(
+            {'_id': ROLLUPS_VERSION_ID},
+            {'$max': {'version': version}, '$currentDate': {'updated_at': True}}
+        )
+        return {sales_collection_name: version, ROLLUPS_VERSION_ID: version}
+    versions.update_one({'_id': sales_collection_name},
+                        {'$addToSet': {'pending_dates': {'$each': sorted(touched_dates)}}})
+    return {sales_collection_name: version, ROLLUPS_VERSION_ID: rollups.get('version')}
+
+def ingest_line_items(db, sales_collection_name, df, lock_wait=INGEST_LOCK_WAIT_SECONDS):
+    """
+    Write posted line items through to MongoDB and add them to the aggregates.
+
+    The line items are inserted into the sales collection, then added to the
+    rollup collections and to the store and day sketches, and the data
+    versions are advanced so that the API caches pick them up. None of the
+    line items already stored are read back, apart from the other lines of
+    the posted receipts. The line items are stored with SOURCE_FIELD set to
+    LIVE_SOURCE, so that a full reload of the sales file keeps them. The
+    ingestion requests of all the API processes and the rollup refresh of
+    the ETL flow are serialized by the ROLLUPS_LOCK document, so that two of
+    them never both count the same receipt as new.
+
+    Args:
+        db : MongoDB database instance.
+        sales_collection_name : Name of the sales line item collection.
+        df : Line items converted by prepare_line_items.
+        lock_wait : Seconds to wait for the ROLLUPS_LOCK.
+
+    Returns:
+        dict: Number of line items received, inserted and already stored, the
+        inserted line items and the new data versions.
+
+    Raises:
+        TimeoutError: When the ROLLUPS_LOCK is still held after lock_wait
+            seconds. Nothing was written and the line items can be posted again.
+    """
+    with held_lock(db, ROLLUPS_LOCK, wait=lock_wait):
+        collection = db[sales_collection_name]
+        records = [dict(record, **{SOURCE_FIELD: LIVE_SOURCE}) for record in to_records(df.copy())]
+        stored_lines = stored_receipt_lines(collection, records)
+        inserted = insert_line_items(collection, records)
+        new_records = [records[position] for position in inserted]
+        new_rows = df.iloc[inserted].reset_index(drop=True)
+
+        versions = {}
+        if new_records:
+            touched_dates = {record['transaction_date'] for record in new_records}
+            try:
+                update_rollups(db, new_records, stored_lines)
+                add_to_store_day_sketches(db, new_rows.reindex(columns=list(SKETCH_FIELDS)))
+            except Exception:
+                # The line items are stored, leave their dates to the next rollup refresh
+                bump_data_version(db, sales_collection_name, touched_dates)
+                raise
+            versions = advance_versions(db, sales_collection_name, touched_dates)
+    return {
+        'received': len(records),
+        'inserted': len(new_records),
+        'duplicates': len(records) - len(new_records),
+        'rows': new_rows,
+        'versions': versions,
+    }
@@ -0,0 +1,71 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError
+
+# Collection holding one document per lock held by a process
+LOCKS_COLLECTION = 'locks'
+
+# Lock serializing the writers of the rollups and sketches: the live ingestion
+# requests of every API process and the rollup refresh of the ETL flow
+ROLLUPS_LOCK = 'rollups'
+
+# A lock whose holder died is taken over once it has been held this long
+LOCK_TTL_SECONDS = float(os.getenv('LOCK_TTL_SECONDS', '600'))
+
+# How long to wait for a lock held by another process before giving up
+LOCK_WAIT_SECONDS = float(os.getenv('LOCK_WAIT_SECONDS', '60'))
+
+# Pause between two attempts to take a held lock
+LOCK_RETRY_SECONDS = 0.05
+
+def acquire_lock(db, name, owner, ttl=LOCK_TTL_SECONDS):
+    """
+    Try once to take a lock.
+
+    The lock is held by the process that inserted its document. A document
+    past its expiry is left by a holder that died, and is taken over.
+
+    Returns:
+        bool: Whether the lock is now held by owner.
+    """
+    locks = db[LOCKS_COLLECTION]
+    now = datetime.now(timezone.utc)
+    document = {'owner': owner, 'acquired_at': now, 'expires_at': now + timedelta(seconds=ttl)}
+    try:
+        locks.insert_one({'_id': name, **document})
+        return True
+    except DuplicateKeyError:
+        result = locks.update_one({'_id': name, 'expires_at': {'$lte': now}}, {'$set': document})
+        return result.modified_count == 1
+
+def release_lock(db, name, owner):
+    # Only the holder removes the lock, not a process whose lock expired and was taken over
+    db[LOCKS_COLLECTION].delete_one({'_id': name, 'owner': owner})
+
+@contextmanager
+def held_lock(db, name, ttl=LOCK_TTL_SECONDS, wait=LOCK_WAIT_SECONDS):
+    """
+    Hold a lock shared by all the processes using the database for the duration of a block.
+
+    Args:
+        db : MongoDB database instance.
+        name : Name of the lock, e.g. ROLLUPS_LOCK.
+        ttl : Seconds after which the lock is taken over if it was not released.
+        wait : Seconds to wait for the lock when another process holds it.
+
+    Raises:
+        TimeoutError: When the lock is still held by another process after wait seconds.
+    """
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    while not acquire_lock(db, name, owner, ttl):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"The '{name}' lock is held by another process")
+        time.sleep(LOCK_RETRY_SECONDS)
+    try:
+        yield owner
+    finally:
+        release_lock(db, name, owner)
@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+
+# Collection holding one document per ingested file
+MANIFEST_COLLECTION = 'ingestion_manifest'
+
+# Collection holding a version counter per data collection, bumped by
+# every ingestion that writes to it. Readers caching data compare against it.
+DATA_VERSIONS_COLLECTION = 'data_versions'
+
+# Block size used when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def load_manifest(db, data_paths):
+    """
+    Fetch the manifest entries of the given files in a single query.
+
+    Args:
+        db : MongoDB database instance.
+        data_paths : Paths of the files listed in the configuration.
+
+    Returns:
+        dict: Manifest entries keyed by file path.
+    """
+    entries = db[MANIFEST_COLLECTION].find({'_id': {'$in': list(data_paths)}})
+    return {entry['_id']: entry for entry in entries}
+
+def file_fingerprint(data_path, prefix_size=None):
+    """
+    Hash a file, optionally also hashing its first prefix_size bytes.
+
+    Both digests are computed in a single pass over the file.
+
+    Returns:
+        tuple: (sha256 of the whole file, sha256 of the prefix or None)
+    """
+    digest = hashlib.sha256()
+    prefix_digest = None
+    read = 0
+    with open(data_path, 'rb') as file:
+        while True:
+            block = file.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            if prefix_size is not None and prefix_digest is None and read + len(block) >= prefix_size:
+                digest.update(block[:prefix_size - read])
+                prefix_digest = digest.copy()
+                digest.update(block[prefix_size - read:])
+            else:
+                digest.update(block)
+            read += len(block)
+    return digest.hexdigest(), prefix_digest.hexdigest() if prefix_digest else None
+
+def config_fingerprint(file_config):
+    """
+    Hash the parts of a file configuration that affect the stored documents.
+    """
+    relevant = {key: value for key, value in file_config.items() if key not in ('path', 'chunk_size', 'indexes')}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+def _ends_with_newline(data_path, size):
+    with open(data_path, 'rb') as file:
+        file.seek(size - 1)
+        return file.read(1) == b'\n'
+
+def plan_ingestion(entry, data_path, file_config):
+    """
+    Decide how much of a file has to be (re)ingested.
+
+    Unchanged size and mtime skip the file without reading it. Otherwise the
+    file is hashed: identical content is skipped, content that only grew past
+    the previously ingested bytes is loaded from that byte offset, and
+    anything else is reloaded in full. A full reload always goes into an
+    emptied collection, keyed files included, so that the rows removed from
+    the file, or stored under another configuration (dropped columns, key or
+    schema), do not survive it.
+
+    Args:
+        entry : The manifest entry of the file, or None if it was never ingested.
+        data_path : Path to the CSV file.
+        file_config : The configuration entry of the file.
+
+    Returns:
+        dict: 'action' ('skip', 'append' or 'full'), the byte 'offset' to
+        start reading from, whether to 'replace' the collection contents and
+        the new 'fingerprint' of the file.
+    """
+    stat = os.stat(data_path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'config_sha256': config_fingerprint(file_config)}
+    if entry is None or entry.get('config_sha256') != fingerprint['config_sha256']:
+        fingerprint['sha256'] = file_fingerprint(data_path)[0]
+        return {'action': 'full', 'offset': 0, 'replace': True, 'fingerprint': fingerprint}
+    if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        fingerprint['sha256'] = entry['sha256']
+        return {'action': 'skip', 'offset': 0, 'replace': False, 'fingerprint': fingerprint, 'unchanged': True}
+
+    grew = 0 < entry['size'] < stat.st_size
+    sha256, prefix_sha256 = file_fingerprint(data_path, entry['size'] if grew else None)
+    fingerprint['sha256'] = sha256
+
+    if sha256 == entry['sha256']:
+        return {'action': 'skip', 'offset': 0, 'replace': False, 'fingerprint': fingerprint, 'unchanged': False}
+    if grew and prefix_sha256 == entry['sha256'] and _ends_with_newline(data_path, entry['size']):
+        return {'action': 'append', 'offset': entry['size'], 'replace': False, 'fingerprint': fingerprint}
+    return {'action': 'full', 'offset': 0, 'replace': True, 'fingerprint': fingerprint}
+
+def record_ingestion(db, data_path, fingerprint, rows=0):
+    """
+    Store the fingerprint of an ingested file in the manifest.
+
+    Args:
+        db : MongoDB database instance.
+        data_path : Path to the CSV file.
+        fingerprint : Size, mtime and content hash of the ingested file.
+        rows : Number of rows written by this run.
+    """
+    db[MANIFEST_COLLECTION].update_one(
+        {'_id': data_path},
+        {'$set': dict(fingerprint, rows_written=rows)},
+        upsert=True
+    )
+
+def bump_data_version(db, collection_name, touched_dates=None):
+    """
+    Mark the contents of a collection as changed by incrementing its version.
+
+    Args:
+        db : MongoDB database instance.
+        collection_name : Name of the changed collection.
+        touched_dates : Dates of the written rows. They are added to the
+            'pending_dates' of the collection, from which the rollups are
+            refreshed incrementally.
+    """
+    update = {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}}
+    if touched_dates:
+        update['$addToSet'] = {'pending_dates': {'$each': sorted(touched_dates)}}
+    db[DATA_VERSIONS_COLLECTION].update_one({'_id': collection_name}, update, upsert=True)
+
+def load_data_versions(db):
+    """
+    Fetch the current version of every data collection.
+
+    Returns:
+        dict: Version numbers keyed by collection name.
+    """
+    entries = db[DATA_VERSIONS_COLLECTION].find({}, {'version': 1})
+    return {entry['_id']: entry.get('version') for entry in entries}
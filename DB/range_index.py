@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+# Bucket boundaries of each granularity of a range query
+GRANULARITY_FREQ = {'hour': 'h', 'day': 'D', 'week': 'W-MON', 'month': 'MS'}
+
+# Most buckets a range query may return, e.g. 416 days of hours
+MAX_BUCKETS = 10000
+
+# Length of the buckets of a fixed length granularity
+GRANULARITY_SPAN = {'hour': pd.Timedelta(hours=1), 'day': pd.Timedelta(days=1), 'week': pd.Timedelta(weeks=1)}
+
+def _timestamps(sales_df):
+    # Line item timestamps as int64 nanoseconds: the date plus the time of day when known
+    times = sales_df['transaction_date'].to_numpy(dtype='datetime64[ns]')
+    if 'transaction_time' in sales_df.columns:
+        time_of_day = sales_df['transaction_time']
+        if pd.api.types.is_numeric_dtype(time_of_day):
+            offsets = pd.to_timedelta(time_of_day, unit='s')
+        else:
+            offsets = pd.to_timedelta(time_of_day, errors='coerce')
+        times = times + offsets.fillna(pd.Timedelta(0)).to_numpy(dtype='timedelta64[ns]')
+    return times.astype('int64')
+
+def _to_nanoseconds(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp.value
+
+def bucket_count(start, end, granularity):
+    """
+    Return an upper bound of the number of buckets of [start, end), without building them.
+    """
+    start, end = pd.Timestamp(_to_nanoseconds(start)), pd.Timestamp(_to_nanoseconds(end))
+    if granularity == 'month':
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return int(np.ceil((end - start) / GRANULARITY_SPAN[granularity])) + 1
+
+class _CumulativeSums:
+    # Sorted timestamps of one store with a running total of every measure
+    def __init__(self, times, measures):
+        self.times = times
+        self.sums = {name: np.concatenate(([0], np.cumsum(values))) for name, values in measures.items()}
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + sum(sums.nbytes for sums in self.sums.values())
+
+    def interval_sums(self, starts, ends):
+        # Totals of the independent [starts[i], ends[i]) ranges
+        first = np.searchsorted(self.times, starts, side='left')
+        last = np.searchsorted(self.times, ends, side='left')
+        return {name: sums[last] - sums[first] for name, sums in self.sums.items()}
+
+    def range_sums(self, edges):
+        # Totals of the consecutive [edges[i], edges[i + 1]) ranges
+        positions = np.searchsorted(self.times, edges, side='left')
+        return {name: sums[positions[1:]] - sums[positions[:-1]] for name, sums in self.sums.items()}
+
+class SalesRangeIndex:
+    """
+    Prefix-sum index of the sales line items for arbitrary time range totals.
+
+    The line items are sorted by time, per store and over all stores, with
+    running totals of the sales amount, the quantity, the line items and the
+    receipts. The total of any [start, end) range is then two binary searches
+    and a subtraction, however many line items the range covers.
+
+    Args:
+        sales_df : Line items with transaction_date and line_item_amount, and
+            optionally transaction_time, sales_outlet_id, quantity and
+            transaction_id. Measures whose column is missing are left out.
+    """
+
+    def __init__(self, sales_df):
+        sales_df = sales_df[sales_df['transaction_date'].notna()]
+        times = _timestamps(sales_df)
+        order = np.argsort(times, kind='stable')
+
+        measures = {
+            'sales': sales_df['line_item_amount'].to_numpy(dtype='float64', na_value=0.0),
+            'line_items': np.ones(len(sales_df), dtype='int64'),
+        }
+        if 'quantity' in sales_df.columns:
+            measures['quantity'] = sales_df['quantity'].to_numpy(dtype='int64', na_value=0)
+        if 'transaction_id' in sales_df.columns:
+            # Count each receipt once, at its first line item
+            receipt_key = [column for column in ('sales_outlet_id', 'transaction_date', 'transaction_id')
+                           if column in sales_df.columns]
+            measures['receipts'] = (~sales_df.duplicated(subset=receipt_key)).to_numpy(dtype='int64')
+
+        times = times[order]
+        measures = {name: values[order] for name, values in measures.items()}
+        self.measures = list(measures)
+        self._sums = {None: _CumulativeSums(times, measures)}
+
+        if 'sales_outlet_id' in sales_df.columns:
+            stores = sales_df['sales_outlet_id'].to_numpy()[order]
+            # A stable sort by store keeps each store's line items sorted by time
+            by_store = np.argsort(stores, kind='stable')
+            store_ids, starts = np.unique(stores[by_store], return_index=True)
+            ends = np.append(starts[1:], len(by_store))
+            for store_id, start, end in zip(store_ids, starts, ends):
+                positions = by_store[start:end]
+                self._sums[int(store_id)] = _CumulativeSums(
+                    times[positions], {name: values[positions] for name, values in measures.items()}
+                )
+
+    @property
+    def stores(self):
+        return [store_id for store_id in self._sums if store_id is not None]
+
+    @property
+    def nbytes(self):
+        return sum(sums.nbytes for sums in self._sums.values())
+
+    def totals(self, start, end, store_id=None):
+        """
+        Return the totals of every measure over [start, end).
+
+        Args:
+            start : Start of the range, included.
+            end : End of the range, excluded.
+            store_id : Store to total. Defaults to all stores.
+
+        Returns:
+            dict: Total of each measure.
+        """
+        sums = self._sums[store_id].range_sums(np.array([_to_nanoseconds(start), _to_nanoseconds(end)]))
+        return {name: values[0].item() for name, values in sums.items()}
+
+    def range_totals(self, starts, ends, store_id=None):
+        """
+        Return the totals of every measure over many [start, end) ranges at once.
+
+        Args:
+            starts : Starts of the ranges, included.
+            ends : Ends of the ranges, excluded.
+            store_id : Store to total. Defaults to all stores. A store without
+                line items totals to zero.
+
+        Returns:
+            dict: Array of the range totals of each measure.
+        """
+        starts = pd.DatetimeIndex(starts).asi8
+        ends = pd.DatetimeIndex(ends).asi8
+        sums = self._sums.get(store_id)
+        if sums is None:
+            return {name: np.zeros(len(starts)) for name in self.measures}
+        return sums.interval_sums(starts, ends)
+
+    def buckets(self, start, end, granularity, store_id=None):
+        """
+        Return the totals of every measure per hour, day, week or month of [start, end).
+
+        The first and last buckets are clipped to the range.
+
+        Returns:
+            list: One dict per bucket with its start, end and measure totals.
+
+        Raises:
+            ValueError: When the range holds more than MAX_BUCKETS buckets.
+        """
+        if bucket_count(start, end, granularity) > MAX_BUCKETS:
+            raise ValueError(f"The range holds more than {MAX_BUCKETS} {granularity} buckets")
+        start, end = pd.Timestamp(_to_nanoseconds(start)), pd.Timestamp(_to_nanoseconds(end))
+        boundaries = pd.date_range(start.normalize(), end, freq=GRANULARITY_FREQ[granularity])
+        edges = pd.DatetimeIndex([start]).append(boundaries[(boundaries > start) & (boundaries < end)])
+        edges = edges.append(pd.DatetimeIndex([end]))
+        sums = self._sums[store_id].range_sums(edges.asi8)
+        return [
+            {'start': edges[i], 'end': edges[i + 1], **{name: values[i].item() for name, values in sums.items()}}
+            for i in range(len(edges) - 1)
+        ]
@@ -0,0 +1,176 @@
+from datetime import datetime
+from DB.manifest import DATA_VERSIONS_COLLECTION
+from DB.locks import ROLLUPS_LOCK, held_lock
+from DB.sketches import refresh_store_day_sketches
+
+# Pre-aggregated collections maintained by the ETL flow
+ROLLUP_STORE_DAY_PRODUCT = 'rollup_store_day_product'
+ROLLUP_STORE_DAY_HOUR = 'rollup_store_day_hour'
+ROLLUP_STORE_HOUR_WEEKDAY = 'rollup_store_hour_weekday'
+ROLLUP_STORE_MONTH = 'rollup_store_month'
+
+# data_versions entry holding the sales version the rollups were built from,
+# and whether they were ever fully built ('built')
+ROLLUPS_VERSION_ID = 'rollups'
+
+# Hour of a transaction_time stored in seconds since midnight and weekday of a date (Monday=0)
+HOUR = {"$toInt": {"$floor": {"$divide": ["$transaction_time", 3600]}}}
+WEEKDAY = {"$subtract": [{"$isoDayOfWeek": "$transaction_date"}, 1]}
+
+def _merge_into(collection_name):
+    return {"$merge": {"into": collection_name, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+
+def store_day_product_pipeline(match):
+    """
+    Roll line items up to store x day x product.
+    """
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"sales_outlet_id": "$sales_outlet_id", "transaction_date": "$transaction_date",
+                    "product_id": "$product_id"},
+            "quantity": {"$sum": "$quantity"},
+            "amount": {"$sum": "$line_item_amount"},
+            "line_items": {"$sum": 1},
+            "transactions": {"$addToSet": "$transaction_id"},
+        }},
+        {"$project": {
+            "sales_outlet_id": "$_id.sales_outlet_id", "transaction_date": "$_id.transaction_date",
+            "product_id": "$_id.product_id", "quantity": 1, "amount": 1, "line_items": 1,
+            "receipts": {"$size": "$transactions"},
+        }},
+        _merge_into(ROLLUP_STORE_DAY_PRODUCT),
+    ]
+
+def store_day_hour_pipeline(match):
+    """
+    Roll line items up to store x day x hour.
+    """
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"sales_outlet_id": "$sales_outlet_id", "transaction_date": "$transaction_date", "hour": HOUR},
+            "weekday": {"$first": WEEKDAY},
+            "quantity": {"$sum": "$quantity"},
+            "amount": {"$sum": "$line_item_amount"},
+            "line_items": {"$sum": 1},
+            "transactions": {"$addToSet": "$transaction_id"},
+        }},
+        {"$project": {
+            "sales_outlet_id": "$_id.sales_outlet_id", "transaction_date": "$_id.transaction_date",
+            "hour": "$_id.hour", "weekday": 1, "quantity": 1, "amount": 1, "line_items": 1,
+            "receipts": {"$size": "$transactions"},
+        }},
+        _merge_into(ROLLUP_STORE_DAY_HOUR),
+    ]
+
+def store_hour_weekday_pipeline():
+    """
+    Roll the store x day x hour rollup up to store x weekday x hour.
+    """
+    return [
+        {"$group": {
+            "_id": {"sales_outlet_id": "$sales_outlet_id", "weekday": "$weekday", "hour": "$hour"},
+            "quantity": {"$sum": "$quantity"},
+            "amount": {"$sum": "$amount"},
+            "line_items": {"$sum": "$line_items"},
+            "receipts": {"$sum": "$receipts"},
+            "days": {"$sum": 1},
+        }},
+        {"$project": {
+            "sales_outlet_id": "$_id.sales_outlet_id", "weekday": "$_id.weekday", "hour": "$_id.hour",
+            "quantity": 1, "amount": 1, "line_items": 1, "receipts": 1, "days": 1,
+        }},
+        {"$out": ROLLUP_STORE_HOUR_WEEKDAY},
+    ]
+
+def store_month_pipeline(match):
+    """
+    Roll the store x day x hour rollup up to store x month.
+    """
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"sales_outlet_id": "$sales_outlet_id", "year": {"$year": "$transaction_date"},
+                    "month": {"$month": "$transaction_date"}},
+            "quantity": {"$sum": "$quantity"},
+            "amount": {"$sum": "$amount"},
+            "line_items": {"$sum": "$line_items"},
+            "receipts": {"$sum": "$receipts"},
+        }},
+        {"$project": {
+            "sales_outlet_id": "$_id.sales_outlet_id", "year": "$_id.year", "month": "$_id.month",
+            "quantity": 1, "amount": 1, "line_items": 1, "receipts": 1,
+        }},
+        _merge_into(ROLLUP_STORE_MONTH),
+    ]
+
+def _month_ranges(dates):
+    # Date range filter covering the calendar months of the given dates
+    months = sorted({(date.year, date.month) for date in dates})
+    ranges = []
+    for year, month in months:
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        ranges.append({"transaction_date": {"$gte": start, "$lt": end}})
+    return {"$or": ranges}
+
+def refresh_rollups(db, sales_collection_name, full=False):
+    """
+    Bring the rollup collections up to date with the sales collection.
+
+    Only the dates recorded as touched by the ingestion step are recomputed,
+    from the line items of those dates. The month rollup is recomputed for
+    the months of those dates and the weekday x hour rollup from the (small)
+    day x hour rollup. The store x day sketches of DB/sketches.py are rebuilt
+    for the same dates. The rollups are fully rebuilt when full is set or
+    when no full build was recorded yet, even if posted line items were
+    already added to them. The refresh holds the ROLLUPS_LOCK document, so
+    that it does not interleave with the live ingestion of DB/live_ingest.py.
+
+    Args:
+        db : MongoDB database instance.
+        sales_collection_name : Name of the sales line item collection.
+        full : Rebuild the rollups from the whole sales history.
+
+    Returns:
+        dict: Number of dates refreshed and the sales version the rollups now reflect.
+    """
+    with held_lock(db, ROLLUPS_LOCK):
+        versions = db[DATA_VERSIONS_COLLECTION]
+        source = versions.find_one({'_id': sales_collection_name}) or {}
+        dates = source.get('pending_dates', [])
+        full = full or not (versions.find_one({'_id': ROLLUPS_VERSION_ID}) or {}).get('built')
+
+        if full:
+            match, month_match = {}, {}
+        elif dates:
+            match = {"transaction_date": {"$in": dates}}
+            month_match = _month_ranges(dates)
+        else:
+            match = None
+
+        if match is not None:
+            for name in (ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_DAY_HOUR):
+                db[name].delete_many(match)
+            db[ROLLUP_STORE_MONTH].delete_many(
+                {} if full else {"$or": [{"year": date.year, "month": date.month} for date in dates]}
+            )
+            sales = db[sales_collection_name]
+            sales.aggregate(store_day_product_pipeline(match))
+            sales.aggregate(store_day_hour_pipeline(match))
+            db[ROLLUP_STORE_DAY_HOUR].aggregate(store_month_pipeline(month_match))
+            db[ROLLUP_STORE_DAY_HOUR].aggregate(store_hour_weekday_pipeline())
+            for name in (ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_DAY_HOUR):
+                db[name].create_index([("sales_outlet_id", 1), ("transaction_date", 1)])
+                db[name].create_index([("transaction_date", 1)])
+            refresh_store_day_sketches(db, sales_collection_name, None if full else dates)
+
+        if dates:
+            versions.update_one({'_id': sales_collection_name}, {'$pullAll': {'pending_dates': dates}})
+        versions.update_one(
+            {'_id': ROLLUPS_VERSION_ID},
+            {'$set': {'version': source.get('version'), 'built': True}, '$currentDate': {'updated_at': True}},
+            upsert=True
+        )
+    return {'full': full, 'dates': len(dates), 'version': source.get('version')}
@@ -0,0 +1,85 @@
+from decimal import Decimal, InvalidOperation
+import pandas as pd
+from bson.decimal128 import Decimal128
+from DB.compact import seconds_since_midnight
+
+# Integer column types and the nullable pandas dtype they are converted to
+INT_TYPES = {'int8': 'Int8', 'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64'}
+
+# Values accepted for boolean columns
+BOOL_VALUES = {'Y': True, 'N': False}
+
+def _strip_number(series):
+    # Remove currency symbols, thousands separators and padding, e.g. "$18.00 "
+    if pd.api.types.is_numeric_dtype(series):
+        return series
+    return series.astype(str).str.replace(r'[^0-9.\-]', '', regex=True)
+
+def _to_decimal128(value):
+    try:
+        return Decimal128(Decimal(value))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+def convert_column(series, spec):
+    """
+    Convert a column to the type declared in the ingestion schema.
+
+    Args:
+        series : The column as parsed from the CSV file.
+        spec : A type name, or a dict with a 'type' and optional 'format'.
+            Supported types are datetime, float, decimal, bool, int8, int16,
+            int32, int64 and seconds ("HH:MM:SS" times of day stored as
+            seconds since midnight).
+
+    Returns:
+        pd.Series: The converted column. Unparseable values become missing values.
+    """
+    if isinstance(spec, str):
+        spec = {'type': spec}
+    column_type = spec['type']
+
+    if column_type == 'datetime':
+        return pd.to_datetime(series, format=spec.get('format'), errors='coerce')
+    if column_type == 'float':
+        return pd.to_numeric(_strip_number(series), errors='coerce').astype('float64')
+    if column_type == 'decimal':
+        return _strip_number(series).astype(str).map(_to_decimal128)
+    if column_type == 'bool':
+        return series.astype(str).str.strip().str.upper().map(BOOL_VALUES).astype('boolean')
+    if column_type == 'seconds':
+        return seconds_since_midnight(series).astype('Int32')
+    if column_type in INT_TYPES:
+        return pd.to_numeric(_strip_number(series), errors='coerce').astype(INT_TYPES[column_type])
+    raise ValueError(f"Unsupported column type '{column_type}' for column {series.name}")
+
+def apply_schema(df, schema):
+    """
+    Convert the columns of a DataFrame according to an ingestion schema.
+
+    Args:
+        df : The DataFrame to convert.
+        schema : Dict mapping column names to type specs. Columns that are
+            missing from the DataFrame are ignored.
+
+    Returns:
+        pd.DataFrame: The converted DataFrame.
+    """
+    for column, spec in (schema or {}).items():
+        if column in df.columns:
+            df[column] = convert_column(df[column], spec)
+    return df
+
+def to_records(df):
+    """
+    Convert a DataFrame to a list of documents that can be encoded as BSON.
+
+    Missing values of datetime and nullable columns are stored as null, since
+    NaT and pd.NA have no BSON representation.
+    """
+    for column in df.columns:
+        series = df[column]
+        nullable = pd.api.types.is_extension_array_dtype(series) or pd.api.types.is_datetime64_any_dtype(series)
+        if nullable and series.isna().any():
+            df[column] = series.astype(object).where(series.notna(), None)
+    return df.to_dict('records')
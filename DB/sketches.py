@@ -0,0 +1,448 @@
+import math
+import numpy as np
+from pymongo.errors import DuplicateKeyError
+from DB.columnar import fetch_columns
+
+# Collection of the sketches of each store and day, maintained with the rollups
+SKETCH_STORE_DAY = 'sketch_store_day'
+
+# HyperLogLog registers: 2 ** 12 one-byte registers (4 KiB) per sketch,
+# distinct counts within 1.04 / sqrt(4096) = 1.6% relative standard error
+HLL_PRECISION = 12
+
+# Products kept by the Space-Saving summary of each store and day
+SPACE_SAVING_CAPACITY = 32
+
+# Count-Min table of each store and day: the quantity of a product is
+# overestimated by at most e / width of the total quantity, with probability
+# 1 - exp(-depth), i.e. 1.1% of the total with 98% probability
+COUNT_MIN_WIDTH = 256
+COUNT_MIN_DEPTH = 4
+
+# Days of line items fetched at once when the sketches are rebuilt
+SKETCH_DATES_PER_BATCH = 31
+
+# Attempts at merging new line items into a sketch rewritten by another writer meanwhile
+SKETCH_WRITE_ATTEMPTS = 5
+
+SKETCH_FIELDS = {
+    'sales_outlet_id': 'int', 'transaction_date': 'datetime', 'transaction_id': 'int', 'customer_id': 'int',
+    'product_id': 'int', 'quantity': 'int', 'line_item_amount': 'float',
+}
+
+def hash64(values, seed=0):
+    """
+    Hash integer ids to uniformly distributed uint64 values (splitmix64).
+
+    The hash only depends on the values, so sketches built in different
+    processes can be merged.
+    """
+    x = np.asarray(values).astype('int64').view('uint64') + np.uint64(0x9E3779B97F4A7C15 + seed)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+class HyperLogLog:
+    """
+    Mergeable distinct count sketch.
+
+    The estimate has a relative standard error of 1.04 / sqrt(2 ** precision),
+    whatever the number of values added, and merging sketches gives the
+    sketch of the union of their values.
+    """
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        # The bits left after the register index must fit the 53-bit mantissa of a float64
+        if not 11 <= precision <= 16:
+            raise ValueError(f"precision must be between 11 and 16, got {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype='uint8') if registers is None else registers
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, values):
+        hashes = hash64(values)
+        if len(hashes) == 0:
+            return self
+        index = (hashes >> np.uint64(64 - self.precision)).astype('int64')
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # Position of the first set bit of the remaining bits, 64 - precision + 1 when none is set
+        _, bit_length = np.frexp(rest.astype('float64'))
+        ranks = (64 - self.precision - bit_length + 1).astype('uint8')
+        np.maximum.at(self.registers, index, ranks)
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype('int64')))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        registers = np.frombuffer(data, dtype='uint8').copy()
+        return cls(int(math.log2(len(registers))), registers)
+
+class SpaceSaving:
+    """
+    Mergeable summary of the heaviest items of a weighted stream.
+
+    At most capacity items are tracked, each with an estimated count and the
+    maximum overestimation of that count: the true count lies in
+    [count - error, count]. Any item that is not tracked has a true count of
+    at most floor. For the exact counts of one store and day the floor is
+    below total / (capacity + 1), merging adds up the floors.
+    """
+
+    def __init__(self, capacity=SPACE_SAVING_CAPACITY, counts=None, errors=None, floor=0):
+        self.capacity = capacity
+        self.counts = counts or {}
+        self.errors = errors or {}
+        self.floor = floor
+
+    @classmethod
+    def from_counts(cls, items, counts, capacity=SPACE_SAVING_CAPACITY):
+        """
+        Summarize exact counts, keeping the capacity largest ones.
+        """
+        summary = cls(capacity, {int(item): int(count) for item, count in zip(items, counts)})
+        return summary._truncate()
+
+    def _truncate(self):
+        if len(self.counts) > self.capacity:
+            ranked = sorted(self.counts, key=lambda item: (-self.counts[item], item))
+            for item in ranked[self.capacity:]:
+                self.floor = max(self.floor, self.counts.pop(item))
+                self.errors.pop(item, None)
+        return self
+
+    def merge(self, other):
+        items = set(self.counts) | set(other.counts)
+        counts = {item: self.counts.get(item, self.floor) + other.counts.get(item, other.floor) for item in items}
+        errors = {
+            item: (self.errors.get(item, 0) if item in self.counts else self.floor)
+            + (other.errors.get(item, 0) if item in other.counts else other.floor)
+            for item in items
+        }
+        self.counts, self.errors = counts, errors
+        self.floor = self.floor + other.floor
+        return self._truncate()
+
+    @classmethod
+    def merge_documents(cls, documents, capacity=SPACE_SAVING_CAPACITY):
+        """
+        Merge the stored documents of several summaries in one step.
+
+        Args:
+            documents : Summaries as written by to_document.
+
+        Returns:
+            SpaceSaving: The summary of the union of their streams.
+        """
+        sizes = [len(document['items']) for document in documents]
+        floors = np.array([document['floor'] for document in documents], dtype='int64')
+        items = np.fromiter((item for document in documents for item in document['items']), 'int64', sum(sizes))
+        counts = np.fromiter((count for document in documents for count in document['counts']), 'int64', sum(sizes))
+        errors = np.fromiter((error for document in documents for error in document['errors']), 'int64', sum(sizes))
+        # What a tracked item adds over the floor of its summary, counted for every item
+        item_floors = np.repeat(floors, sizes)
+        unique_items, positions = np.unique(items, return_inverse=True)
+        floor = int(floors.sum())
+        merged_counts = np.full(len(unique_items), floor, dtype='int64')
+        merged_errors = np.full(len(unique_items), floor, dtype='int64')
+        np.add.at(merged_counts, positions, counts - item_floors)
+        np.add.at(merged_errors, positions, errors - item_floors)
+        summary = cls(capacity, dict(zip(unique_items.tolist(), merged_counts.tolist())),
+                      dict(zip(unique_items.tolist(), merged_errors.tolist())), floor)
+        return summary._truncate()
+
+    def top(self, k=1):
+        """
+        Return the k items with the largest estimated counts as (item, count, error) tuples.
+        """
+        ranked = sorted(self.counts, key=lambda item: (-self.counts[item], item))[:k]
+        return [(item, self.counts[item], self.errors.get(item, 0)) for item in ranked]
+
+    def to_document(self):
+        items = sorted(self.counts)
+        return {'items': items, 'counts': [self.counts[item] for item in items],
+                'errors': [self.errors.get(item, 0) for item in items], 'floor': self.floor}
+
+    @classmethod
+    def from_document(cls, document, capacity=SPACE_SAVING_CAPACITY):
+        return cls(capacity, dict(zip(document['items'], document['counts'])),
+                   dict(zip(document['items'], document['errors'])), document['floor'])
+
+class CountMinSketch:
+    """
+    Mergeable table of approximate counts.
+
+    The estimated count of an item is never below its true count and, with
+    probability 1 - exp(-depth), exceeds it by at most e / width of the total
+    count added.
+    """
+
+    def __init__(self, width=COUNT_MIN_WIDTH, depth=COUNT_MIN_DEPTH, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype='int64') if table is None else table
+
+    def _columns(self, items):
+        return [(hash64(items, seed=row) % np.uint64(self.width)).astype('int64') for row in range(self.depth)]
+
+    def add(self, items, counts):
+        counts = np.asarray(counts, dtype='int64')
+        for row, columns in enumerate(self._columns(items)):
+            np.add.at(self.table[row], columns, counts)
+        return self
+
+    def merge(self, other):
+        self.table += other.table
+        return self
+
+    def estimate(self, items):
+        columns = self._columns(items)
+        return np.min([self.table[row][row_columns] for row, row_columns in enumerate(columns)], axis=0)
+
+    def to_bytes(self):
+        return self.table.astype('int64').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, width=COUNT_MIN_WIDTH):
+        table = np.frombuffer(data, dtype='int64').reshape(-1, width).copy()
+        return cls(width, table.shape[0], table)
+
+def store_day_sketch_documents(sales_df):
+    """
+    Build the sketch document of each store and day of a set of line items.
+
+    Args:
+        sales_df : Line items with the fields of SKETCH_FIELDS.
+
+    Returns:
+        list: One document per store and day with its exact totals, the
+        HyperLogLog sketches of its receipts and loyalty customers, and the
+        Space-Saving and Count-Min summaries of the quantity sold per product.
+    """
+    documents = []
+    for (store_id, date), rows in sales_df.groupby(['sales_outlet_id', 'transaction_date'], sort=True):
+        customers = rows['customer_id'].dropna()
+        product_quantities = rows.groupby('product_id')['quantity'].sum()
+        items = product_quantities.index.to_numpy(dtype='int64')
+        quantities = product_quantities.fillna(0).to_numpy(dtype='int64')
+        documents.append({
+            '_id': {'sales_outlet_id': int(store_id), 'transaction_date': date.to_pydatetime()},
+            'sales_outlet_id': int(store_id),
+            'transaction_date': date.to_pydatetime(),
+            'line_items': len(rows),
+            'quantity': int(rows['quantity'].sum()),
+            'amount': float(rows['line_item_amount'].sum()),
+            # Receipts are told apart by transaction_id alone, as in the exact receipt totals
+            'receipts': HyperLogLog().add(rows['transaction_id'].dropna().to_numpy()).to_bytes(),
+            # Purchases without a loyalty customer are recorded with customer_id 0
+            'customers': HyperLogLog().add(customers[customers != 0].to_numpy()).to_bytes(),
+            'products': SpaceSaving.from_counts(items, quantities).to_document(),
+            'product_quantities': CountMinSketch().add(items, quantities).to_bytes(),
+        })
+    return documents
+
+def refresh_store_day_sketches(db, sales_collection_name, dates=None):
+    """
+    Rebuild the sketches of the given dates from their line items.
+
+    Args:
+        db : MongoDB database instance.
+        sales_collection_name : Name of the sales line item collection.
+        dates : Dates to rebuild, every date of the sales history when None.
+
+    Returns:
+        int: Number of store and day sketches written.
+    """
+    sales = db[sales_collection_name]
+    sketches = db[SKETCH_STORE_DAY]
+    if dates is None:
+        sketches.delete_many({})
+        dates = sorted(sales.distinct('transaction_date'))
+    written = 0
+    for start in range(0, len(dates), SKETCH_DATES_PER_BATCH):
+        batch = list(dates[start:start + SKETCH_DATES_PER_BATCH])
+        sketches.delete_many({'transaction_date': {'$in': batch}})
+        documents = store_day_sketch_documents(
+            fetch_columns(sales, SKETCH_FIELDS, {'transaction_date': {'$in': batch}}))
+        if documents:
+            sketches.insert_many(documents, ordered=False)
+            written += len(documents)
+    sketches.create_index([('sales_outlet_id', 1), ('transaction_date', 1)])
+    sketches.create_index([('transaction_date', 1)])
+    return written
+
+def merge_sketch_documents(document, other):
+    """
+    Merge two sketch documents of the same store and day into the first one.
+    """
+    for total in ('line_items', 'quantity', 'amount'):
+        document[total] += other[total]
+    for field in ('receipts', 'customers'):
+        document[field] = HyperLogLog.from_bytes(document[field]).merge(
+            HyperLogLog.from_bytes(other[field])).to_bytes()
+    document['products'] = SpaceSaving.from_document(document['products']).merge(
+        SpaceSaving.from_document(other['products'])).to_document()
+    document['product_quantities'] = CountMinSketch.from_bytes(document['product_quantities']).merge(
+        CountMinSketch.from_bytes(other['product_quantities'])).to_bytes()
+    return document
+
+def add_to_store_day_sketches(db, sales_df):
+    """
+    Merge the sketches of new line items into the sketches of their store and day.
+
+    Only the store and day sketches of the new line items are read and
+    rewritten, none of the line items already stored. A sketch is only
+    replaced if its revision is still the one that was read, so a write by
+    another process in between is merged again instead of being lost.
+
+    Args:
+        db : MongoDB database instance.
+        sales_df : New line items with the fields of SKETCH_FIELDS.
+
+    Returns:
+        int: Number of store and day sketches written.
+    """
+    sketches = db[SKETCH_STORE_DAY]
+    documents = store_day_sketch_documents(sales_df)
+    for document in documents:
+        for _ in range(SKETCH_WRITE_ATTEMPTS):
+            if _write_sketch(sketches, document):
+                break
+        else:
+            raise RuntimeError(f"The sketch of {document['_id']} kept changing while it was being updated")
+    return len(documents)
+
+def _write_sketch(sketches, document):
+    # Insert the sketch, or merge it into the stored one when that is still at the revision read
+    current = sketches.find_one({'_id': document['_id']})
+    if current is None:
+        try:
+            sketches.insert_one(dict(document, revision=1))
+            return True
+        except DuplicateKeyError:
+            return False
+    revision = current.get('revision')
+    merged = merge_sketch_documents(current, document)
+    merged['revision'] = (revision or 0) + 1
+    return sketches.replace_one({'_id': document['_id'], 'revision': revision}, merged).matched_count == 1
+
+def sketch_match(store_ids=None, start=None, end=None):
+    # Filter of the store and day sketches of some stores over [start, end)
+    match = {}
+    if store_ids is not None:
+        match['sales_outlet_id'] = {'$in': list(store_ids)}
+    if start is not None or end is not None:
+        match['transaction_date'] = {
+            **({'$gte': start} if start is not None else {}), **({'$lt': end} if end is not None else {})}
+    return match
+
+def merge_store_day_sketches(db, match=None, by_store=True):
+    """
+    Merge the store and day sketches matching a filter.
+
+    The cost depends on the number of stores and days matched, not on the
+    number of line items behind them.
+
+    Args:
+        db : MongoDB database instance.
+        match : Filter of the sketches, see sketch_match.
+        by_store : Whether to merge the sketches of each store too.
+
+    Returns:
+        dict: Exact line_items, quantity and amount totals, the merged
+        receipts and customers HyperLogLog sketches, and the merged products
+        Space-Saving and product_quantities Count-Min summaries, over all the
+        stores and per store under 'stores'.
+    """
+    documents = list(db[SKETCH_STORE_DAY].find(match or {}, {'_id': 0}))
+    overall = merge_sketch_group(documents)
+    stores = {}
+    if by_store:
+        documents_by_store = {}
+        for document in documents:
+            documents_by_store.setdefault(document['sales_outlet_id'], []).append(document)
+        stores = {store_id: merge_sketch_group(store_documents)
+                  for store_id, store_documents in documents_by_store.items()}
+    overall['stores'] = stores
+    return overall
+
+def merge_sketch_group(documents):
+    """
+    Merge sketch documents at once, with array reductions rather than one merge per document.
+
+    The HyperLogLog registers of all the documents are stacked and reduced
+    with np.maximum.reduce and the Count-Min tables are summed. The
+    Space-Saving summaries are merged in one step: every item gets the sum
+    over the documents of its count, or of the floor of the documents not
+    tracking it, which gives the same bounds as merging them two by two
+    with less truncation on the way.
+
+    Args:
+        documents : Store and day sketch documents.
+
+    Returns:
+        dict: The days, exact totals and merged sketches, as merge_store_day_sketches.
+    """
+    merged = {
+        'days': len(documents),
+        'line_items': sum(document['line_items'] for document in documents),
+        'quantity': sum(document['quantity'] for document in documents),
+        'amount': sum((document['amount'] for document in documents), 0.0),
+    }
+    if not documents:
+        return dict(merged, receipts=HyperLogLog(), customers=HyperLogLog(), products=SpaceSaving(),
+                    product_quantities=CountMinSketch())
+    for field in ('receipts', 'customers'):
+        registers = _stacked(documents, field, 'uint8')
+        merged[field] = HyperLogLog(int(math.log2(registers.shape[1])), np.maximum.reduce(registers, axis=0))
+    tables = _stacked(documents, 'product_quantities', 'int64').sum(axis=0)
+    merged['product_quantities'] = CountMinSketch(table=tables.reshape(-1, COUNT_MIN_WIDTH))
+    merged['products'] = SpaceSaving.merge_documents([document['products'] for document in documents])
+    return merged
+
+def _stacked(documents, field, dtype):
+    # One row per document of the fixed-size array stored as bytes in field
+    data = b''.join(document[field] for document in documents)
+    return np.frombuffer(data, dtype=dtype).reshape(len(documents), -1)
+
+def top_products(merged, k=1):
+    """
+    Return the k products with the largest estimated quantity sold.
+
+    The Space-Saving summary proposes the candidates and both summaries
+    bound their quantity from above, so the smaller of both estimates is
+    kept. The true quantity of each product lies in [quantity - max_error, quantity].
+
+    Returns:
+        list: Dicts with product_id, quantity and max_error.
+    """
+    candidates = merged['products'].top(len(merged['products'].counts))
+    if not candidates:
+        return []
+    items = np.array([item for item, _, _ in candidates], dtype='int64')
+    count_min = merged['product_quantities'].estimate(items)
+    products = []
+    for (item, count, error), count_min_estimate in zip(candidates, count_min):
+        quantity = min(count, int(count_min_estimate))
+        products.append({'product_id': int(item), 'quantity': quantity, 'max_error': max(error - (count - quantity), 0)})
+    products.sort(key=lambda product: (-product['quantity'], product['product_id']))
+    return products[:k]
@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from DB.columnar import fetch_columns
+from DB.compact import COMPACT_SCHEMA, NULLABLE_INTS, compact_column, fits_int_type
+
+# Directory of the on-disk column snapshots written by the ingestion step, at the
+# project root by default so that the ETL flow and the API find the same files
+# whatever directory they are started from
+SNAPSHOT_DIR = os.getenv(
+    'SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'snapshots'),
+)
+
+# Number of generations of a snapshot kept on disk, the current one included.
+# A reader that loaded the previous pointer can still open its files until
+# the next write removes them.
+SNAPSHOT_KEEP_GENERATIONS = int(os.getenv('SNAPSHOT_KEEP_GENERATIONS', '2'))
+
+# Column kind of each schema type, see DB/schema.py
+SCHEMA_KINDS = {'datetime': 'datetime', 'float': 'float', 'decimal': 'float', 'bool': 'bool', 'seconds': 'int'}
+
+def column_kinds(columns, schema=None):
+    """
+    Map the stored columns of a file to the column kinds of DB/columnar.py.
+
+    Columns without a declared type are strings.
+    """
+    kinds = {}
+    for column in columns:
+        spec = (schema or {}).get(column)
+        column_type = spec['type'] if isinstance(spec, dict) else spec
+        if column_type is None:
+            kinds[column] = 'str'
+        elif column_type.startswith('int'):
+            kinds[column] = 'int'
+        else:
+            kinds[column] = SCHEMA_KINDS.get(column_type, 'str')
+    return kinds
+
+def _column_layout(series, kind):
+    # How a column is stored: its values, the codes of its categories or its seconds since midnight
+    compact_type = COMPACT_SCHEMA.get(series.name)
+    if kind == 'str' and compact_type in ('category', 'seconds'):
+        return compact_type
+    return 'values'
+
+def _column_arrays(series, kind, layout='values'):
+    # Fixed-size array of the values of a column, plus a missing-value mask when it has gaps
+    if layout == 'category':
+        # The codes of missing values are -1
+        categorical = compact_column(series, 'category').array
+        return categorical.codes, None, [str(category) for category in categorical.categories]
+    if layout == 'seconds':
+        series = compact_column(series, 'seconds')
+        missing = series.isna().to_numpy()
+        return series.to_numpy(dtype='int32', na_value=0), (missing if missing.any() else None), None
+    return _value_arrays(series, kind) + (None,)
+
+def _value_arrays(series, kind):
+    missing = series.isna().to_numpy()
+    if kind == 'datetime':
+        return series.to_numpy(dtype='datetime64[ns]'), None
+    if kind == 'float':
+        return series.to_numpy(dtype='float64', na_value=np.nan), None
+    if kind == 'int':
+        values = series.to_numpy(dtype='int64', na_value=0)
+        # Ids and counts are stored in their compact integer type when their values fit
+        compact_type = COMPACT_SCHEMA.get(series.name)
+        if compact_type == 'seconds':
+            compact_type = 'int32'
+        if compact_type in NULLABLE_INTS and fits_int_type(values, compact_type):
+            values = values.astype(compact_type)
+    elif kind == 'bool':
+        values = series.to_numpy(dtype='bool', na_value=False)
+    else:
+        values = np.array(series.where(~missing, '').astype(str), dtype=str)
+    return values, (missing if missing.any() else None)
+
+def _column_from_arrays(values, missing, kind, layout='values', categories=None):
+    # Same dtypes as compact_frame applied to fetch_columns: nullable booleans,
+    # nullable integers only for columns with gaps
+    if layout == 'category':
+        return pd.Categorical.from_codes(values, categories=categories)
+    if (kind == 'int' or layout == 'seconds') and missing is not None:
+        return pd.arrays.IntegerArray(values, missing)
+    if kind == 'bool':
+        return pd.arrays.BooleanArray(values, missing if missing is not None else np.zeros(len(values), dtype=bool))
+    if kind == 'str' and layout == 'values':
+        # Python strings cannot live in a mapped file, they are decoded here
+        strings = values.astype(object)
+        if missing is not None:
+            strings[missing] = None
+        return strings
+    return values
+
+def _pointer_path(name, directory):
+    return os.path.join(directory, f'{name}.json')
+
+def load_snapshot_meta(name, directory=SNAPSHOT_DIR):
+    """
+    Return the metadata of the current snapshot of a dataset, or None.
+    """
+    try:
+        with open(_pointer_path(name, directory)) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+def sweep_generations(name, generation, directory=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP_GENERATIONS):
+    """
+    Remove the directories of the generations of a snapshot older than the last keep ones.
+
+    Args:
+        name : Name of the dataset.
+        generation : Current generation of the snapshot.
+        directory : Root directory of the snapshots.
+        keep : Number of generations to keep, the current one included.
+    """
+    for entry in os.listdir(directory):
+        prefix, _, suffix = entry.rpartition('.')
+        if prefix == name and suffix.isdigit() and int(suffix) <= generation - max(keep, 1):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+def write_snapshot(df, name, kinds, version=None, directory=SNAPSHOT_DIR):
+    """
+    Write a DataFrame as one .npy file per column.
+
+    The files are written to a new directory and the <name>.json pointer is
+    then atomically replaced, so readers always see a complete snapshot and
+    keep using the files they already mapped. The previous generation stays
+    on disk for the readers that loaded its pointer before the replace and
+    is removed by the next write, see sweep_generations.
+
+    Args:
+        df : Data to write.
+        name : Name of the dataset, usually its collection name.
+        kinds : Dict mapping each column to write to its kind.
+        version : Data version of the collection the snapshot was taken from.
+        directory : Root directory of the snapshots.
+
+    Returns:
+        dict: Metadata of the written snapshot.
+    """
+    previous = load_snapshot_meta(name, directory)
+    generation = (previous or {}).get('generation', 0) + 1
+    snapshot_dir = f"{name}.{generation}"
+    path = os.path.join(directory, snapshot_dir)
+    os.makedirs(path, exist_ok=True)
+
+    columns = {}
+    for column, kind in kinds.items():
+        layout = _column_layout(df[column], kind)
+        values, missing, categories = _column_arrays(df[column], kind, layout)
+        np.save(os.path.join(path, f'{column}.npy'), values, allow_pickle=False)
+        if missing is not None:
+            np.save(os.path.join(path, f'{column}.missing.npy'), missing, allow_pickle=False)
+        columns[column] = {'kind': kind, 'missing': missing is not None, 'layout': layout}
+        if categories is not None:
+            columns[column]['categories'] = categories
+
+    meta = {
+        'name': name,
+        'directory': snapshot_dir,
+        'generation': generation,
+        'version': version,
+        'rows': len(df),
+        'columns': columns,
+    }
+    pointer = _pointer_path(name, directory)
+    with open(pointer + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file, indent=4)
+    os.replace(pointer + '.tmp', pointer)
+
+    sweep_generations(name, generation, directory)
+    return meta
+
+def read_snapshot(name, columns=None, directory=SNAPSHOT_DIR, meta=None):
+    """
+    Open the current snapshot of a dataset as a DataFrame of memory-mapped columns.
+
+    Numeric, boolean and date columns are read-only views of the mapped
+    files, so no data is parsed or copied and processes reading the same
+    snapshot share one page-cache copy of it. The columns with a compact
+    type are stored and returned in it, see DB/compact.py.
+
+    Args:
+        name : Name of the dataset.
+        columns : Columns to open. Defaults to all of them.
+        directory : Root directory of the snapshots.
+        meta : Snapshot metadata, when already loaded.
+
+    Returns:
+        pd.DataFrame: The snapshot, or None when there is none or it lacks a column.
+    """
+    meta = meta or load_snapshot_meta(name, directory)
+    if meta is None:
+        return None
+    columns = list(columns or meta['columns'])
+    if not set(columns) <= set(meta['columns']):
+        return None
+
+    path = os.path.join(directory, meta['directory'])
+    data = {}
+    for column in columns:
+        info = meta['columns'][column]
+        values = np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r', allow_pickle=False)
+        missing = None
+        if info['missing']:
+            missing = np.load(os.path.join(path, f'{column}.missing.npy'), mmap_mode='r', allow_pickle=False)
+        data[column] = _column_from_arrays(values, missing, info['kind'], info.get('layout', 'values'),
+                                           info.get('categories'))
+    return pd.DataFrame(data, copy=False)
+
+def export_snapshot(collection, kinds, version=None, directory=SNAPSHOT_DIR):
+    """
+    Write the snapshot of a collection from its stored documents.
+
+    Args:
+        collection : MongoDB collection instance.
+        kinds : Dict mapping each field to snapshot to its kind.
+        version : Data version of the collection.
+        directory : Root directory of the snapshots.
+
+    Returns:
+        dict: Metadata of the written snapshot.
+    """
+    df = fetch_columns(collection, kinds)
+    return write_snapshot(df, collection.name, kinds, version, directory)
@@ -1,11 +1,35 @@
+import io
 import os
 import json
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
+from pymongo import ReplaceOne
 import os, sys
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
 sys.path.append(project_root)
-from DB.connect_db import get_mongo_connection
+from DB.connect_db import get_database
+from DB.manifest import load_manifest, plan_ingestion, record_ingestion, bump_data_version, load_data_versions
+from DB.schema import apply_schema, to_records
+from DB.indexes import ensure_indexes
+from DB.snapshots import column_kinds, load_snapshot_meta, export_snapshot
+from DB.live_ingest import SOURCE_FIELD, LIVE_SOURCE
+
+# Number of CSV rows read, converted and written per batch
+DEFAULT_CHUNK_SIZE = 10000
+
+# Number of parser processes and writer threads used by the parallel mode
+DEFAULT_WORKERS = 1
+
+# Field whose values are recorded as touched dates for the incremental rollups
+DATE_FIELD = 'transaction_date'
+
+# Documents stored from the files, as opposed to the line items posted to the API
+FILE_ROWS = {SOURCE_FIELD: {'$ne': LIVE_SOURCE}}
 
 def load_config(config_path):
     """
@@ -28,46 +52,324 @@ def remove_columns(df, columns_to_exclude):
     """
     return df.drop(columns=columns_to_exclude, errors='ignore')
 
-def process_and_store_csv(data_path, columns_to_drop, db, collection_name):
+def read_csv_chunks(data_path, columns_to_drop, chunk_size=DEFAULT_CHUNK_SIZE, offset=0):
+    """
+    Read a CSV file as a stream of fixed-size DataFrame chunks.
+
+    Args:
+        data_path : Path to the CSV file.
+        columns_to_drop : List of columns that are never parsed.
+        chunk_size : Number of rows per chunk. A falsy value reads the whole file as one chunk.
+        offset : Byte offset of the first row to read. The header line is always used for column names.
+
+    Yields:
+        pd.DataFrame: The next chunk of rows.
+    """
+    usecols = lambda column: column not in columns_to_drop
+    with open(data_path, 'rb') as file:
+        options = {'usecols': usecols}
+        if offset:
+            options['names'] = pd.read_csv(io.BytesIO(file.readline()), nrows=0).columns
+            options['header'] = None
+            file.seek(offset)
+        if not chunk_size:
+            yield pd.read_csv(file, **options)
+            return
+        with pd.read_csv(file, chunksize=chunk_size, **options) as reader:
+            for chunk in reader:
+                yield chunk
+
+def collect_dates(records, touched_dates):
+    """
+    Add the distinct DATE_FIELD values of a batch of records to touched_dates.
+    """
+    touched_dates.update(record[DATE_FIELD] for record in records if record.get(DATE_FIELD) is not None)
+
+def write_records(collection, records, key_fields=None):
+    """
+    Write a batch of records with a single unordered bulk operation.
+
+    Records are upserted on their natural key when key_fields is given and
+    inserted otherwise.
+    """
+    if key_fields:
+        operations = [
+            ReplaceOne({field: record[field] for field in key_fields}, record, upsert=True)
+            for record in records
+        ]
+        collection.bulk_write(operations, ordered=False)
+    else:
+        collection.insert_many(records, ordered=False)
+
+def prepare_collection(collection, key_fields=None, replace=False, touched_dates=None):
+    """
+    Get a collection ready to receive the rows of a file.
+
+    Removes the documents stored from the file when its contents are
+    replaced, keeping the line items posted to the API, and creates the
+    unique index backing the upserts of keyed files. The dates of the
+    removed documents are added to touched_dates, when given, so that the
+    rollups of the dates missing from the new contents are refreshed too.
+    """
+    if replace:
+        if touched_dates is not None:
+            touched_dates.update(date for date in collection.distinct(DATE_FIELD, FILE_ROWS) if date is not None)
+        collection.delete_many(FILE_ROWS)
+    if key_fields:
+        collection.create_index([(field, 1) for field in key_fields], unique=True)
+
+def report_throughput(data_path, rows, elapsed):
+    rate = rows / elapsed if elapsed else 0
+    print(f"Data from {data_path} has been successfully stored into MongoDB "
+          f"({rows} rows in {elapsed:.2f}s, {rate:,.0f} rows/sec).")
+
+def process_and_store_csv(data_path, columns_to_drop, db, collection_name, chunk_size=DEFAULT_CHUNK_SIZE,
+                          key_fields=None, offset=0, replace=False, schema=None, touched_dates=None):
     """
-    Load a CSV file, remove specified columns, and store the result in MongoDB.
+    Stream a CSV file in chunks, remove specified columns, and store the result in MongoDB.
+
+    Only one chunk is held in memory at a time, so peak memory depends on
+    chunk_size rather than on the size of the file.
 
     Args:
     data_path : Path to the CSV file.
     columns_to_drop : List of columns to remove.
     db : MongoDB client instance.
     collection_name : Name of the MongoDB collection to store data.
+    chunk_size : Number of rows read and inserted per batch.
+    key_fields : Natural key of the rows. When given, rows are upserted on it.
+    offset : Byte offset to start reading from, used to load only appended rows.
+    replace : Remove the existing documents of the collection before storing.
+    schema : Column types the rows are converted to before they are stored.
+    touched_dates : Optional set that receives the dates of the stored rows.
+
+    Returns:
+        int: Number of rows stored, or None if the file could not be stored.
     """
-    df = pd.read_csv(data_path)
-    modified_df = remove_columns(df, columns_to_drop)
     collection = db[collection_name]
+    rows = 0
+    start = time.perf_counter()
     try:
-        collection.insert_many(modified_df.to_dict('records'))
-        print(f"Data from {data_path} has been successfully stored into MongoDB.")
+        prepare_collection(collection, key_fields, replace, touched_dates)
+        for chunk in read_csv_chunks(data_path, columns_to_drop, chunk_size, offset):
+            records = to_records(apply_schema(chunk, schema))
+            if records:
+                write_records(collection, records, key_fields)
+                rows += len(records)
+                if touched_dates is not None:
+                    collect_dates(records, touched_dates)
+        report_throughput(data_path, rows, time.perf_counter() - start)
+        return rows
     except Exception as e:
         print(f"An error occurred while inserting data from {data_path}: {e}")
+        return None
 
-def store_data_to_mongodb(config_path):
+def parse_csv_to_queue(job, batches):
+    """
+    Parse a CSV file in a worker process and put its record batches on a queue.
+
+    The file is finished by a (path, None) sentinel, or by (path, exception)
+    if parsing failed.
+    """
+    data_path = job['path']
+    try:
+        for chunk in read_csv_chunks(data_path, job['columns_to_drop'], job['chunk_size'], job['offset']):
+            records = to_records(apply_schema(chunk, job['schema']))
+            if records:
+                batches.put((data_path, records))
+    except Exception as e:
+        batches.put((data_path, e))
+    batches.put((data_path, None))
+
+def store_csv_files_parallel(jobs, db, workers):
+    """
+    Parse CSV files in a process pool and write their batches from a thread pool.
+
+    Parsing is CPU-bound and runs in `workers` processes. The parsed batches
+    are handed to `workers` writer threads sharing the client behind db, so
+    inserts for one file overlap with parsing of the next. The queue between
+    both sides is bounded, which keeps memory flat when Mongo is the bottleneck.
+
+    Args:
+        jobs : Files to store, as dicts with path, columns_to_drop, chunk_size,
+            offset, collection_name, key_fields, replace, schema and the
+            touched_dates set that receives the dates of the stored rows.
+        db : MongoDB database instance.
+        workers : Number of parser processes and writer threads.
+
+    Returns:
+        dict: Number of rows stored per file path, or None for files that failed.
+    """
+    jobs_by_path = {job['path']: job for job in jobs}
+    # A file is timed from its first batch taken off the queue to its last write, not
+    # from the start of the run, so that files queued behind others are not charged the wait
+    stats = {path: {'rows': 0, 'start': None, 'end': None, 'error': None} for path in jobs_by_path}
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    start = time.perf_counter()
+
+    def write_batch(data_path, records):
+        job = jobs_by_path[data_path]
+        try:
+            write_records(db[job['collection_name']], records, job['key_fields'])
+            with lock:
+                collect_dates(records, job['touched_dates'])
+                stats[data_path]['rows'] += len(records)
+                stats[data_path]['end'] = time.perf_counter()
+        except Exception as e:
+            with lock:
+                stats[data_path]['error'] = e
+        finally:
+            in_flight.release()
+
+    for job in jobs:
+        prepare_collection(db[job['collection_name']], job['key_fields'], job['replace'], job['touched_dates'])
+
+    with multiprocessing.Manager() as manager:
+        batches = manager.Queue(maxsize=workers * 2)
+        with ProcessPoolExecutor(max_workers=workers) as parsers, \
+                ThreadPoolExecutor(max_workers=workers) as writers:
+            parse_futures = [parsers.submit(parse_csv_to_queue, job, batches) for job in jobs]
+            finished = set()
+            while len(finished) < len(jobs):
+                try:
+                    data_path, payload = batches.get(timeout=1)
+                except queue.Empty:
+                    # A parser process that died never sends its sentinel
+                    if all(future.done() for future in parse_futures) and batches.empty():
+                        for future in parse_futures:
+                            if future.exception() is not None:
+                                print(f"A parser process failed: {future.exception()}")
+                        break
+                    continue
+                if payload is None:
+                    finished.add(data_path)
+                elif isinstance(payload, Exception):
+                    stats[data_path]['error'] = payload
+                else:
+                    if stats[data_path]['start'] is None:
+                        stats[data_path]['start'] = time.perf_counter()
+                    in_flight.acquire()
+                    writers.submit(write_batch, data_path, payload)
+
+    total_rows = 0
+    results = {}
+    for data_path, file_stats in stats.items():
+        if data_path not in finished and file_stats['error'] is None:
+            file_stats['error'] = 'parsing did not complete'
+        if file_stats['error'] is not None:
+            print(f"An error occurred while inserting data from {data_path}: {file_stats['error']}")
+            results[data_path] = None
+            continue
+        file_start = file_stats['start'] or time.perf_counter()
+        end = file_stats['end'] or file_start
+        report_throughput(data_path, file_stats['rows'], end - file_start)
+        total_rows += file_stats['rows']
+        results[data_path] = file_stats['rows']
+    elapsed = time.perf_counter() - start
+    rate = total_rows / elapsed if elapsed else 0
+    print(f"Stored {total_rows} rows from {len(jobs)} files with {workers} workers "
+          f"in {elapsed:.2f}s ({rate:,.0f} rows/sec).")
+    return results
+
+def refresh_snapshots(db, data_files):
+    """
+    Rewrite the column snapshot of every collection whose data version changed.
+
+    Args:
+        db : MongoDB database instance.
+        data_files : File entries of the configuration.
+    """
+    versions = load_data_versions(db)
+    for file_config in data_files:
+        data_path = file_config['path']
+        if not os.path.exists(data_path):
+            continue
+        collection_name = os.path.basename(data_path).split('.')[0].replace(' ', '_')
+        meta = load_snapshot_meta(collection_name)
+        if meta is not None and meta['version'] == versions.get(collection_name):
+            continue
+        try:
+            start = time.perf_counter()
+            header = pd.read_csv(data_path, nrows=0).columns
+            columns = [column for column in header if column not in file_config['columns_to_drop']]
+            meta = export_snapshot(db[collection_name], column_kinds(columns, file_config.get('schema')),
+                                   versions.get(collection_name))
+            print(f"Snapshot of {collection_name} written ({meta['rows']} rows in "
+                  f"{time.perf_counter() - start:.2f}s).")
+        except Exception as e:
+            print(f"Could not write the snapshot of {collection_name}: {e}")
+
+def store_data_to_mongodb(config_path, workers=None):
     """
     Modify, save, and store CSV data into MongoDB.
+
+    Files whose fingerprint matches the ingestion manifest are skipped, files
+    that were appended to only load their new rows, and rows of files with a
+    declared 'key' are upserted so that reruns never duplicate data.
+
+    With more than one worker (argument or 'workers' in the configuration)
+    the files are parsed and written in parallel. The 'indexes' declared for
+    each file are created on its collection on every run.
     """
     try:
         # Load configuration
         config = load_config(config_path)
         data_files = config['data_files']
+        default_chunk_size = config.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        workers = workers or config.get('workers', DEFAULT_WORKERS)
 
         # Connect to MongoDB
-        client, db, sales_collection = get_mongo_connection()
+        db = get_database()
+        manifest = load_manifest(db, [file_config['path'] for file_config in data_files])
 
-        # Process and store data
+        # Work out which files have to be stored
+        jobs = []
         for file_config in data_files:
             data_path = file_config['path']
-            columns_to_drop = file_config['columns_to_drop']
-            if os.path.exists(data_path):
-                collection_name = os.path.basename(data_path).split('.')[0].replace(' ', '_')
-                process_and_store_csv(data_path, columns_to_drop, db, collection_name)
-            else:
+            if not os.path.exists(data_path):
                 print(f"File {data_path} does not exist and was skipped.")
+                continue
+            collection_name = os.path.basename(data_path).split('.')[0].replace(' ', '_')
+            ensure_indexes(db[collection_name], file_config.get('indexes'))
+            plan = plan_ingestion(manifest.get(data_path), data_path, file_config)
+            if plan['action'] == 'skip':
+                if not plan['unchanged']:
+                    record_ingestion(db, data_path, plan['fingerprint'])
+                print(f"File {data_path} is unchanged and was skipped.")
+                continue
+            jobs.append({
+                'path': data_path,
+                'columns_to_drop': file_config['columns_to_drop'],
+                'chunk_size': file_config.get('chunk_size', default_chunk_size),
+                'collection_name': collection_name,
+                'key_fields': file_config.get('key'),
+                'schema': file_config.get('schema'),
+                'offset': plan['offset'],
+                'replace': plan['replace'],
+                'fingerprint': plan['fingerprint'],
+                'touched_dates': set(),
+            })
+
+        # Process and store data
+        if workers > 1 and jobs:
+            results = store_csv_files_parallel(jobs, db, workers)
+        else:
+            results = {
+                job['path']: process_and_store_csv(job['path'], job['columns_to_drop'], db, job['collection_name'],
+                                                   job['chunk_size'], job['key_fields'], job['offset'], job['replace'],
+                                                   job['schema'], job['touched_dates'])
+                for job in jobs
+            }
+
+        for job in jobs:
+            if results[job['path']] is not None:
+                record_ingestion(db, job['path'], job['fingerprint'], results[job['path']])
+            # Even a failed file may have written part of its rows
+            bump_data_version(db, job['collection_name'], job['touched_dates'])
+
+        # Memory-mapped column snapshots read by the API and the ETL flow
+        refresh_snapshots(db, data_files)
 
         print("All data has been successfully stored into MongoDB.")
     except Exception as e:
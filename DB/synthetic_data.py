@@ -0,0 +1,258 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Seed files of the generator, in the data directory
+RECEIPTS_FILE = '201904 sales reciepts.csv'
+CUSTOMER_FILE = 'customer.csv'
+PRODUCT_FILE = 'product.csv'
+SALES_OUTLET_FILE = 'sales_outlet.csv'
+SALES_TARGETS_FILE = 'sales targets.csv'
+PASTRY_INVENTORY_FILE = 'pastry inventory.csv'
+COPIED_FILES = [PRODUCT_FILE, 'generations.csv']
+
+# Fields identifying one receipt of the sales receipts
+RECEIPT_KEY = ['sales_outlet_id', 'transaction_date', 'transaction_id']
+
+# Number of stores whose receipts are generated and written together
+STORE_BLOCK = 50
+
+def _seed_receipts(receipts):
+    # Receipts of the seed as contiguous line item ranges, grouped by store and weekday
+    receipts = receipts.sort_values(RECEIPT_KEY + ['transaction_time', 'line_item_id'], kind='stable')
+    receipts = receipts.reset_index(drop=True)
+    starts = np.flatnonzero(~receipts.duplicated(subset=RECEIPT_KEY).to_numpy())
+    lengths = np.diff(np.append(starts, len(receipts)))
+    heads = receipts.iloc[starts]
+    days = {}
+    for (store_id, date), positions in heads.groupby(['sales_outlet_id', 'transaction_date']).indices.items():
+        weekday = pd.Timestamp(date).dayofweek
+        days.setdefault((store_id, weekday), []).append(positions)
+    return receipts, starts, lengths, days
+
+def _template_stores(outlets, receipts, stores):
+    # Ids of the generated stores and the seed store each one copies
+    seed_stores = sorted(receipts['sales_outlet_id'].unique())
+    next_id = int(outlets['sales_outlet_id'].max()) + 1
+    store_ids, templates = [], []
+    for i in range(stores):
+        template = seed_stores[i % len(seed_stores)]
+        if i < len(seed_stores):
+            store_ids.append(int(template))
+        else:
+            store_ids.append(next_id)
+            next_id += 1
+        templates.append(int(template))
+    return store_ids, templates
+
+def _generate_outlets(outlets, store_ids, templates):
+    new = [(store_id, template) for store_id, template in zip(store_ids, templates) if store_id != template]
+    if not new:
+        return outlets
+    rows = outlets.set_index('sales_outlet_id').loc[[template for _, template in new]].reset_index()
+    rows['sales_outlet_id'] = [store_id for store_id, _ in new]
+    rows['store_address'] = [f'{store_id} Synthetic Street' for store_id, _ in new]
+    return pd.concat([outlets, rows], ignore_index=True)
+
+def _generate_customers(customers, store_ids, templates):
+    # Each new store gets a copy of the customers of its template store
+    frames = [customers]
+    customer_maps = {}
+    next_id = int(customers['customer_id'].max()) + 1
+    for store_id, template in zip(store_ids, templates):
+        template_customers = customers['customer_id'][customers['home_store'] == template].to_numpy()
+        if store_id == template:
+            customer_maps[store_id] = (template_customers, template_customers)
+            continue
+        new_ids = np.arange(next_id, next_id + len(template_customers))
+        next_id += len(template_customers)
+        rows = customers[customers['home_store'] == template].copy()
+        rows['customer_id'] = new_ids
+        rows['home_store'] = store_id
+        frames.append(rows)
+        customer_maps[store_id] = (template_customers, new_ids)
+    return pd.concat(frames, ignore_index=True), customer_maps
+
+def _map_customers(customer_ids, customer_map):
+    # Replace the template store's customers by their copies. Guests (0) and
+    # the few seed ids missing from the customer file become guests.
+    template_ids, new_ids = customer_map
+    order = np.argsort(template_ids)
+    positions = np.searchsorted(template_ids[order], customer_ids)
+    positions = np.minimum(positions, len(template_ids) - 1)
+    known = template_ids[order][positions] == customer_ids
+    return np.where(known, new_ids[order][positions], 0)
+
+def _month_starts(start_month, months):
+    return pd.date_range(pd.Timestamp(start_month), periods=months, freq='MS')
+
+def _generate_receipts(seed, store_ids, templates, customer_maps, days, rng):
+    # Line items of one block of stores over the given days
+    receipts, starts, lengths, seed_days = seed
+    chosen, dates, stores = [], [], []
+    for store_id, template in zip(store_ids, templates):
+        for day in days:
+            candidates = seed_days.get((template, day.dayofweek))
+            if not candidates:
+                continue
+            day_receipts = candidates[rng.integers(len(candidates))]
+            # Resample the receipts of a seed day of the same weekday, with a Poisson receipt count
+            count = rng.poisson(len(day_receipts))
+            chosen.append(rng.choice(day_receipts, size=count))
+            dates.append(np.full(count, day.to_datetime64()))
+            stores.append(np.full(count, store_id))
+    if not chosen:
+        return receipts.iloc[:0]
+    chosen, dates, stores = np.concatenate(chosen), np.concatenate(dates), np.concatenate(stores)
+
+    counts = lengths[chosen]
+    line_starts = np.repeat(starts[chosen], counts)
+    receipt_of_line = np.repeat(np.arange(len(chosen)), counts)
+    line_positions = line_starts + np.arange(len(line_starts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    lines = receipts.iloc[line_positions].reset_index(drop=True)
+
+    lines['transaction_date'] = pd.to_datetime(dates[receipt_of_line]).strftime('%Y-%m-%d')
+    lines['sales_outlet_id'] = stores[receipt_of_line]
+    # Number the receipts of each store and day in order of their time
+    heads = pd.DataFrame({
+        'sales_outlet_id': stores, 'transaction_date': dates,
+        'transaction_time': receipts['transaction_time'].to_numpy()[starts[chosen]],
+    })
+    heads = heads.sort_values(['sales_outlet_id', 'transaction_date', 'transaction_time'], kind='stable')
+    transaction_ids = np.empty(len(heads), dtype='int64')
+    transaction_ids[heads.index.to_numpy()] = heads.groupby(['sales_outlet_id', 'transaction_date']).cumcount().to_numpy() + 1
+    lines['transaction_id'] = transaction_ids[receipt_of_line]
+
+    customer_ids = lines['customer_id'].to_numpy().copy()
+    line_stores = lines['sales_outlet_id'].to_numpy()
+    for store_id in store_ids:
+        in_store = line_stores == store_id
+        customer_ids[in_store] = _map_customers(customer_ids[in_store], customer_maps[store_id])
+    lines['customer_id'] = customer_ids
+    return lines.sort_values(['transaction_date', 'sales_outlet_id', 'transaction_time'], kind='stable')
+
+def _generate_targets(targets, store_ids, templates, month_starts):
+    template_targets = targets.set_index('sales_outlet_id')
+    rows = []
+    for store_id, template in zip(store_ids, templates):
+        if template not in template_targets.index:
+            continue
+        for month_start in month_starts:
+            row = template_targets.loc[template].to_dict()
+            row.update(sales_outlet_id=store_id, year_month=month_start.strftime('%b-%y'))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=targets.columns)
+
+def _generate_pastry_inventory(inventory, store_ids, templates, month_starts):
+    # The pastry counts of the template store, shifted to each generated month
+    inventory = inventory.assign(transaction_date=pd.to_datetime(inventory['transaction_date'], format='%m/%d/%Y'))
+    seed_month = inventory['transaction_date'].min().to_period('M').to_timestamp()
+    frames = []
+    for store_id, template in zip(store_ids, templates):
+        rows = inventory[inventory['sales_outlet_id'] == template]
+        for month_start in month_starts:
+            months = (month_start.year - seed_month.year) * 12 + month_start.month - seed_month.month
+            shifted = rows['transaction_date'] + pd.DateOffset(months=months)
+            in_month = shifted.dt.to_period('M') == month_start.to_period('M')
+            frame = rows[in_month.to_numpy()].copy()
+            frame['transaction_date'] = [f'{date.month}/{date.day}/{date.year}' for date in shifted[in_month]]
+            frame['sales_outlet_id'] = store_id
+            frames.append(frame.drop_duplicates(subset=['transaction_date', 'product_id']))
+    return pd.concat(frames, ignore_index=True) if frames else inventory.iloc[:0]
+
+def write_config(output_dir, config_path='data_files_config.json'):
+    """
+    Write a copy of the ingestion configuration that reads the generated files.
+
+    Returns:
+        str: Path of the written configuration.
+    """
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    for file_config in config['data_files']:
+        file_config['path'] = os.path.join(output_dir, os.path.basename(file_config['path']))
+    path = os.path.join(output_dir, 'data_files_config.json')
+    with open(path, 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+    return path
+
+def generate_dataset(output_dir, stores=3, months=1, seed_dir='data', start_month='2019-04-01', random_seed=0):
+    """
+    Generate a synthetic POS dataset for stores x months from the seed CSV files.
+
+    Every store copies one of the seed stores that have sales (cycling
+    through them) with its own customers, and every day of the generated
+    months resamples the receipts of a seed day of the same weekday at that
+    store, so the receipt counts, basket sizes, product mix, time of day and
+    guest/loyal split follow the seed. Product, customer and sales outlet ids
+    of the generated rows all exist in the generated dimension files.
+
+    Args:
+        output_dir : Directory the CSV files and their ingestion configuration are written to.
+        stores : Number of stores with sales.
+        months : Number of consecutive months of sales.
+        seed_dir : Directory of the seed CSV files.
+        start_month : First generated month.
+        random_seed : Seed of the random generator, the same arguments give the same files.
+
+    Returns:
+        dict: Row counts of the written files and the path of their configuration.
+    """
+    rng = np.random.default_rng(random_seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    receipts = pd.read_csv(os.path.join(seed_dir, RECEIPTS_FILE), dtype={'line_item_amount': str, 'unit_price': str})
+    customers = pd.read_csv(os.path.join(seed_dir, CUSTOMER_FILE), dtype={'loyalty_card_number': str})
+    outlets = pd.read_csv(os.path.join(seed_dir, SALES_OUTLET_FILE))
+    targets = pd.read_csv(os.path.join(seed_dir, SALES_TARGETS_FILE))
+    inventory = pd.read_csv(os.path.join(seed_dir, PASTRY_INVENTORY_FILE))
+
+    store_ids, templates = _template_stores(outlets, receipts, stores)
+    month_starts = _month_starts(start_month, months)
+    outlets = _generate_outlets(outlets, store_ids, templates)
+    customers, customer_maps = _generate_customers(customers, store_ids, templates)
+
+    counts = {}
+    for file_name, frame in [
+        (SALES_OUTLET_FILE, outlets),
+        (CUSTOMER_FILE, customers),
+        (SALES_TARGETS_FILE, _generate_targets(targets, store_ids, templates, month_starts)),
+        (PASTRY_INVENTORY_FILE, _generate_pastry_inventory(inventory, store_ids, templates, month_starts)),
+    ]:
+        frame.to_csv(os.path.join(output_dir, file_name), index=False)
+        counts[file_name] = len(frame)
+    for file_name in COPIED_FILES:
+        frame = pd.read_csv(os.path.join(seed_dir, file_name), dtype=str, keep_default_na=False)
+        frame.to_csv(os.path.join(output_dir, file_name), index=False)
+        counts[file_name] = len(frame)
+
+    # The receipts are generated and appended month by month and block by block of stores
+    seed = _seed_receipts(receipts)
+    receipts_path = os.path.join(output_dir, RECEIPTS_FILE)
+    counts[RECEIPTS_FILE] = 0
+    header = True
+    for month_start in month_starts:
+        days = pd.date_range(month_start, month_start + pd.offsets.MonthEnd(0), freq='D')
+        for block in range(0, len(store_ids), STORE_BLOCK):
+            lines = _generate_receipts(seed, store_ids[block:block + STORE_BLOCK],
+                                       templates[block:block + STORE_BLOCK], customer_maps, days, rng)
+            lines.to_csv(receipts_path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            counts[RECEIPTS_FILE] += len(lines)
+
+    counts['config'] = write_config(output_dir)
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic POS dataset from the seed CSV files.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--stores', type=int, default=3)
+    parser.add_argument('--months', type=int, default=1)
+    parser.add_argument('--seed-dir', default='data')
+    parser.add_argument('--start-month', default='2019-04-01')
+    parser.add_argument('--random-seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate_dataset(args.output_dir, args.stores, args.months, args.seed_dir, args.start_month,
+                           args.random_seed))
@@ -0,0 +1,50 @@
+import pandas as pd
+from DB.compact import FOOTPRINTS, compact_frame, seconds_since_midnight
+
+def fetched_sales():
+    # Line items as fetched from MongoDB: int64 ids, Y/N strings and HH:MM:SS times
+    return pd.DataFrame({
+        '_id': ['a', 'b', 'c'],
+        'transaction_id': [1, 2, 70000],
+        'sales_outlet_id': [3, 5, 8],
+        'customer_id': [12.0, None, 40.0],
+        'instore_yn': ['Y', 'N', 'y '],
+        'promo_item_yn': ['N', None, 'Y'],
+        'transaction_time': ['07:05:10', '15:12:45', '23:59:59'],
+        'transaction_date': ['2019-04-01', '2019-04-02', '2019-04-30'],
+        'store_city': ['Astoria', 'Astoria', 'Hell\'s Kitchen'],
+        'line_item_amount': [3.5, 2.0, 9.75],
+    })
+
+def test_columns_take_their_compact_types():
+    df = compact_frame(fetched_sales())
+    assert '_id' not in df.columns
+    assert df['transaction_id'].dtype == 'int32'
+    assert df['sales_outlet_id'].dtype == 'int16'
+    assert str(df['customer_id'].dtype) == 'Int32'
+    assert df['instore_yn'].tolist() == [True, False, True] and df['instore_yn'].dtype == bool
+    assert str(df['promo_item_yn'].dtype) == 'boolean'
+    assert df['transaction_time'].tolist() == [25510, 54765, 86399]
+    assert pd.api.types.is_datetime64_dtype(df['transaction_date'])
+    assert isinstance(df['store_city'].dtype, pd.CategoricalDtype)
+    assert df['line_item_amount'].dtype == 'float64'
+
+def test_values_out_of_range_keep_the_wider_type():
+    df = compact_frame(pd.DataFrame({'sales_outlet_id': [1, 40000]}))
+    assert df['sales_outlet_id'].dtype == 'int64'
+
+def test_footprint_is_recorded_under_the_name():
+    before = fetched_sales()
+    compact_frame(before.copy(), name='sales')
+    assert FOOTPRINTS['sales']['rows'] == 3
+    assert FOOTPRINTS['sales']['bytes_after'] < FOOTPRINTS['sales']['bytes_before']
+
+def test_seconds_since_midnight():
+    assert seconds_since_midnight(pd.Series(['00:00:00', '01:02:03'])).tolist() == [0, 3723]
+    assert seconds_since_midnight(pd.Series([90, 3600])).tolist() == [90, 3600]
+    seconds = seconds_since_midnight(pd.Series(['01:00:00', 'late']))
+    assert seconds.iloc[0] == 3600 and pd.isna(seconds.iloc[1])
+
+def test_seconds_since_midnight_takes_mixed_values():
+    seconds = seconds_since_midnight(pd.Series(['01:00:00', 90, 'late']))
+    assert seconds.tolist()[:2] == [3600, 90] and pd.isna(seconds.iloc[2])
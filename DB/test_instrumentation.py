@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from DB.instrumentation import SERVICE_ERRORS, instrumented
+
+def errors(service, status):
+    return SERVICE_ERRORS.labels(service, status)._value.get()
+
+@instrumented
+def lookup_store(store_id):
+    if store_id < 0:
+        raise HTTPException(status_code=404, detail="Store not found")
+    return [10, 20][store_id]
+
+@instrumented
+async def lookup_store_async(store_id):
+    return lookup_store.__wrapped__(store_id)
+
+@pytest.mark.parametrize('call', [lookup_store, lambda store_id: asyncio.run(lookup_store_async(store_id))])
+def test_errors_are_counted_under_their_status(call):
+    service = 'lookup_store' if call is lookup_store else 'lookup_store_async'
+    not_found, failed = errors(service, '404'), errors(service, '500')
+
+    with pytest.raises(HTTPException) as error:
+        call(-1)
+    assert error.value.status_code == 404
+    with pytest.raises(HTTPException) as error:
+        call(3)
+    assert error.value.status_code == 500 and isinstance(error.value.__cause__, IndexError)
+
+    assert (errors(service, '404'), errors(service, '500')) == (not_found + 1, failed + 1)
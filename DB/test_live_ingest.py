@@ -0,0 +1,97 @@
+import os
+import pandas as pd
+import pytest
+from DB.live_ingest import sales_file_config, prepare_line_items, ingest_line_items
+from DB.schema import apply_schema, to_records
+from DB.store_to_db import prepare_collection
+from DB.rollups import ROLLUP_STORE_DAY_HOUR, ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_HOUR_WEEKDAY, ROLLUP_STORE_MONTH
+from DB.sketches import SKETCH_STORE_DAY
+
+mongomock = pytest.importorskip('mongomock')
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'data_files_config.json')
+SALES_COLLECTION = '201904_sales_reciepts'
+
+def line_item(transaction_id, line_item_id, store_id, date, time, product_id, quantity, unit_price):
+    return {
+        'transaction_id': transaction_id, 'transaction_date': date, 'transaction_time': time,
+        'sales_outlet_id': store_id, 'staff_id': 12, 'customer_id': 5000 + transaction_id, 'instore_yn': 'Y',
+        'order': 1, 'line_item_id': line_item_id, 'product_id': product_id, 'quantity': quantity,
+        'line_item_amount': quantity * unit_price, 'unit_price': unit_price, 'promo_item_yn': 'N',
+    }
+
+LINE_ITEMS = [
+    line_item(1, 1, 3, '2019-04-01', '07:05:10', 27, 2, 3.5),
+    line_item(1, 2, 3, '2019-04-01', '07:05:10', 40, 1, 2.0),
+    line_item(2, 1, 3, '2019-04-01', '07:40:00', 27, 1, 3.5),
+    line_item(3, 1, 3, '2019-04-01', '15:12:45', 87, 3, 3.0),
+    line_item(3, 1, 5, '2019-04-02', '09:00:00', 27, 1, 3.5),
+    line_item(4, 1, 5, '2019-04-30', '18:30:00', 40, 2, 2.0),
+]
+
+@pytest.fixture
+def db():
+    database = mongomock.MongoClient()['test']
+    _, key_fields = sales_file_config(CONFIG_PATH, SALES_COLLECTION)
+    database[SALES_COLLECTION].create_index([(field, 1) for field in key_fields], unique=True)
+    return database
+
+def documents(db, collection_name):
+    return sorted(db[collection_name].find({}, {'_id': 0}), key=repr)
+
+def aggregates(db):
+    collections = (ROLLUP_STORE_DAY_HOUR, ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_HOUR_WEEKDAY, ROLLUP_STORE_MONTH,
+                   SKETCH_STORE_DAY)
+    return {collection_name: list(db[collection_name].find()) for collection_name in collections}
+
+def test_rollups_match_pandas(db):
+    schema, _ = sales_file_config(CONFIG_PATH, SALES_COLLECTION)
+    df = prepare_line_items(LINE_ITEMS, schema)
+    result = ingest_line_items(db, SALES_COLLECTION, df)
+    assert (result['received'], result['inserted'], result['duplicates']) == (6, 6, 0)
+
+    df['hour'] = df['transaction_time'] // 3600
+    expected = df.groupby(['sales_outlet_id', 'transaction_date', 'hour']).agg(
+        quantity=('quantity', 'sum'), amount=('line_item_amount', 'sum'),
+        line_items=('line_item_id', 'size'), receipts=('transaction_id', 'nunique'))
+    rollup = pd.DataFrame(
+        dict(document['_id'], **{measure: document[measure] for measure in expected.columns})
+        for document in db[ROLLUP_STORE_DAY_HOUR].find()
+    ).set_index(expected.index.names).sort_index()
+    pd.testing.assert_frame_equal(rollup, expected, check_dtype=False, check_index_type=False)
+
+    months = df.groupby('sales_outlet_id')['quantity'].sum()
+    assert {document['_id']['sales_outlet_id']: document['quantity']
+            for document in db[ROLLUP_STORE_MONTH].find()} == months.to_dict()
+
+def test_reposting_a_receipt_is_idempotent(db):
+    schema, _ = sales_file_config(CONFIG_PATH, SALES_COLLECTION)
+    ingest_line_items(db, SALES_COLLECTION, prepare_line_items(LINE_ITEMS, schema))
+    stored = documents(db, SALES_COLLECTION)
+    before = aggregates(db)
+
+    result = ingest_line_items(db, SALES_COLLECTION, prepare_line_items(LINE_ITEMS[:3], schema))
+    assert (result['inserted'], result['duplicates']) == (0, 3)
+    assert documents(db, SALES_COLLECTION) == stored
+    assert aggregates(db) == before
+
+def test_new_line_of_a_stored_receipt_counts_the_receipt_once(db):
+    schema, _ = sales_file_config(CONFIG_PATH, SALES_COLLECTION)
+    ingest_line_items(db, SALES_COLLECTION, prepare_line_items(LINE_ITEMS[:1], schema))
+    result = ingest_line_items(db, SALES_COLLECTION, prepare_line_items(LINE_ITEMS[:2], schema))
+    assert (result['inserted'], result['duplicates']) == (1, 1)
+
+    day_hour = db[ROLLUP_STORE_DAY_HOUR].find_one()
+    assert (day_hour['line_items'], day_hour['receipts'], day_hour['quantity']) == (2, 1, 3)
+    assert {document['_id']['product_id']: document['receipts']
+            for document in db[ROLLUP_STORE_DAY_PRODUCT].find()} == {27: 1, 40: 1}
+
+def test_full_reload_of_the_sales_file_keeps_the_posted_line_items(db):
+    schema, key_fields = sales_file_config(CONFIG_PATH, SALES_COLLECTION)
+    ingest_line_items(db, SALES_COLLECTION, prepare_line_items(LINE_ITEMS[:2], schema))
+    db[SALES_COLLECTION].insert_many(to_records(apply_schema(pd.DataFrame(LINE_ITEMS[4:]), schema)))
+
+    touched_dates = set()
+    prepare_collection(db[SALES_COLLECTION], key_fields, replace=True, touched_dates=touched_dates)
+    assert sorted(document['transaction_id'] for document in db[SALES_COLLECTION].find()) == [1, 1]
+    assert sorted(touched_dates) == list(pd.to_datetime(['2019-04-02', '2019-04-30']))
@@ -0,0 +1,77 @@
+import os
+import pytest
+from DB.manifest import plan_ingestion
+from DB.store_to_db import process_and_store_csv
+
+mongomock = pytest.importorskip('mongomock')
+
+FILE_CONFIG = {'path': 'sales.csv', 'columns_to_drop': [], 'key': ['transaction_id', 'line_item_id']}
+HEADER = 'transaction_id,line_item_id,quantity\n'
+
+def write_csv(path, rows, mode='w'):
+    with open(path, mode) as file:
+        if mode == 'w':
+            file.write(HEADER)
+        file.writelines(f'{transaction_id},{line_item_id},{quantity}\n'
+                        for transaction_id, line_item_id, quantity in rows)
+
+def ingested(path, config=FILE_CONFIG):
+    # Manifest entry of a file after it was stored as it is now
+    return plan_ingestion(None, path, config)['fingerprint']
+
+def test_new_file_is_loaded_in_full(tmp_path):
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2)])
+    plan = plan_ingestion(None, path, FILE_CONFIG)
+    assert (plan['action'], plan['offset']) == ('full', 0)
+
+def test_unchanged_file_is_skipped(tmp_path):
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2)])
+    entry = ingested(path)
+    plan = plan_ingestion(entry, path, FILE_CONFIG)
+    assert (plan['action'], plan['unchanged']) == ('skip', True)
+
+    # Same content, newer mtime: hashed, then skipped
+    os.utime(path, ns=(entry['mtime_ns'] + 10 ** 9, entry['mtime_ns'] + 10 ** 9))
+    plan = plan_ingestion(entry, path, FILE_CONFIG)
+    assert (plan['action'], plan['unchanged']) == ('skip', False)
+
+def test_appended_rows_are_read_from_the_previous_size(tmp_path):
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2), (1, 2, 1)])
+    entry = ingested(path)
+    write_csv(path, [(2, 1, 5)], mode='a')
+    plan = plan_ingestion(entry, path, FILE_CONFIG)
+    assert (plan['action'], plan['offset']) == ('append', entry['size'])
+
+def test_rewritten_file_is_reloaded_in_full(tmp_path):
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2), (1, 2, 1)])
+    entry = ingested(path)
+    write_csv(path, [(1, 1, 3), (1, 2, 1), (2, 1, 5)])
+    assert plan_ingestion(entry, path, FILE_CONFIG)['action'] == 'full'
+
+def test_changed_config_reloads_in_full(tmp_path):
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2)])
+    entry = ingested(path)
+    plan = plan_ingestion(entry, path, dict(FILE_CONFIG, columns_to_drop=['quantity']))
+    assert (plan['action'], plan['replace']) == ('full', True)
+
+def test_keyed_rows_are_upserted_and_appends_only_read_new_rows(tmp_path):
+    db = mongomock.MongoClient()['test']
+    path = tmp_path / 'sales.csv'
+    write_csv(path, [(1, 1, 2), (1, 2, 1)])
+    key_fields = FILE_CONFIG['key']
+    assert process_and_store_csv(str(path), [], db, 'sales', key_fields=key_fields) == 2
+    # A rerun upserts on the key instead of duplicating the rows
+    assert process_and_store_csv(str(path), [], db, 'sales', key_fields=key_fields) == 2
+    assert db['sales'].count_documents({}) == 2
+
+    entry = ingested(path)
+    write_csv(path, [(2, 1, 5)], mode='a')
+    plan = plan_ingestion(entry, path, FILE_CONFIG)
+    assert process_and_store_csv(str(path), [], db, 'sales', key_fields=key_fields, offset=plan['offset']) == 1
+    assert sorted((document['transaction_id'], document['line_item_id'], document['quantity'])
+                  for document in db['sales'].find()) == [(1, 1, 2), (1, 2, 1), (2, 1, 5)]
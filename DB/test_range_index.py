@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from DB.range_index import GRANULARITY_FREQ, MAX_BUCKETS, SalesRangeIndex, bucket_count
+
+def synthetic_sales(rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'sales_outlet_id': rng.integers(1, 4, rows),
+        'transaction_date': pd.Timestamp('2019-04-01') + pd.to_timedelta(rng.integers(0, 30, rows), unit='D'),
+        'transaction_time': rng.integers(6 * 3600, 21 * 3600, rows).astype('int32'),
+        'transaction_id': rng.integers(0, 800, rows),
+        'quantity': rng.integers(1, 4, rows),
+        'line_item_amount': rng.integers(1, 2000, rows) / 100,
+    })
+
+def timestamps(sales_df):
+    return sales_df['transaction_date'] + pd.to_timedelta(sales_df['transaction_time'], unit='s')
+
+def test_daily_buckets_match_pandas_groupby():
+    sales_df = synthetic_sales()
+    index = SalesRangeIndex(sales_df)
+    for store_id in (None, 2):
+        rows = sales_df if store_id is None else sales_df[sales_df['sales_outlet_id'] == store_id]
+        expected = rows.groupby(rows['transaction_date'])
+        buckets = index.buckets('2019-04-01', '2019-05-01', 'day', store_id)
+        assert [bucket['start'] for bucket in buckets] == list(pd.date_range('2019-04-01', periods=30, freq='D'))
+        assert [bucket['line_items'] for bucket in buckets] == expected.size().tolist()
+        assert [bucket['quantity'] for bucket in buckets] == expected['quantity'].sum().tolist()
+        assert np.allclose([bucket['sales'] for bucket in buckets], expected['line_item_amount'].sum())
+
+def test_range_totals_match_pandas():
+    sales_df = synthetic_sales()
+    index = SalesRangeIndex(sales_df)
+    times = timestamps(sales_df)
+    starts = pd.to_datetime(['2019-04-03 07:30', '2019-04-10 00:00', '2019-04-28 20:15'])
+    ends = pd.to_datetime(['2019-04-03 12:00', '2019-04-17 00:00', '2019-05-02 00:00'])
+    totals = index.range_totals(starts, ends, store_id=3)
+    for position, (start, end) in enumerate(zip(starts, ends)):
+        rows = sales_df[(times >= start) & (times < end) & (sales_df['sales_outlet_id'] == 3)]
+        assert totals['line_items'][position] == len(rows)
+        assert totals['quantity'][position] == rows['quantity'].sum()
+        assert np.isclose(totals['sales'][position], rows['line_item_amount'].sum())
+
+def test_receipts_counted_once():
+    sales_df = synthetic_sales()
+    totals = SalesRangeIndex(sales_df).totals('2019-04-01', '2019-05-01')
+    assert totals['receipts'] == len(sales_df.drop_duplicates(['sales_outlet_id', 'transaction_date', 'transaction_id']))
+
+@pytest.mark.parametrize('granularity', list(GRANULARITY_FREQ))
+@pytest.mark.parametrize('start, end', [('2019-04-01', '2019-05-01'), ('2019-04-01 13:30', '2019-04-03 02:00'),
+                                        ('2019-01-31', '2020-03-01 10:00')])
+def test_bucket_count_bounds_the_buckets(start, end, granularity):
+    index = SalesRangeIndex(synthetic_sales(rows=100))
+    assert len(index.buckets(start, end, granularity)) <= bucket_count(start, end, granularity)
+
+def test_too_many_buckets_are_refused():
+    index = SalesRangeIndex(synthetic_sales(rows=100))
+    with pytest.raises(ValueError):
+        index.buckets('2019-01-01', pd.Timestamp('2019-01-01') + pd.Timedelta(hours=MAX_BUCKETS + 1), 'hour')
@@ -0,0 +1,45 @@
+import pandas as pd
+from bson.decimal128 import Decimal128
+from DB.schema import apply_schema, to_records
+
+SCHEMA = {
+    'transaction_date': {'type': 'datetime', 'format': '%Y-%m-%d'},
+    'sales_outlet_id': 'int16',
+    'instore_yn': 'bool',
+    'unit_price': 'float',
+    'retail_price': 'decimal',
+}
+
+def raw_rows():
+    return pd.DataFrame({
+        'transaction_date': ['2019-04-01', '2019-04-31', '2019-04-02'],
+        'sales_outlet_id': ['3', '5', 'x'],
+        'instore_yn': ['Y', ' n', ''],
+        'unit_price': ['$3.00', '2.5', None],
+        'retail_price': ['$18.00 ', '1,200.50', 'n/a'],
+        'product': ['Latte', 'Scone', 'Tea'],
+    })
+
+def test_columns_are_converted_to_their_declared_types():
+    df = apply_schema(raw_rows(), SCHEMA)
+    assert str(df['sales_outlet_id'].dtype) == 'Int16'
+    assert str(df['instore_yn'].dtype) == 'boolean'
+    assert df['unit_price'].dtype == 'float64'
+    assert pd.api.types.is_datetime64_dtype(df['transaction_date'])
+    # Undeclared columns are left as they are
+    assert df['product'].tolist() == ['Latte', 'Scone', 'Tea']
+
+def test_unparseable_values_become_missing():
+    df = apply_schema(raw_rows(), SCHEMA)
+    assert df['transaction_date'].isna().tolist() == [False, True, False]
+    assert df['sales_outlet_id'].isna().tolist() == [False, False, True]
+    assert df['instore_yn'].tolist()[:2] == [True, False] and df['instore_yn'].isna().tolist()[2]
+    assert df['unit_price'].tolist()[:2] == [3.0, 2.5]
+    assert df['retail_price'].tolist() == [Decimal128('18.00'), Decimal128('1200.50'), None]
+
+def test_missing_values_are_stored_as_null():
+    records = to_records(apply_schema(raw_rows(), SCHEMA))
+    assert records[1]['transaction_date'] is None
+    assert records[2]['sales_outlet_id'] is None
+    assert records[2]['instore_yn'] is None
+    assert records[0]['transaction_date'] == pd.Timestamp('2019-04-01')
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+from DB.sketches import (HyperLogLog, SpaceSaving, CountMinSketch, store_day_sketch_documents, merge_sketch_group,
+                         top_products)
+
+def synthetic_sales(rows=20000, stores=3, days=10, products=60, seed=0):
+    # Line items with a skewed product mix, so that the Space-Saving summaries truncate
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'sales_outlet_id': rng.integers(1, stores + 1, rows),
+        'transaction_date': pd.Timestamp('2019-04-01') + pd.to_timedelta(rng.integers(0, days, rows), unit='D'),
+        'transaction_id': rng.integers(0, rows // 2, rows),
+        'customer_id': rng.integers(0, 3000, rows),
+        'product_id': np.minimum(rng.zipf(1.5, rows), products),
+        'quantity': rng.integers(1, 4, rows),
+        'line_item_amount': rng.random(rows) * 10,
+    })
+
+def test_hyperloglog_error_within_bounds():
+    rng = np.random.default_rng(1)
+    for distinct in (100, 5000, 200000):
+        values = rng.permutation(np.arange(distinct) * 7919)
+        sketch = HyperLogLog().add(np.concatenate([values, values[:distinct // 2]]))
+        # Four standard errors
+        assert abs(sketch.count() - distinct) <= 4 * sketch.relative_error * distinct
+
+def test_hyperloglog_merge_counts_the_union():
+    left = HyperLogLog().add(np.arange(0, 30000))
+    right = HyperLogLog().add(np.arange(20000, 50000))
+    union = HyperLogLog().add(np.arange(0, 50000))
+    assert np.array_equal(left.merge(right).registers, union.registers)
+
+def assert_space_saving_bounds(summary, exact):
+    for item, count in summary.counts.items():
+        assert count - summary.errors.get(item, 0) <= exact.get(item, 0) <= count
+    for item, count in exact.items():
+        if item not in summary.counts:
+            assert count <= summary.floor
+
+def test_space_saving_bounds_hold_after_merge():
+    sales_df = synthetic_sales()
+    documents = store_day_sketch_documents(sales_df)
+    exact = sales_df.groupby('product_id')['quantity'].sum().to_dict()
+    assert any(document['products']['floor'] > 0 for document in documents)
+
+    pairwise = SpaceSaving()
+    for document in documents:
+        pairwise.merge(SpaceSaving.from_document(document['products']))
+    assert_space_saving_bounds(pairwise, exact)
+    assert_space_saving_bounds(SpaceSaving.merge_documents([document['products'] for document in documents]), exact)
+
+def test_merged_group_matches_pandas():
+    sales_df = synthetic_sales()
+    merged = merge_sketch_group(store_day_sketch_documents(sales_df))
+
+    assert merged['days'] == sales_df.groupby(['sales_outlet_id', 'transaction_date']).ngroups
+    assert merged['line_items'] == len(sales_df)
+    assert merged['quantity'] == sales_df['quantity'].sum()
+    assert np.isclose(merged['amount'], sales_df['line_item_amount'].sum())
+    assert np.array_equal(merged['receipts'].registers, HyperLogLog().add(sales_df['transaction_id']).registers)
+
+    exact = sales_df.groupby('product_id')['quantity'].sum()
+    items = exact.index.to_numpy(dtype='int64')
+    table = CountMinSketch().add(items, exact.to_numpy())
+    assert np.array_equal(merged['product_quantities'].table, table.table)
+    for product in top_products(merged, k=3):
+        true_quantity = exact[product['product_id']]
+        assert product['quantity'] - product['max_error'] <= true_quantity <= product['quantity']
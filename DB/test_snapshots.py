@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pandas as pd
+from DB.snapshots import load_snapshot_meta, read_snapshot, write_snapshot
+
+KINDS = {'sales_outlet_id': 'int', 'transaction_date': 'datetime', 'line_item_amount': 'float',
+         'instore_yn': 'bool', 'customer_id': 'int', 'product': 'str'}
+
+def sales(amount=1.0):
+    return pd.DataFrame({
+        'sales_outlet_id': [3, 5, 8],
+        'transaction_date': pd.to_datetime(['2019-04-01', '2019-04-02', '2019-04-02']),
+        'line_item_amount': [amount, 2.5, 3.0],
+        'instore_yn': [True, False, True],
+        'customer_id': pd.array([12, None, 40], dtype='Int32'),
+        'product': ['Latte', None, 'Tea'],
+    })
+
+def test_snapshot_round_trip(tmp_path):
+    write_snapshot(sales(), 'sales', KINDS, version=4, directory=tmp_path)
+    snapshot = read_snapshot('sales', directory=tmp_path)
+    assert load_snapshot_meta('sales', tmp_path)['version'] == 4
+    assert snapshot['sales_outlet_id'].tolist() == [3, 5, 8]
+    assert snapshot['transaction_date'].tolist() == sales()['transaction_date'].tolist()
+    assert snapshot['line_item_amount'].tolist() == [1.0, 2.5, 3.0]
+    assert snapshot['instore_yn'].tolist() == [True, False, True]
+    assert snapshot['customer_id'].isna().tolist() == [False, True, False]
+    assert snapshot['product'].tolist() == ['Latte', None, 'Tea']
+    # Numeric columns are views of the mapped files
+    assert isinstance(np.asarray(snapshot['line_item_amount']).base, np.memmap)
+
+def test_missing_columns_are_not_served(tmp_path):
+    assert read_snapshot('sales', directory=tmp_path) is None
+    write_snapshot(sales(), 'sales', KINDS, directory=tmp_path)
+    assert read_snapshot('sales', ['sales_outlet_id', 'quantity'], directory=tmp_path) is None
+
+def test_writes_swap_generations_and_keep_the_previous_one(tmp_path):
+    first = write_snapshot(sales(1.0), 'sales', KINDS, version=1, directory=tmp_path)
+    second = write_snapshot(sales(2.0), 'sales', KINDS, version=2, directory=tmp_path)
+    assert (first['generation'], second['generation']) == (1, 2)
+    assert read_snapshot('sales', directory=tmp_path)['line_item_amount'].iloc[0] == 2.0
+    # A reader that loaded the previous pointer can still open its files
+    assert read_snapshot('sales', directory=tmp_path, meta=first)['line_item_amount'].iloc[0] == 1.0
+
+    write_snapshot(sales(3.0), 'sales', KINDS, version=3, directory=tmp_path)
+    assert sorted(entry for entry in os.listdir(tmp_path) if not entry.endswith('.json')) == ['sales.2', 'sales.3']
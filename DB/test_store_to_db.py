@@ -0,0 +1,45 @@
+import pytest
+from DB.store_to_db import process_and_store_csv, store_csv_files_parallel
+
+mongomock = pytest.importorskip('mongomock')
+
+def write_csv(path, rows):
+    with open(path, 'w') as file:
+        file.write('transaction_id,line_item_id,quantity,note\n')
+        file.writelines(f'{transaction_id},{line_item_id},{transaction_id % 4},x\n'
+                        for transaction_id, line_item_id in rows)
+
+def stored(db, collection_name):
+    return sorted((document['transaction_id'], document['line_item_id'], document['quantity'])
+                  for document in db[collection_name].find())
+
+def job(path, collection_name):
+    return {
+        'path': str(path), 'columns_to_drop': ['note'], 'chunk_size': 7, 'offset': 0,
+        'collection_name': collection_name, 'key_fields': ['transaction_id', 'line_item_id'],
+        'replace': False, 'schema': None, 'touched_dates': set(),
+    }
+
+def test_parallel_mode_stores_the_same_rows_as_the_sequential_one(tmp_path):
+    paths = {'first': tmp_path / 'first.csv', 'second': tmp_path / 'second.csv'}
+    write_csv(paths['first'], [(transaction_id, 1) for transaction_id in range(50)])
+    write_csv(paths['second'], [(transaction_id, line_item_id) for transaction_id in range(20)
+                                for line_item_id in (1, 2)])
+    sequential, parallel = mongomock.MongoClient()['sequential'], mongomock.MongoClient()['parallel']
+
+    for name, path in paths.items():
+        process_and_store_csv(str(path), ['note'], sequential, name, chunk_size=7,
+                              key_fields=['transaction_id', 'line_item_id'])
+    results = store_csv_files_parallel([job(path, name) for name, path in paths.items()], parallel, workers=2)
+
+    assert results == {str(paths['first']): 50, str(paths['second']): 40}
+    for name in paths:
+        assert stored(parallel, name) == stored(sequential, name)
+        assert 'note' not in parallel[name].find_one()
+
+def test_parallel_mode_reports_a_file_that_fails_to_parse(tmp_path):
+    good, missing = tmp_path / 'good.csv', tmp_path / 'missing.csv'
+    write_csv(good, [(1, 1), (2, 1)])
+    db = mongomock.MongoClient()['test']
+    results = store_csv_files_parallel([job(good, 'good'), job(missing, 'missing')], db, workers=2)
+    assert results == {str(good): 2, str(missing): None}
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from DB.compact import seconds_since_midnight
+
+WEEKDAYS = 7
+MINUTES_PER_DAY = 24 * 60
+
+# Measures binned per store, weekday and slot
+MEASURES = ('line_items', 'receipts', 'amount')
+
+def _weekdays(dates):
+    # Weekday of datetime64 dates, Monday=0 like WEEKDAY in DB/rollups.py (1970-01-01 was a Thursday)
+    days = dates.astype('datetime64[D]').astype('int64')
+    return (days + 3) % WEEKDAYS
+
+class TrafficProfile:
+    """
+    Sales of each store binned by weekday x time-of-day slot.
+
+    The line items are counted and their amounts summed into one dense
+    store x weekday x slot array per measure with a single np.bincount, so
+    the peak slot of a store or the full heatmap of every store is read
+    from memory without grouping the line items again. Receipts are counted
+    in the slot of their first line item.
+
+    Args:
+        sales_df : Line items with sales_outlet_id, transaction_date,
+            transaction_time (seconds since midnight or "HH:MM:SS") and
+            line_item_amount, and optionally transaction_id. Line items
+            without a date or time of day are left out.
+        slot_minutes : Width of the time-of-day slots, a divisor of a day.
+    """
+
+    def __init__(self, sales_df, slot_minutes=60):
+        if slot_minutes <= 0 or MINUTES_PER_DAY % slot_minutes:
+            raise ValueError(f"slot_minutes must divide {MINUTES_PER_DAY}, got {slot_minutes}")
+        self.slot_minutes = slot_minutes
+        self.slots = MINUTES_PER_DAY // slot_minutes
+
+        seconds = seconds_since_midnight(sales_df['transaction_time']).to_numpy(dtype='int64', na_value=-1)
+        dates = sales_df['transaction_date']
+        known = ((seconds >= 0) & (seconds < MINUTES_PER_DAY * 60) & dates.notna().to_numpy()
+                 & sales_df['sales_outlet_id'].notna().to_numpy())
+
+        store_ids = sales_df['sales_outlet_id'].to_numpy(dtype='int64', na_value=-1)[known]
+        self.stores, store_codes = np.unique(store_ids, return_inverse=True)
+        self._positions = {int(store_id): position for position, store_id in enumerate(self.stores)}
+
+        days = dates.to_numpy(dtype='datetime64[ns]')[known]
+        slot_seconds = slot_minutes * 60
+        slots = seconds[known] // slot_seconds
+        bins = (store_codes * WEEKDAYS + _weekdays(days)) * self.slots + slots
+
+        shape = (len(self.stores), WEEKDAYS, self.slots)
+        size = int(np.prod(shape))
+        amounts = np.nan_to_num(sales_df['line_item_amount'].to_numpy(dtype='float64', na_value=np.nan)[known])
+        self.line_items = np.bincount(bins, minlength=size).reshape(shape)
+        self.amount = np.bincount(bins, weights=amounts, minlength=size).reshape(shape)
+        if 'transaction_id' in sales_df.columns:
+            receipts = pd.DataFrame({
+                'store': store_codes, 'day': days,
+                'transaction_id': sales_df['transaction_id'].to_numpy()[known],
+            })
+            first_lines = ~receipts.duplicated().to_numpy()
+            self.receipts = np.bincount(bins[first_lines], minlength=size).reshape(shape)
+        else:
+            self.receipts = None
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, measure).nbytes for measure in MEASURES if getattr(self, measure) is not None)
+
+    def slot_labels(self):
+        """
+        Return the start of each time-of-day slot, e.g. ['00:00', '00:15', ...].
+        """
+        return [f"{start // 60:02d}:{start % 60:02d}" for start in range(0, MINUTES_PER_DAY, self.slot_minutes)]
+
+    def profile(self, store_id, measure='amount'):
+        """
+        Return the weekday x slot array of a measure for a store, or None
+        when the store has no line items.
+        """
+        position = self._positions.get(store_id)
+        if position is None:
+            return None
+        return getattr(self, measure)[position]
+
+    def peak_slot(self, store_id, measure='amount'):
+        """
+        Return the slot with the highest total of a measure over all
+        weekdays, the earliest one on ties.
+
+        Returns:
+            tuple: Index of the slot and its total, or None when the store has no line items.
+        """
+        profile = self.profile(store_id, measure)
+        if profile is None:
+            return None
+        totals = profile.sum(axis=0)
+        slot = int(np.argmax(totals))
+        return slot, totals[slot].item()
+
+    def heatmap(self, store_ids=None):
+        """
+        Return the weekday x slot arrays of every measure, keyed by store id.
+
+        Args:
+            store_ids : Stores to include, all of them when None.
+        """
+        store_ids = [int(store_id) for store_id in self.stores] if store_ids is None else store_ids
+        return {
+            store_id: {measure: getattr(self, measure)[self._positions[store_id]]
+                       for measure in MEASURES if getattr(self, measure) is not None}
+            for store_id in store_ids if store_id in self._positions
+        }
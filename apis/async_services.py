@@ -0,0 +1,194 @@
+import os
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from fastapi import HTTPException
+from DB.connect_db import get_async_mongo_connection
+from DB.columnar import fetch_columns_async
+from DB.compact import compact_frame
+from DB.dimensions import DimensionTable
+from DB.instrumentation import instrumented, span
+from DB.rollups import ROLLUP_STORE_DAY_HOUR, ROLLUP_STORE_MONTH, ROLLUPS_VERSION_ID
+from services import (
+    AGGREGATION_ENGINE, CACHE_ENABLED, COLUMN_TYPES, SNAPSHOT_FIELDS, PASTRY_INVENTORY_FIELDS, DIMENSIONS,
+    STORE_TOTALS_PIPELINE, frame_cache, use_rollups, select_rows, current_snapshot, store_totals_frame,
+    analyze_city_sales, analyze_tax_status_distribution, analyze_drink_size_distribution, most_sold_products,
+    average_sales_per_transaction_pipeline, average_sales_per_transaction_from_rows,
+    plot_average_sales_per_transaction_by_day_of_month, daily_sales_per_week_pipeline,
+    daily_sales_per_week_from_rows, get_daily_sales_per_week,
+)
+
+# asyncio MongoDB connection setup, used by the async def handlers
+async_client, async_db, async_sales_collection = get_async_mongo_connection()
+
+# Bounded pool running the pandas work of the async handlers off the event
+# loop. Queries are awaited on the loop, so only this work takes a worker.
+CPU_WORKERS = int(os.getenv('API_CPU_WORKERS', '4'))
+cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix='api-cpu')
+
+async def run_cpu(fn, *args):
+    """
+    Run fn(*args) on the bounded worker pool and await its result.
+    """
+    loop = asyncio.get_running_loop()
+    # Copy the context so that spans opened by fn belong to the calling service
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(cpu_pool, partial(context.run, fn, *args))
+
+async def use_rollups_async(engine):
+    """
+    Async counterpart of services.use_rollups, reading the data versions off the event loop.
+    """
+    if (engine or AGGREGATION_ENGINE) != 'rollup':
+        return False
+    return use_rollups(engine, await frame_cache.versions_async())
+
+@span('fetch')
+async def fetch_frame_async(collection_name, fields, query=None):
+    """
+    Async counterpart of services.fetch_frame, sharing its cache entries.
+    """
+    query = query or {}
+    collection = async_db[collection_name]
+    snapshot_fields = SNAPSHOT_FIELDS.get(collection_name)
+    if not CACHE_ENABLED or snapshot_fields is None or not set(fields).union(query) <= set(snapshot_fields):
+        snapshot = await run_cpu(current_snapshot, collection_name, list(set(fields).union(query)))
+        if snapshot is not None:
+            return await run_cpu(lambda: compact_frame(select_rows(snapshot, fields, query)))
+        columns = {field: COLUMN_TYPES[field] for field in fields}
+        return await run_cpu(compact_frame, await fetch_columns_async(collection, columns, query, cpu_pool))
+
+    async def load_snapshot():
+        # The version check and the file mapping stay off the event loop
+        snapshot = await run_cpu(current_snapshot, collection_name, snapshot_fields)
+        if snapshot is None:
+            columns = {field: COLUMN_TYPES[field] for field in snapshot_fields}
+            snapshot = await fetch_columns_async(collection, columns, None, cpu_pool)
+        return await run_cpu(compact_frame, snapshot, collection_name)
+
+    async def load_rows():
+        snapshot = await frame_cache.get_async(collection_name, ('snapshot', collection_name), load_snapshot)
+        return await run_cpu(select_rows, snapshot, fields, query)
+
+    if not query:
+        # Views of the cached snapshot, not cached a second time
+        return await load_rows()
+    key = ('rows', collection_name, tuple(fields), tuple(sorted(query.items())))
+    return await frame_cache.get_async(collection_name, key, load_rows)
+
+@span('fetch')
+async def aggregate_async(collection_name, pipeline, source=None):
+    """
+    Async counterpart of services.aggregate, sharing its cache entries.
+    """
+    async def load():
+        return await async_db[collection_name].aggregate(pipeline).to_list(None)
+
+    if not CACHE_ENABLED:
+        return await load()
+    key = ('aggregate', collection_name, repr(pipeline))
+    return await frame_cache.get_async(source or collection_name, key, load)
+
+async def dimension_table_async(collection_name):
+    """
+    Async counterpart of services.dimension_table, sharing its cache entries.
+    """
+    id_field, fields, flags = DIMENSIONS[collection_name]
+
+    async def build():
+        dimension_df = await fetch_frame_async(collection_name, fields)
+        return await run_cpu(DimensionTable, dimension_df, id_field, flags)
+
+    if not CACHE_ENABLED:
+        return await build()
+    return await frame_cache.get_async(collection_name, ('dimension', collection_name), build)
+
+@instrumented
+async def get_most_sales_city_async(engine: str = None):
+    # Fetch data from MongoDB, one total per store when the rollups are current
+    if await use_rollups_async(engine):
+        sales_rows = aggregate_async(ROLLUP_STORE_MONTH, STORE_TOTALS_PIPELINE, ROLLUPS_VERSION_ID)
+        rows, outlets = await asyncio.gather(sales_rows, dimension_table_async('sales_outlet'))
+        sales_df = store_totals_frame(rows)
+    else:
+        sales_df, outlets = await asyncio.gather(
+            fetch_frame_async(async_sales_collection.name, ['sales_outlet_id', 'line_item_amount']),
+            dimension_table_async('sales_outlet'))
+
+    if sales_df.empty or not len(outlets):
+        raise HTTPException(status_code=404, detail="Required data not found")
+
+    # Analyze city sales
+    most_sales_city = await run_cpu(analyze_city_sales, sales_df, outlets)
+    with span('serialize'):
+        return {"most_sales_city": most_sales_city.to_dict()}
+
+@instrumented
+async def get_tax_status_distribution_async():
+    product_df = await fetch_frame_async('product', ['tax_exempt_yn'])
+
+    if product_df.empty:
+        raise HTTPException(status_code=404, detail="Product data not found")
+
+    tax_status_counts = await run_cpu(analyze_tax_status_distribution, product_df)
+    with span('serialize'):
+        return {"tax_status_distribution": tax_status_counts.to_dict()}
+
+@instrumented
+async def get_drink_size_distribution_async():
+    products, sales_df = await asyncio.gather(
+        dimension_table_async('product'),
+        fetch_frame_async(async_sales_collection.name, ['product_id', 'quantity']))
+
+    if not len(products) or sales_df.empty:
+        raise HTTPException(status_code=404, detail="Required data not found")
+
+    drink_size_distribution = await run_cpu(analyze_drink_size_distribution, products, sales_df)
+    with span('serialize'):
+        return {"drink_size_distribution": drink_size_distribution.to_dict()}
+
+@instrumented
+async def get_most_sold_products_async():
+    pastry_inventory_df, products, sales_df = await asyncio.gather(
+        fetch_frame_async('pastry_inventory', PASTRY_INVENTORY_FIELDS),
+        dimension_table_async('product'),
+        fetch_frame_async(async_sales_collection.name, ['product_id']))
+
+    if pastry_inventory_df.empty or not len(products) or sales_df.empty:
+        raise HTTPException(status_code=404, detail="Required data not found")
+
+    top_5_sold_products = await run_cpu(most_sold_products, pastry_inventory_df, products, sales_df)
+    with span('serialize'):
+        return {"most_sold_products": top_5_sold_products.to_dict(orient="records")}
+
+@instrumented
+async def get_average_sales_per_transaction_async(month: int, engine: str = None):
+    if await use_rollups_async(engine):
+        rows = await aggregate_async(
+            ROLLUP_STORE_DAY_HOUR, average_sales_per_transaction_pipeline(month), ROLLUPS_VERSION_ID)
+        return {"average_sales_per_transaction_by_day_of_month": average_sales_per_transaction_from_rows(rows)}
+
+    sales_df = await fetch_frame_async(async_sales_collection.name, ['transaction_date', 'line_item_amount'])
+
+    if sales_df.empty:
+        raise HTTPException(status_code=404, detail="Sales data not found")
+
+    average_sales = await run_cpu(plot_average_sales_per_transaction_by_day_of_month, sales_df, month)
+    with span('serialize'):
+        return {"average_sales_per_transaction_by_day_of_month": average_sales.to_dict()}
+
+@instrumented
+async def get_daily_sales_per_week_async(month: int, engine: str = None):
+    if await use_rollups_async(engine):
+        rows = await aggregate_async(ROLLUP_STORE_DAY_HOUR, daily_sales_per_week_pipeline(month), ROLLUPS_VERSION_ID)
+        return {"daily_sales_per_week": daily_sales_per_week_from_rows(rows)}
+
+    sales_df = await fetch_frame_async(async_sales_collection.name, ['transaction_date', 'sales_outlet_id'])
+
+    if sales_df.empty:
+        raise HTTPException(status_code=404, detail="Sales data not found")
+
+    daily_sales_per_week = await run_cpu(get_daily_sales_per_week, sales_df, month)
+    with span('serialize'):
+        return {"daily_sales_per_week": daily_sales_per_week.to_dict(orient="records")}
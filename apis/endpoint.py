@@ -1,79 +1,193 @@
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
+from fastapi import Depends, FastAPI, Query, Request, Response
+from pydantic import BaseModel
 from services import *
-
-app = FastAPI()
+from async_services import *
+from DB.connect_db import close_connections
+from DB.instrumentation import HTTP_REQUEST_DURATION, metrics_payload
+from json_responses import RowsQuery, json_response, rows_response
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the MongoDB clients of the process, the motor one included
+    close_connections()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template, not by path, to keep one series per endpoint
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_DURATION.labels(request.method, path, str(status)).observe(time.perf_counter() - start)
 
 @app.get("/daily_sales/{store_id}")
-def daily_sales(store_id: int):
-    return get_daily_sales(store_id)
+def daily_sales(store_id: int, engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    result = get_daily_sales(store_id, engine, rows.limit, rows.after_key)
+    return rows_response(result, "daily_sales", ["transaction_date"], rows)
 
 @app.get("/weekly_sales/{store_id}")
-def weekly_sales(store_id: int):
-    return get_weekly_sales(store_id)
+def weekly_sales(store_id: int, engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    result = get_weekly_sales(store_id, engine, rows.limit, rows.after_key)
+    return rows_response(result, "weekly_sales", ["year", "week"], rows)
 
 @app.get("/monthly_sales/{store_id}")
-def monthly_sales(store_id: int):
-    return  get_monthly_sales(store_id)
+def monthly_sales(store_id: int, engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    result = get_monthly_sales(store_id, engine, rows.limit, rows.after_key)
+    return rows_response(result, "monthly_sales", ["year", "month"], rows)
 
 @app.get("/peak_hours/{store_id}")
-def peak_hours(store_id: int):
-    return get_peak_hours_for_store(store_id)
+def peak_hours(store_id: int, engine: Optional[str] = None):
+    return json_response(get_peak_hours_for_store(store_id, engine))
 
 @app.get("/customer_type/{store_id}")
 def customer_type(store_id: int):
-    return get_sales_by_customer_type(store_id)
+    return json_response(get_sales_by_customer_type(store_id))
 
 @app.get("/most_selling_item/{store_id}")
-def most_selling_item(store_id: int):
-    return get_most_selling_item(store_id)
+def most_selling_item(store_id: int, engine: Optional[str] = None):
+    return json_response(get_most_selling_item(store_id, engine))
+
+# Several stores at once: store_ids is 'all' or ids separated by commas, e.g. ?store_ids=3,5,8
+@app.get("/daily_sales")
+def daily_sales_for_stores(store_ids: str = "all", engine: Optional[str] = None):
+    return json_response(get_daily_sales_for_stores(store_ids, engine))
+
+@app.get("/weekly_sales")
+def weekly_sales_for_stores(store_ids: str = "all", engine: Optional[str] = None):
+    return json_response(get_weekly_sales_for_stores(store_ids, engine))
+
+@app.get("/monthly_sales")
+def monthly_sales_for_stores(store_ids: str = "all", engine: Optional[str] = None):
+    return json_response(get_monthly_sales_for_stores(store_ids, engine))
+
+@app.get("/peak_hours")
+def peak_hours_for_stores(store_ids: str = "all", engine: Optional[str] = None):
+    return json_response(get_peak_hours_for_stores(store_ids, engine))
+
+@app.get("/customer_type")
+def customer_type_for_stores(store_ids: str = "all"):
+    return json_response(get_sales_by_customer_type_for_stores(store_ids))
+
+@app.get("/most_selling_item")
+def most_selling_item_for_stores(store_ids: str = "all", engine: Optional[str] = None):
+    return json_response(get_most_selling_item_for_stores(store_ids, engine))
+
+@app.get("/traffic_heatmap")
+def traffic_heatmap(store_ids: str = "all", slot_minutes: int = 60):
+    return json_response(get_traffic_heatmap(store_ids, slot_minutes))
+
+@app.get("/distinct_counts")
+def distinct_counts(store_ids: str = "all", from_date: Optional[str] = Query(None, alias="from"),
+                    to_date: Optional[str] = Query(None, alias="to")):
+    return json_response(get_distinct_counts(store_ids, from_date, to_date))
 
 @app.get("/sales_comparison")
-def sales_comparison():
-    return get_sales_comparison()
+def sales_comparison(rows: RowsQuery = Depends()):
+    # A store has one row per month of targets, the rows are keyed by their position
+    return rows_response(get_sales_comparison(), "sales_differences", None, rows)
 
 @app.get("/line_item_statistics")
 def line_item_statistics():
-    return get_line_item_statistics()
+    return json_response(get_line_item_statistics())
 
 @app.get("/transaction_distribution")
 def transaction_distribution():
-    return get_transaction_distribution()
+    return json_response(get_transaction_distribution())
 
 @app.get("/generation_counts")
 def generation_counts():
-    return get_generation_counts_endpoint()
+    return json_response(get_generation_counts_endpoint())
 
 @app.get("/daily_receipts/{store_id}")
-def daily_receipts(store_id: int):
-    return get_daily_receipts_for_store(store_id)
+def daily_receipts(store_id: int, engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    result = get_daily_receipts_for_store(store_id, engine, rows.limit, rows.after_key)
+    return rows_response(result, "daily_receipts", ["transaction_date"], rows)
 
 @app.get("/best_performing_store_for_month")
-def best_performing_store_for_month():
-    return get_best_performing_store_for_month()
+def best_performing_store_for_month(engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    return rows_response(get_best_performing_store_for_month(engine), "best_performing_store_for_month", ["month"], rows)
 
 @app.get("/most_sales_city")
-async def most_sales_city_endpoint():
-    return get_most_sales_city()
+async def most_sales_city_endpoint(engine: Optional[str] = None):
+    return json_response(await get_most_sales_city_async(engine))
 
 @app.get("/tax_status_distribution")
 async def tax_status_distribution_endpoint():
-    return get_tax_status_distribution()
+    return json_response(await get_tax_status_distribution_async())
 
 @app.get("/drink_size_distribution")
 async def drink_size_distribution_endpoint():
-    return get_drink_size_distribution()
+    return json_response(await get_drink_size_distribution_async())
 
 @app.get("/most_sold_products")
-async def most_sold_products_endpoint():
-    return get_most_sold_products()
+async def most_sold_products_endpoint(rows: RowsQuery = Depends()):
+    # Ranked by quantity sold, the rows are keyed by their rank
+    return rows_response(await get_most_sold_products_async(), "most_sold_products", None, rows)
 
 @app.get("/average_sales_per_transaction/{month}")
-async def average_sales_per_transaction_endpoint(month: int):
-    return get_average_sales_per_transaction(month)
+async def average_sales_per_transaction_endpoint(month: int, engine: Optional[str] = None):
+    return json_response(await get_average_sales_per_transaction_async(month, engine))
 
 @app.get("/daily_sales_per_week/{month}")
-async def daily_sales_per_week(month: int):
-    return get_daily_sales_per_week_endpoint(month)
+async def daily_sales_per_week(month: int, engine: Optional[str] = None, rows: RowsQuery = Depends()):
+    result = await get_daily_sales_per_week_async(month, engine)
+    return rows_response(result, "daily_sales_per_week", ["day_of_week", "sales_outlet_id"], rows)
+
+@app.get("/sales_range")
+def sales_range(from_date: str = Query(alias="from"), to_date: str = Query(alias="to"),
+                store_id: Optional[int] = None, granularity: Optional[str] = None):
+    return json_response(get_sales_range(from_date, to_date, store_id, granularity))
+
+class LineItem(BaseModel):
+    """
+    Line item of a receipt posted by a till, with the fields of the sales CSV file.
+
+    transaction_date is written as YYYY-MM-DD, transaction_time as HH:MM:SS
+    or seconds since midnight and the flags as Y or N.
+    """
+    transaction_id: int
+    transaction_date: str
+    transaction_time: Union[int, str]
+    sales_outlet_id: int
+    staff_id: Optional[int] = None
+    customer_id: Optional[int] = None
+    instore_yn: Optional[str] = None
+    order: Optional[int] = None
+    line_item_id: int
+    product_id: int
+    quantity: int
+    line_item_amount: float
+    unit_price: Optional[float] = None
+    promo_item_yn: Optional[str] = None
+
+@app.post("/receipts")
+def receipts(line_items: Union[List[LineItem], LineItem]):
+    line_items = line_items if isinstance(line_items, list) else [line_items]
+    return json_response(post_receipts([line_item.dict(exclude_none=True) for line_item in line_items]))
+
+@app.get("/cache_stats")
+def cache_stats():
+    return json_response(get_cache_stats())
+
+@app.get("/pool_stats")
+def pool_stats():
+    return json_response(get_connection_pool_stats())
+
+@app.get("/metrics")
+def metrics():
+    payload, content_type = metrics_payload()
+    return Response(content=payload, media_type=content_type)
 
 if __name__ == "__main__":
     import uvicorn
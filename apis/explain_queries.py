@@ -0,0 +1,24 @@
+from services import API_QUERIES, db
+from DB.indexes import explain_query
+
+def main():
+    """
+    Print the explain plan of every query issued by the API.
+
+    Queries answered by a collection scan are flagged, along with how many
+    documents the server examined for every document it returned.
+    """
+    for query in API_QUERIES:
+        try:
+            summary = explain_query(db, query)
+        except Exception as e:
+            print(f"{query['name']}: could not explain query: {e}")
+            continue
+        flag = "  <-- collection scan" if summary['collection_scan'] else ""
+        print(f"{query['name']} [{query['collection']}]{flag}")
+        print(f"    plan:     {summary['plan']}")
+        print(f"    returned: {summary['returned']}, examined: {summary['examined']}, "
+              f"examined/returned: {summary['ratio']:.2f}")
+
+if __name__ == "__main__":
+    main()
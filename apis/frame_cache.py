@@ -0,0 +1,242 @@
+import time
+import pickle
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import pandas as pd
+from DB.manifest import load_data_versions
+
+def _size_of(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+class FrameCache:
+    """
+    Process-wide LRU cache of collection snapshots and query results.
+
+    Every entry is tagged with the data version of its collection at load
+    time. The versions written by the ingestion step are re-read at most once
+    per version_ttl seconds, and an entry whose collection has a newer version
+    is reloaded on its next access. Concurrent misses on the same key wait
+    for a single load. The total size of the entries is kept under max_bytes
+    by evicting the least recently used ones.
+    """
+
+    def __init__(self, db, max_bytes, version_ttl=1.0):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Version and future of the loads in progress, keyed like the entries
+        self._loading = {}
+        self._versions = {}
+        self._versions_checked = None
+        self._versions_lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _stale_versions(self):
+        return self._versions_checked is None or time.monotonic() - self._versions_checked >= self.version_ttl
+
+    def _refresh_versions(self):
+        # Re-read the data versions when they are older than version_ttl, without
+        # holding the cache lock. One thread reads them at a time, the others
+        # keep using the cached ones, unless none were read yet.
+        if not self._stale_versions():
+            return
+        if not self._versions_lock.acquire(blocking=self._versions_checked is None):
+            return
+        try:
+            if not self._stale_versions():
+                return
+            try:
+                versions = load_data_versions(self.db)
+            except Exception as e:
+                print(f"Could not read data versions, keeping the cached ones: {e}")
+                versions = {}
+            with self._lock:
+                # Versions only grow: keep the ones advanced by this process meanwhile
+                for name, version in self._versions.items():
+                    if version is not None and (versions.get(name) is None or versions[name] < version):
+                        versions[name] = version
+                self._versions = versions
+                self._versions_checked = time.monotonic()
+        finally:
+            self._versions_lock.release()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry['bytes']
+
+    def get(self, collection_name, key, loader):
+        """
+        Return the cached value for key, loading it with loader() on a miss.
+
+        Args:
+            collection_name : Collection the value is derived from.
+            key : Hashable key of the value.
+            loader : Function computing the value from the database.
+
+        Returns:
+            The cached value. DataFrames are returned as shallow copies, so
+            callers can add or replace columns without touching the cache.
+        """
+        hit, value, version, load, leader = self._lookup(collection_name, key)
+        if hit:
+            return value
+        if not leader:
+            return self._copy(load.result())
+        # Load outside the lock so that a slow query does not block cache hits
+        try:
+            value = loader()
+        except BaseException as e:
+            self._abandon(key, load, e)
+            raise
+        return self._store(key, version, value, load)
+
+    async def get_async(self, collection_name, key, loader, executor=None):
+        """
+        Same as get, for a coroutine function loader awaited on a miss.
+
+        The lookup and the store take the cache lock and may re-read the data
+        versions, so they run on executor (the loop's default one when None)
+        rather than on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        hit, value, version, load, leader = await loop.run_in_executor(executor, self._lookup, collection_name, key)
+        if hit:
+            return value
+        if not leader:
+            return self._copy(await asyncio.wrap_future(load))
+        try:
+            value = await loader()
+        except BaseException as e:
+            self._abandon(key, load, e)
+            raise
+        return await loop.run_in_executor(executor, self._store, key, version, value, load)
+
+    def _lookup(self, collection_name, key):
+        # Returns whether key was a hit, its value, the current version and, on
+        # a miss, the future of its load and whether this caller has to load it
+        self._refresh_versions()
+        with self._lock:
+            version = self._versions.get(collection_name)
+            entry = self._entries.get(key)
+            if entry is not None and entry['version'] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._copy(entry['value']), version, None, False
+            if entry is not None:
+                self._remove(key)
+                self.invalidations += 1
+            loading_version, load = self._loading.get(key, (None, None))
+            if load is not None and loading_version == version:
+                self.coalesced += 1
+                return False, None, version, load, False
+            load = Future()
+            self._loading[key] = (version, load)
+            self.misses += 1
+            return False, None, version, load, True
+
+    def _store(self, key, version, value, load=None):
+        size = _size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size <= self.max_bytes:
+                self._entries[key] = {'version': version, 'value': value, 'bytes': size}
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+            if load is not None and self._loading.get(key, (None, None))[1] is load:
+                del self._loading[key]
+        if load is not None:
+            load.set_result(value)
+        return self._copy(value)
+
+    def _abandon(self, key, load, error):
+        # The callers waiting for a failed load get its error
+        with self._lock:
+            if self._loading.get(key, (None, None))[1] is load:
+                del self._loading[key]
+        load.set_exception(error)
+
+    @staticmethod
+    def _copy(value):
+        if isinstance(value, pd.DataFrame):
+            return value.copy(deep=False)
+        return value
+
+    def versions(self):
+        """
+        Return the data versions of all collections, re-read at most once per version_ttl.
+        """
+        self._refresh_versions()
+        with self._lock:
+            return dict(self._versions)
+
+    async def versions_async(self, executor=None):
+        """
+        Same as versions, run on executor rather than on the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(executor, self.versions)
+
+    def advance(self, versions, collection_name=None, updates=None, from_version=None):
+        """
+        Move to data versions written by this process, without waiting for the next re-read.
+
+        Args:
+            versions : New version numbers keyed by collection name.
+            collection_name : Collection whose cached values are updated.
+            updates : Optional dict mapping keys of cached values of
+                collection_name to functions deriving the value of its new
+                version from the cached one, e.g. appending the rows just
+                written. The other entries are reloaded on their next access.
+            from_version : Version of collection_name the updated values
+                were loaded at. Values loaded at another version are dropped.
+        """
+        with self._lock:
+            self._versions.update(versions)
+            pending = {}
+            for key, update in (updates or {}).items():
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._remove(key)
+                    if entry['version'] == from_version:
+                        pending[key] = (entry['value'], update)
+        for key, (value, update) in pending.items():
+            self._store(key, versions.get(collection_name), update(value))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the memory used by the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'data_versions': dict(self._versions),
+            }
@@ -0,0 +1,252 @@
+import heapq
+import base64
+from bisect import bisect_right
+from typing import Optional
+import orjson
+import numpy as np
+import pandas as pd
+from fastapi import HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+
+# NumPy arrays and scalars are written natively, dict keys may be ints or dates
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Size of the chunks an NDJSON response is written in
+NDJSON_CHUNK_BYTES = 64 * 1024
+
+def _default(value):
+    # Values orjson does not write itself, written the way FastAPI's encoder does
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Period):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def _plain_keys(value):
+    if isinstance(value, dict):
+        return {key if isinstance(key, (str, int, float, bool)) else _default(key): _plain_keys(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain_keys(item) for item in value]
+    return value
+
+def dumps(content):
+    """
+    Serialize a result to JSON bytes, NumPy and pandas values included.
+    """
+    try:
+        return orjson.dumps(content, default=_default, option=JSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        # orjson does not take pandas timestamps or NumPy scalars as dict keys
+        return orjson.dumps(_plain_keys(content), default=_default, option=JSON_OPTIONS)
+
+class FastJSONResponse(Response):
+    """
+    JSON response encoded with orjson instead of FastAPI's encoder.
+    """
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
+
+def json_response(content):
+    # Returning a response skips FastAPI's jsonable_encoder walk of the result
+    return FastJSONResponse(content)
+
+class RowsQuery:
+    """
+    Query parameters of the endpoints returning a list of rows.
+
+    Args:
+        limit : Maximum number of rows to return, all of them when None.
+        after : Cursor returned with the previous page.
+        format : 'json' (default) or 'ndjson' for one row per line.
+    """
+
+    def __init__(self, limit: Optional[int] = Query(None, ge=1), after: Optional[str] = None,
+                 format: Optional[str] = None):
+        self.limit = limit
+        self.after = after
+        self.format = format or 'json'
+
+    @property
+    def paginated(self):
+        return self.limit is not None or self.after is not None
+
+    @property
+    def after_key(self):
+        # Key of the last row of the previous page, None for the first page
+        return decode_cursor(self.after) if self.after is not None else None
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(dumps(key)).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        key = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+def _row_keys(rows, key_fields):
+    # Keys of the rows as written in the cursors, so that both compare alike
+    if key_fields is None:
+        return [[position] for position in range(len(rows))]
+    return orjson.loads(dumps([[row[field] for field in key_fields] for row in rows]))
+
+def paginate(rows, key_fields, limit=None, after=None):
+    """
+    Return the page of rows following a cursor, in key order.
+
+    Rows already in key order, as returned by the sorted pipelines, are not
+    sorted again and the cursor is found by bisection. Otherwise only the
+    rows of the page are picked out, rather than sorting all of them.
+
+    Args:
+        rows : List of row dicts.
+        key_fields : Fields identifying a row. When None the rows are keyed
+            by their position in the result.
+        limit : Maximum number of rows of the page, all the rest when None.
+        after : Cursor of the last row of the previous page, None for the first page.
+
+    Returns:
+        tuple: The rows of the page and the cursor of the next page, None on the last page.
+    """
+    keys = _row_keys(rows, key_fields)
+    in_order = all(key <= following for key, following in zip(keys, keys[1:]))
+    positions = range(len(rows))
+    if after is not None:
+        cursor = decode_cursor(after)
+        try:
+            if in_order:
+                positions = positions[bisect_right(keys, cursor):]
+            else:
+                positions = [position for position in positions if keys[position] > cursor]
+        except TypeError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if in_order:
+        selected = positions if limit is None else positions[:limit + 1]
+    elif limit is None:
+        selected = sorted(positions, key=keys.__getitem__)
+    else:
+        # Equal keys keep the order of the rows
+        selected = heapq.nsmallest(limit + 1, positions, key=lambda position: (keys[position], position))
+    selected = list(selected)
+    has_next = limit is not None and len(selected) > limit
+    if has_next:
+        selected = selected[:limit]
+    page = [rows[position] for position in selected]
+    next_cursor = encode_cursor(keys[selected[-1]]) if has_next and selected else None
+    return page, next_cursor
+
+def after_match(key_paths, after):
+    """
+    Build the filter of the rows whose key sorts after a cursor key.
+
+    Args:
+        key_paths : Fields of the key, in sort order, e.g. ['_id.year', '_id.month'].
+        after : Values of the key, converted to the types of the fields.
+
+    Returns:
+        dict: Filter matching (k1 > a1) or (k1 == a1 and k2 > a2) and so on.
+    """
+    conditions = []
+    for position, path in enumerate(key_paths):
+        condition = dict(zip(key_paths[:position], after[:position]))
+        condition[path] = {"$gt": after[position]}
+        conditions.append(condition)
+    return {"$or": conditions}
+
+def page_stages(key_paths, after=None, limit=None):
+    """
+    Build the stages restricting a pipeline sorted by key_paths to one page.
+
+    The page holds the rows after the cursor key and one row more than the
+    limit, which tells paginate whether there is a next page.
+    """
+    stages = []
+    if after is not None:
+        stages.append({"$match": after_match(key_paths, after)})
+    if limit is not None:
+        stages.append({"$limit": limit + 1})
+    return stages
+
+def page_frame(df, key_fields, after=None, limit=None):
+    """
+    Restrict a result frame to one page before it is serialized, the
+    in-memory counterpart of page_stages.
+
+    Args:
+        df : Result rows, in any order.
+        key_fields : Columns of the key.
+        after : Values of the cursor key, comparable with the columns.
+        limit : Maximum number of rows of the page.
+
+    Returns:
+        pd.DataFrame: The rows after the cursor key in key order, one more than limit at most.
+    """
+    if after is None and limit is None:
+        return df
+    df = df.sort_values(key_fields, kind='stable')
+    if after is not None:
+        following = np.zeros(len(df), dtype=bool)
+        equal = np.ones(len(df), dtype=bool)
+        for field, value in zip(key_fields, after):
+            column = df[field]
+            following |= equal & (column > value).to_numpy(dtype=bool)
+            equal &= (column == value).to_numpy(dtype=bool)
+        df = df[following]
+    return df if limit is None else df.head(limit + 1)
+
+def iter_ndjson(rows, chunk_bytes=NDJSON_CHUNK_BYTES):
+    """
+    Encode rows as newline-delimited JSON, yielded in chunks of about chunk_bytes.
+    """
+    chunk = bytearray()
+    for row in rows:
+        chunk += dumps(row)
+        chunk += b'\n'
+        if len(chunk) >= chunk_bytes:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+def rows_response(content, rows_field, key_fields, query):
+    """
+    Respond with a result holding a list of rows, paginated and encoded as requested.
+
+    Args:
+        content : Result of a service function. Services that push the
+            cursor down into their query hold only the rows after it, one
+            more than the limit at most, which paginate then trims.
+        rows_field : Field of the result holding the rows.
+        key_fields : Fields identifying a row, see paginate.
+        query : RowsQuery of the request.
+
+    Returns:
+        Response: The result as JSON, with the page of rows and the next
+        cursor when paginated, or the rows as NDJSON with the next cursor in
+        the X-Next-Cursor header.
+    """
+    if query.format not in ('json', 'ndjson'):
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'ndjson'")
+    rows = content[rows_field]
+    next_cursor = None
+    if query.paginated:
+        rows, next_cursor = paginate(rows, key_fields, query.limit, query.after)
+    if query.format == 'ndjson':
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else None
+        return StreamingResponse(iter_ndjson(rows), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    page = dict(content, **{rows_field: rows})
+    if query.paginated:
+        page['next_cursor'] = next_cursor
+    return json_response(page)
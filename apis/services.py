@@ -1,12 +1,376 @@
 import os
+import calendar
+from datetime import datetime
 from typing import List
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient
 from fastapi import HTTPException
-from DB.connect_db import get_mongo_connection
+from DB.connect_db import get_database, get_sales_collection, get_pool_stats
+from DB.columnar import fetch_columns
+from DB.snapshots import load_snapshot_meta, read_snapshot
+from DB.instrumentation import instrumented, span
+from DB.compact import FOOTPRINTS, compact_frame
+from DB.range_index import SalesRangeIndex, GRANULARITY_FREQ, MAX_BUCKETS, bucket_count
+from DB.traffic_profile import TrafficProfile
+from DB.dimensions import DimensionTable, totals_by_code, totals_by_id
+from DB.sketches import merge_store_day_sketches, sketch_match, top_products
+from DB.live_ingest import sales_file_config, prepare_line_items, ingest_line_items, INGEST_RETRY_AFTER_SECONDS
+from DB.rollups import (ROLLUP_STORE_DAY_PRODUCT, ROLLUP_STORE_DAY_HOUR, ROLLUP_STORE_HOUR_WEEKDAY,
+                        ROLLUP_STORE_MONTH, ROLLUPS_VERSION_ID)
+from frame_cache import FrameCache
+from json_responses import page_frame, page_stages
 
 # MongoDB connection setup
-client, db, sales_collection = get_mongo_connection()
+db = get_database()
+sales_collection = get_sales_collection()
+
+# Engine of the sales endpoints: 'rollup' answers from the rollup collections
+# maintained by the ETL flow while they are up to date and falls back to
+# 'mongo' otherwise, 'mongo' runs aggregation pipelines over the raw line
+# items, 'pandas' pulls the raw line items and groups them locally. All of
+# them return the same rows, so one can be checked against the other.
+# 'sketch' answers the top-k and distinct count endpoints approximately from
+# the store x day sketches of DB/sketches.py, with their error bounds, and
+# falls back to 'pandas' while the sketches are not up to date.
+AGGREGATION_ENGINE = os.getenv('SALES_AGGREGATION_ENGINE', 'rollup')
+
+# Group keys and accumulators of the time-bucketed sales pipelines
+DAILY_BUCKET = "$transaction_date"
+WEEKLY_BUCKET = {"year": {"$isoWeekYear": "$transaction_date"}, "week": {"$isoWeek": "$transaction_date"}}
+MONTHLY_BUCKET = {"year": {"$year": "$transaction_date"}, "month": {"$month": "$transaction_date"}}
+SALES_TOTAL = 'sales_total'
+LINE_ITEM_COUNT = 'line_items'
+ACCUMULATORS = {
+    SALES_TOTAL: {"$sum": "$line_item_amount"},
+    LINE_ITEM_COUNT: {"$sum": 1},
+}
+
+# The same accumulators over the rollup documents
+ROLLUP_ACCUMULATORS = {
+    SALES_TOTAL: {"$sum": "$amount"},
+    LINE_ITEM_COUNT: {"$sum": "$line_items"},
+}
+
+def store_sales_pipeline(store_id, bucket, accumulator):
+    """
+    Build a pipeline grouping the line items of a store into sorted time buckets.
+    """
+    return [
+        {"$match": {"sales_outlet_id": store_id}},
+        {"$group": {"_id": bucket, "value": accumulator}},
+        {"$sort": {"_id": 1}},
+    ]
+
+def stores_match(store_ids):
+    # Match stage of the multi-store pipelines, store_ids None for all the stores
+    return {} if store_ids is None else {"sales_outlet_id": {"$in": store_ids}}
+
+def stores_sales_pipeline(store_ids, bucket, accumulator):
+    """
+    Build a pipeline grouping the line items of several stores into time
+    buckets, sorted by store and bucket.
+    """
+    return [
+        {"$match": stores_match(store_ids)},
+        {"$group": {"_id": {"store": "$sales_outlet_id", "bucket": bucket}, "value": accumulator}},
+        {"$sort": {"_id.store": 1, "_id.bucket": 1}},
+    ]
+
+def use_pandas(engine):
+    return (engine or AGGREGATION_ENGINE) == 'pandas'
+
+def use_rollups(engine, versions=None):
+    """
+    Whether to answer from the rollups: requested, and built from the
+    current version of the sales collection.
+
+    Args:
+        engine : Requested engine, AGGREGATION_ENGINE when None.
+        versions : Data versions to check, read from the cache when None.
+    """
+    if (engine or AGGREGATION_ENGINE) != 'rollup':
+        return False
+    if versions is None:
+        versions = frame_cache.versions()
+    rollups_version = versions.get(ROLLUPS_VERSION_ID)
+    return rollups_version is not None and rollups_version == versions.get(sales_collection.name)
+
+def use_sketches(engine):
+    """
+    Whether to answer approximately from the sketches: requested, and built
+    from the current version of the sales collection along with the rollups.
+    """
+    if (engine or AGGREGATION_ENGINE) != 'sketch':
+        return False
+    return use_rollups('rollup')
+
+def merged_sketches(store_ids=None, start=None, end=None):
+    """
+    Merge the store x day sketches of some stores over [start, end), serving
+    repeated merges from the cache until the rollups are refreshed.
+    """
+    def merge():
+        return merge_store_day_sketches(db, sketch_match(store_ids, start, end))
+
+    if not CACHE_ENABLED:
+        return merge()
+    key = ('sketches', tuple(store_ids) if store_ids is not None else None, start, end)
+    return frame_cache.get(ROLLUPS_VERSION_ID, key, merge)
+
+def bucket_key_paths(bucket):
+    # Fields of the group key of a bucket, in sort order
+    return [f"_id.{field}" for field in bucket] if isinstance(bucket, dict) else ["_id"]
+
+def store_bucket_totals(store_id, bucket, measure, engine=None, after=None, limit=None):
+    """
+    Total the line items of a store per time bucket on the server.
+
+    measure names the total, SALES_TOTAL or LINE_ITEM_COUNT, computed by its
+    accumulator in ACCUMULATORS or ROLLUP_ACCUMULATORS.
+
+    Reads the day x hour (or month) rollup when the rollups are current, and
+    the raw line items otherwise. With after or limit only one page of the
+    sorted buckets is returned, see json_responses.page_stages.
+    """
+    page = page_stages(bucket_key_paths(bucket), after, limit)
+    if use_rollups(engine):
+        rollup_accumulator = ROLLUP_ACCUMULATORS[measure]
+        if bucket == MONTHLY_BUCKET:
+            pipeline = store_sales_pipeline(store_id, {"year": "$year", "month": "$month"}, rollup_accumulator)
+            return aggregate(db[ROLLUP_STORE_MONTH], pipeline + page, ROLLUPS_VERSION_ID)
+        pipeline = store_sales_pipeline(store_id, bucket, rollup_accumulator)
+        return aggregate(db[ROLLUP_STORE_DAY_HOUR], pipeline + page, ROLLUPS_VERSION_ID)
+    return aggregate(sales_collection, store_sales_pipeline(store_id, bucket, ACCUMULATORS[measure]) + page)
+
+def date_cursor(after):
+    """
+    Convert the cursor key of a daily row, an ISO date or datetime, to a datetime.
+
+    Raises:
+        HTTPException: 400 when the key is not a single ISO date.
+    """
+    if after is None:
+        return None
+    try:
+        (value,) = after
+        return [datetime.fromisoformat(value)]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def int_cursor(after, size):
+    """
+    Check the cursor key of a row keyed by size integers, e.g. a year and a month.
+
+    Raises:
+        HTTPException: 400 when the key is not made of size integers.
+    """
+    if after is not None and (len(after) != size or not all(type(value) is int for value in after)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+def stores_bucket_totals(store_ids, bucket, measure, engine=None):
+    """
+    Total the line items of several stores per time bucket in one pipeline,
+    the multi-store counterpart of store_bucket_totals.
+    """
+    if use_rollups(engine):
+        rollup_accumulator = ROLLUP_ACCUMULATORS[measure]
+        if bucket == MONTHLY_BUCKET:
+            pipeline = stores_sales_pipeline(store_ids, {"year": "$year", "month": "$month"}, rollup_accumulator)
+            return aggregate(db[ROLLUP_STORE_MONTH], pipeline, ROLLUPS_VERSION_ID)
+        pipeline = stores_sales_pipeline(store_ids, bucket, rollup_accumulator)
+        return aggregate(db[ROLLUP_STORE_DAY_HOUR], pipeline, ROLLUPS_VERSION_ID)
+    return aggregate(sales_collection, stores_sales_pipeline(store_ids, bucket, ACCUMULATORS[measure]))
+
+# Types of the fields read by the service functions
+COLUMN_TYPES = {
+    # Sales line items
+    'transaction_id': 'int', 'transaction_date': 'datetime', 'transaction_time': 'int',
+    'sales_outlet_id': 'int', 'customer_id': 'int', 'line_item_id': 'int', 'product_id': 'int',
+    'quantity': 'int', 'line_item_amount': 'float',
+    # Dimension tables
+    'store_city': 'str', 'generation': 'str', 'product_group': 'str', 'product_category': 'str',
+    'product_type': 'str', 'product': 'str', 'product_description': 'str', 'unit_of_measure': 'str',
+    'current_wholesale_price': 'float', 'current_retail_price': 'float', 'tax_exempt_yn': 'bool',
+    'promo_yn': 'bool', 'quantity_sold': 'int', 'waste': 'int',
+    # Sales targets
+    'year_month': 'datetime', 'beans_goal': 'int', 'beverage_goal': 'int', 'food_goal': 'int',
+    'merchandise _goal': 'int',
+}
+
+# Fields of the pastry inventory and product rows returned by get_most_sold_products
+PASTRY_INVENTORY_FIELDS = ['sales_outlet_id', 'transaction_date', 'product_id', 'quantity_sold', 'waste']
+PRODUCT_FIELDS = [
+    'product_id', 'product_group', 'product_category', 'product_type', 'product', 'product_description',
+    'unit_of_measure', 'current_wholesale_price', 'current_retail_price', 'tax_exempt_yn', 'promo_yn',
+]
+
+# Fields of the sales targets compared with the actual sales
+SALES_TARGET_FIELDS = ['sales_outlet_id', 'year_month', 'beans_goal', 'beverage_goal', 'food_goal', 'merchandise _goal']
+
+# Process-wide cache of typed collection snapshots and aggregation results,
+# invalidated by the data versions the ingestion step writes
+CACHE_ENABLED = os.getenv('API_CACHE_ENABLED', '1') == '1'
+frame_cache = FrameCache(
+    db,
+    max_bytes=int(os.getenv('API_CACHE_MAX_MB', '512')) * 1024 * 1024,
+    version_ttl=float(os.getenv('API_CACHE_VERSION_TTL', '1.0')),
+)
+
+# Fields kept in the cached snapshot of each collection
+SNAPSHOT_FIELDS = {
+    os.getenv('COLLECTION_NAME'): [
+        'transaction_id', 'transaction_date', 'transaction_time', 'sales_outlet_id', 'customer_id',
+        'line_item_id', 'product_id', 'quantity', 'line_item_amount',
+    ],
+    'product': PRODUCT_FIELDS,
+    'sales_outlet': ['sales_outlet_id', 'store_city'],
+    'customer': ['customer_id', 'generation'],
+    'pastry_inventory': PASTRY_INVENTORY_FIELDS,
+    'sales_targets': SALES_TARGET_FIELDS,
+}
+
+def select_rows(snapshot, fields, query):
+    """
+    Select the rows of a cached snapshot matching an equality filter, the
+    in-memory counterpart of find(query). Used by the sync and async fetches.
+
+    Without a filter the columns are returned as views of the snapshot, not copied.
+    """
+    if not query:
+        return pd.DataFrame({field: snapshot[field] for field in fields}, copy=False)
+    mask = np.ones(len(snapshot), dtype=bool)
+    for field, value in query.items():
+        mask &= (snapshot[field] == value).to_numpy(dtype=bool, na_value=False)
+    return snapshot.loc[mask, fields].reset_index(drop=True)
+
+def current_snapshot(collection_name, fields):
+    """
+    Open the on-disk snapshot of a collection written by the ingestion step.
+
+    Args:
+        collection_name : Name of the collection.
+        fields : Fields to open.
+
+    Returns:
+        pd.DataFrame: Memory-mapped columns, or None when the snapshot is
+        missing, older than the collection or stores a field as another type.
+    """
+    meta = load_snapshot_meta(collection_name)
+    if meta is None or meta['version'] != frame_cache.versions().get(collection_name):
+        return None
+    if any(meta['columns'].get(field, {}).get('kind') != COLUMN_TYPES[field] for field in fields):
+        return None
+    return read_snapshot(collection_name, fields, meta=meta)
+
+@span('fetch')
+def fetch_frame(collection, fields, query=None):
+    """
+    Fetch only the given fields of a collection as compact DataFrame columns.
+
+    Collections listed in SNAPSHOT_FIELDS are loaded once into the cache and
+    later requests are answered from memory until the next ingestion. The
+    columns are mapped from the on-disk snapshot when it is current and only
+    queried from MongoDB otherwise. Either way they are converted to the
+    compact types of DB/compact.py.
+    """
+    query = query or {}
+    snapshot_fields = SNAPSHOT_FIELDS.get(collection.name)
+    if not CACHE_ENABLED or snapshot_fields is None or not set(fields).union(query) <= set(snapshot_fields):
+        snapshot = current_snapshot(collection.name, list(set(fields).union(query)))
+        if snapshot is not None:
+            return compact_frame(select_rows(snapshot, fields, query))
+        return compact_frame(fetch_columns(collection, {field: COLUMN_TYPES[field] for field in fields}, query))
+
+    def load_snapshot():
+        snapshot = current_snapshot(collection.name, snapshot_fields)
+        if snapshot is None:
+            snapshot = fetch_columns(collection, {field: COLUMN_TYPES[field] for field in snapshot_fields})
+        return compact_frame(snapshot, collection.name)
+
+    def load_rows():
+        snapshot = frame_cache.get(collection.name, ('snapshot', collection.name), load_snapshot)
+        return select_rows(snapshot, fields, query)
+
+    if not query:
+        # Views of the cached snapshot, not cached a second time
+        return load_rows()
+    key = ('rows', collection.name, tuple(fields), tuple(sorted(query.items())))
+    return frame_cache.get(collection.name, key, load_rows)
+
+@span('fetch')
+def aggregate(collection, pipeline, source=None):
+    """
+    Run an aggregation pipeline, serving repeated pipelines from the cache.
+
+    The cached result is invalidated when the data version of source (by
+    default the collection itself) changes.
+    """
+    if not CACHE_ENABLED:
+        return list(collection.aggregate(pipeline))
+    key = ('aggregate', collection.name, repr(pipeline))
+    return frame_cache.get(source or collection.name, key, lambda: list(collection.aggregate(pipeline)))
+
+# Dimension tables held as dense arrays indexed by id: the id field, the
+# attribute fields and the flags derived once from the attributes
+DRINK_PRODUCT_GROUPS = 'Beverages|Whole Bean/Teas'
+DIMENSIONS = {
+    'product': ('product_id', PRODUCT_FIELDS, {
+        'is_drink': lambda df: df['product_group'].str.contains(DRINK_PRODUCT_GROUPS, case=False, na=False),
+    }),
+    'sales_outlet': ('sales_outlet_id', SNAPSHOT_FIELDS['sales_outlet'], {}),
+    'customer': ('customer_id', SNAPSHOT_FIELDS['customer'], {}),
+}
+
+def dimension_table(collection_name):
+    """
+    Return the dense lookup arrays of a dimension table, rebuilt only when its collection changes.
+    """
+    id_field, fields, flags = DIMENSIONS[collection_name]
+
+    def build():
+        return DimensionTable(fetch_frame(db[collection_name], fields), id_field, flags)
+
+    if not CACHE_ENABLED:
+        return build()
+    return frame_cache.get(collection_name, ('dimension', collection_name), build)
+
+def get_cache_stats():
+    return {"cache": frame_cache.stats(), "enabled": CACHE_ENABLED, "frame_footprints": FOOTPRINTS}
+
+def get_connection_pool_stats():
+    return {"pool": get_pool_stats()}
+
+# Fields read by the store-level time-bucketed sales on the pandas path
+STORE_SALES_FIELDS = ['transaction_date', 'sales_outlet_id', 'line_item_amount']
+
+# Queries issued by the service functions, checked by explain_queries.py.
+# SAMPLE_STORE_ID stands in for the store_id path parameter.
+SAMPLE_STORE_ID = 3
+API_QUERIES = [
+    {"name": "sales for store", "collection": os.getenv('COLLECTION_NAME'), "filter": {"sales_outlet_id": SAMPLE_STORE_ID}},
+    {"name": "all sales", "collection": os.getenv('COLLECTION_NAME'), "filter": {}},
+    {"name": "daily sales for store", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": store_sales_pipeline(SAMPLE_STORE_ID, DAILY_BUCKET, ACCUMULATORS[SALES_TOTAL])},
+    {"name": "weekly sales for store", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": store_sales_pipeline(SAMPLE_STORE_ID, WEEKLY_BUCKET, ACCUMULATORS[SALES_TOTAL])},
+    {"name": "monthly sales for store", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": store_sales_pipeline(SAMPLE_STORE_ID, MONTHLY_BUCKET, ACCUMULATORS[SALES_TOTAL])},
+    {"name": "daily sales for stores", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": stores_sales_pipeline([SAMPLE_STORE_ID], DAILY_BUCKET, ACCUMULATORS[SALES_TOTAL])},
+    {"name": "daily receipts for store", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": store_sales_pipeline(SAMPLE_STORE_ID, DAILY_BUCKET, ACCUMULATORS[LINE_ITEM_COUNT])},
+    {"name": "transaction distribution", "collection": os.getenv('COLLECTION_NAME'),
+     "pipeline": [{"$group": {"_id": "$instore_yn", "count": {"$sum": 1}}}]},
+    {"name": "daily sales for store (rollup)", "collection": ROLLUP_STORE_DAY_HOUR,
+     "pipeline": store_sales_pipeline(SAMPLE_STORE_ID, DAILY_BUCKET, ROLLUP_ACCUMULATORS[SALES_TOTAL])},
+    {"name": "most selling item (rollup)", "collection": ROLLUP_STORE_DAY_PRODUCT,
+     "filter": {"sales_outlet_id": SAMPLE_STORE_ID}},
+    {"name": "customers", "collection": "customer", "filter": {}},
+    {"name": "sales outlets", "collection": "sales_outlet", "filter": {}},
+    {"name": "products", "collection": "product", "filter": {}},
+    {"name": "pastry inventory", "collection": "pastry_inventory", "filter": {}},
+]
 
 # Total sales for each store on a daily basis
 def calculate_line_item_amount(df, column_name):
@@ -19,108 +383,152 @@ def daily_sales_by_store(df):
     daily_sales.columns = [column_name, 'sales_outlet_id', 'daily_sales']
     return daily_sales
 
-def get_daily_sales(store_id: int):
-    try:
+@instrumented
+def get_daily_sales(store_id: int, engine: str = None, limit: int = None, after: list = None):
+    # With limit or after, only the page of days following the cursor is returned
+    after = date_cursor(after)
+    if use_pandas(engine):
         # Fetch data from MongoDB
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        df = pd.DataFrame(data)
-        
+        df = fetch_frame(sales_collection, STORE_SALES_FIELDS, {"sales_outlet_id": store_id})
+
         if df.empty:
             raise HTTPException(status_code=404, detail="Store not found")
 
         daily_sales = daily_sales_by_store(df)
         outlet_data = daily_sales[daily_sales['sales_outlet_id'] == store_id]
-        result = outlet_data.to_dict(orient="records")
-        return {"store_id": store_id, "daily_sales": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        outlet_data = page_frame(outlet_data, ['transaction_date'], after, limit)
+        with span('serialize'):
+            result = outlet_data.to_dict(orient="records")
+    else:
+        # Group on the server, only the daily totals are transferred
+        rows = store_bucket_totals(store_id, DAILY_BUCKET, SALES_TOTAL, engine, after, limit)
+        result = [
+            {'transaction_date': row['_id'], 'sales_outlet_id': store_id, 'daily_sales': row['value']}
+            for row in rows
+        ]
+        if not result and after is None:
+            raise HTTPException(status_code=404, detail="Store not found")
+    return {"store_id": store_id, "daily_sales": result}
 
 # Total sales for each store on a weekly basis
 def weekly_sales_by_store(df):
     column_name = 'transaction_date'
-    df[column_name] = pd.to_datetime(df[column_name])
     df['week'] = df[column_name].dt.isocalendar().week
     df['year'] = df[column_name].dt.isocalendar().year
     weekly_sales = df.groupby(['year', 'week', 'sales_outlet_id']).agg({'line_item_amount': 'sum'}).reset_index()
     weekly_sales.columns = ['year', 'week', 'sales_outlet_id', 'weekly_sales']
     return weekly_sales
 
-def get_weekly_sales(store_id: int):
-    try:
+@instrumented
+def get_weekly_sales(store_id: int, engine: str = None, limit: int = None, after: list = None):
+    after = int_cursor(after, 2)
+    if use_pandas(engine):
         # Fetch data from MongoDB
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        df = pd.DataFrame(data)
-        
+        df = fetch_frame(sales_collection, STORE_SALES_FIELDS, {"sales_outlet_id": store_id})
+
         if df.empty:
             raise HTTPException(status_code=404, detail="Store not found")
 
         weekly_sales = weekly_sales_by_store(df)
         outlet_data = weekly_sales[weekly_sales['sales_outlet_id'] == store_id]
-        result = outlet_data.to_dict(orient="records")
-        return {"store_id": store_id, "weekly_sales": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        outlet_data = page_frame(outlet_data, ['year', 'week'], after, limit)
+        with span('serialize'):
+            result = outlet_data.to_dict(orient="records")
+    else:
+        # Group on the server by ISO year and week
+        rows = store_bucket_totals(store_id, WEEKLY_BUCKET, SALES_TOTAL, engine, after, limit)
+        result = [
+            {'year': row['_id']['year'], 'week': row['_id']['week'], 'sales_outlet_id': store_id,
+             'weekly_sales': row['value']}
+            for row in rows
+        ]
+        if not result and after is None:
+            raise HTTPException(status_code=404, detail="Store not found")
+    return {"store_id": store_id, "weekly_sales": result}
 
 # Total sales for each store on a monthly basis
 def monthly_sales_by_store(df):
     column_name = 'transaction_date'
-    df[column_name] = pd.to_datetime(df[column_name])
     df['month'] = df[column_name].dt.month
     df['year'] = df[column_name].dt.year
     monthly_sales = df.groupby(['year', 'month', 'sales_outlet_id']).agg({'line_item_amount': 'sum'}).reset_index()
     monthly_sales.columns = ['year', 'month', 'sales_outlet_id', 'monthly_sales']
     return monthly_sales
 
-def get_monthly_sales(store_id: int):
-    try:
+@instrumented
+def get_monthly_sales(store_id: int, engine: str = None, limit: int = None, after: list = None):
+    after = int_cursor(after, 2)
+    if use_pandas(engine):
         # Fetch data from MongoDB
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        df = pd.DataFrame(data)
-        
+        df = fetch_frame(sales_collection, STORE_SALES_FIELDS, {"sales_outlet_id": store_id})
+
         if df.empty:
             raise HTTPException(status_code=404, detail="Store not found")
 
         monthly_sales = monthly_sales_by_store(df)
         outlet_data = monthly_sales[monthly_sales['sales_outlet_id'] == store_id]
-        result = outlet_data.to_dict(orient="records")
-        return {"store_id": store_id, "monthly_sales": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        outlet_data = page_frame(outlet_data, ['year', 'month'], after, limit)
+        with span('serialize'):
+            result = outlet_data.to_dict(orient="records")
+    else:
+        # Group on the server by calendar year and month
+        rows = store_bucket_totals(store_id, MONTHLY_BUCKET, SALES_TOTAL, engine, after, limit)
+        result = [
+            {'year': row['_id']['year'], 'month': row['_id']['month'], 'sales_outlet_id': store_id,
+             'monthly_sales': row['value']}
+            for row in rows
+        ]
+        if not result and after is None:
+            raise HTTPException(status_code=404, detail="Store not found")
+    return {"store_id": store_id, "monthly_sales": result}
 
 # Peak hours for each store
-def plot_peak_hours_for_store(df, store_id):
-    df['transaction_time'] = pd.to_datetime(df['transaction_time'])
-    df['hour'] = df['transaction_time'].dt.hour
-    column_name = 'hour'
-    hourly_sales = calculate_line_item_amount(df[df['sales_outlet_id'] == store_id], column_name)
-
-    # Find the peak hour for the store
-    if hourly_sales.empty:
-        return pd.DataFrame()
-    peak_hour = hourly_sales.loc[hourly_sales['line_item_amount'].idxmax()]
-    return peak_hour[['sales_outlet_id', 'hour', 'line_item_amount']]
-
-def get_peak_hours_for_store(store_id: int):
-    try:
-        # Fetch data from MongoDB
-        sales_data = list(sales_collection.find({"sales_outlet_id": store_id}))
-
-        if not sales_data:
-            raise HTTPException(status_code=404, detail="Sales data not found for the store")
-
-        sales_df = pd.DataFrame(sales_data)
-        if sales_df.empty:
+TRAFFIC_FIELDS = ['sales_outlet_id', 'transaction_date', 'transaction_time', 'transaction_id', 'line_item_amount']
+
+# Widths of the time-of-day slots of the traffic heatmap
+TRAFFIC_SLOT_MINUTES = (15, 30, 60)
+
+def traffic_profile(slot_minutes=60):
+    """
+    Return the weekday x time-of-day sales of every store, built once per data version.
+    """
+    def build():
+        return TrafficProfile(fetch_frame(sales_collection, TRAFFIC_FIELDS), slot_minutes)
+
+    if not CACHE_ENABLED:
+        return build()
+    return frame_cache.get(sales_collection.name, ('traffic_profile', sales_collection.name, slot_minutes), build)
+
+def peak_hour_from_profile(store_id):
+    peak = traffic_profile().peak_slot(store_id)
+    if peak is None:
+        return None
+    hour, line_item_amount = peak
+    return {"sales_outlet_id": store_id, "hour": hour, "line_item_amount": line_item_amount}
+
+def peak_hour_from_rollups(store_id):
+    rows = aggregate(db[ROLLUP_STORE_HOUR_WEEKDAY], [
+        {"$match": {"sales_outlet_id": store_id}},
+        {"$group": {"_id": "$hour", "line_item_amount": {"$sum": "$amount"}}},
+        {"$sort": {"line_item_amount": -1, "_id": 1}},
+        {"$limit": 1},
+    ], ROLLUPS_VERSION_ID)
+    return [{"sales_outlet_id": store_id, "hour": row['_id'], "line_item_amount": row['line_item_amount']}
+            for row in rows]
+
+@instrumented
+def get_peak_hours_for_store(store_id: int, engine: str = None):
+    if use_rollups(engine):
+        rows = peak_hour_from_rollups(store_id)
+        if not rows:
             raise HTTPException(status_code=404, detail="Sales data not found for the store")
+        return {"peak_hour": rows[0]}
 
-        # Calculate peak hours
-        peak_hour = plot_peak_hours_for_store(sales_df, store_id)
-        if peak_hour.empty:
-            raise HTTPException(status_code=404, detail="No peak hour data found for the store")
-        
-        result = peak_hour.to_dict()
-        return {"peak_hour": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Read the peak hour from the hourly traffic profile of the store
+    peak_hour = peak_hour_from_profile(store_id)
+    if peak_hour is None:
+        raise HTTPException(status_code=404, detail="Sales data not found for the store")
+    return {"peak_hour": peak_hour}
 
 # sales by customer type
 def sales_by_customer_type(df):
@@ -130,21 +538,22 @@ def sales_by_customer_type(df):
 
     return sales_by_type
 
+@instrumented
 def get_sales_by_customer_type(store_id: int):
-    try:
-        # Fetch data from MongoDB
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            raise HTTPException(status_code=404, detail="Store not found")
-
-        sales_data = sales_by_customer_type(df)
-        outlet_data = sales_data[sales_data['sales_outlet_id'] == store_id]
+    # Fetch data from MongoDB
+    df = fetch_frame(sales_collection, ['sales_outlet_id', 'customer_id', 'transaction_id', 'line_item_amount'],
+                     {"sales_outlet_id": store_id})
+
+    if df.empty:
+        raise HTTPException(status_code=404, detail="Store not found")
+
+    # Purchases without a loyalty customer are recorded with customer_id 0
+    df['Guest'] = df['customer_id'] == 0
+    sales_data = sales_by_customer_type(df)
+    outlet_data = sales_data[sales_data['sales_outlet_id'] == store_id]
+    with span('serialize'):
         result = outlet_data.to_dict(orient="records")
-        return {"store_id": store_id, "sales_by_customer_type": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"store_id": store_id, "sales_by_customer_type": result}
 
 # Most Selling Item in each store
 def most_selling_item_by_store(df):
@@ -153,169 +562,196 @@ def most_selling_item_by_store(df):
     most_selling_items.columns = ['sales_outlet_id', 'product_id', 'total_quantity']
     return most_selling_items
 
-def get_most_selling_item(store_id: int):
-    try:
-        # Fetch data from MongoDB
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        df = pd.DataFrame(data)
-        
-        if df.empty:
+def most_selling_item_from_rollups(store_id):
+    rows = aggregate(db[ROLLUP_STORE_DAY_PRODUCT], [
+        {"$match": {"sales_outlet_id": store_id}},
+        {"$group": {"_id": "$product_id", "total_quantity": {"$sum": "$quantity"}}},
+        {"$sort": {"total_quantity": -1, "_id": 1}},
+        {"$limit": 1},
+    ], ROLLUPS_VERSION_ID)
+    return [{"sales_outlet_id": store_id, "product_id": row['_id'], "total_quantity": row['total_quantity']}
+            for row in rows]
+
+def most_selling_items_from_sketches(store_ids):
+    # The true total quantity lies in [total_quantity - max_error, total_quantity]
+    stores = merged_sketches(store_ids)['stores']
+    result = {}
+    for store_id, merged in sorted(stores.items()):
+        result[store_id] = [{"sales_outlet_id": store_id, "product_id": product['product_id'],
+                             "total_quantity": product['quantity'], "max_error": product['max_error']}
+                            for product in top_products(merged, 1)]
+    return result
+
+@instrumented
+def get_most_selling_item(store_id: int, engine: str = None):
+    if use_sketches(engine):
+        result = most_selling_items_from_sketches([store_id]).get(store_id)
+        if not result:
             raise HTTPException(status_code=404, detail="Store not found")
+        return {"store_id": store_id, "most_selling_item": result}
 
-        most_selling_items = most_selling_item_by_store(df)
-        outlet_data = most_selling_items[most_selling_items['sales_outlet_id'] == store_id]
-        result = outlet_data.to_dict(orient="records")
+    if use_rollups(engine):
+        result = most_selling_item_from_rollups(store_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Store not found")
         return {"store_id": store_id, "most_selling_item": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+    # Fetch data from MongoDB
+    df = fetch_frame(sales_collection, ['sales_outlet_id', 'product_id', 'quantity'], {"sales_outlet_id": store_id})
+
+    if df.empty:
+        raise HTTPException(status_code=404, detail="Store not found")
+
+    most_selling_items = most_selling_item_by_store(df)
+    outlet_data = most_selling_items[most_selling_items['sales_outlet_id'] == store_id]
+    with span('serialize'):
+        result = outlet_data.to_dict(orient="records")
+    return {"store_id": store_id, "most_selling_item": result}
 
 # Comparison between actual sales and target sales for each sales outlet
 def calculate_sales_differences(goal_data, actual_sales_data):
     goal = goal_data.copy()
     goal['total_goal'] = goal['beans_goal'] + goal['beverage_goal'] + goal['food_goal'] + goal['merchandise _goal']
 
-    total_sales_by_outlet = actual_sales_data.groupby('sales_outlet_id')['line_item_amount'].sum().reset_index()
+    # Sales of each store in an array indexed by store id, gathered for the goal rows
+    totals, counts = totals_by_id(actual_sales_data['sales_outlet_id'], actual_sales_data['line_item_amount'])
+    store_ids = goal['sales_outlet_id'].to_numpy(dtype='int64', na_value=-1)
+    positions = np.where((store_ids >= 0) & (store_ids < len(counts)), store_ids, len(counts))
+    has_sales = np.append(counts, 0)[positions] > 0
 
-    comparison_df = pd.merge(goal, total_sales_by_outlet, on='sales_outlet_id')
-    comparison_df.rename(columns={'line_item_amount': 'actual_sales'}, inplace=True)
+    comparison_df = goal[has_sales].reset_index(drop=True)
+    comparison_df['actual_sales'] = totals[positions[has_sales]]
 
     comparison_df['difference'] = comparison_df['actual_sales'] - comparison_df['total_goal']
 
     result_df = comparison_df[['sales_outlet_id', 'total_goal', 'actual_sales', 'difference']]
     return result_df
 
+@instrumented
 def get_sales_comparison():
-    try:
-        # Convert input data to DataFrames
-        goal_df = pd.read_csv('data/sales targets.csv')
-        actual_sales_df = pd.read_csv('data/201904 sales reciepts.csv')
-        
-        if goal_df.empty or actual_sales_df.empty:
-            raise HTTPException(status_code=404, detail="Input data cannot be empty")
+    # Fetch the stored targets and sales instead of parsing the CSV files
+    goal_df = fetch_frame(db['sales_targets'], SALES_TARGET_FIELDS)
+    actual_sales_df = fetch_frame(sales_collection, ['sales_outlet_id', 'line_item_amount'])
+
+    if goal_df.empty or actual_sales_df.empty:
+        raise HTTPException(status_code=404, detail="Input data cannot be empty")
 
-        # Calculate sales differences
-        result_df = calculate_sales_differences(goal_df, actual_sales_df)
+    # Calculate sales differences
+    result_df = calculate_sales_differences(goal_df, actual_sales_df)
+    with span('serialize'):
         result = result_df.to_dict(orient="records")
-        return {"sales_differences": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"sales_differences": result}
                             
 # Number of customers who placed more than one order and only one order
 def calculate_line_item_statistics(data):
-    try:
-        num_customers_line_item_id = []
-        for i in range(1, 9):
-            num_customers_line_item_id.append(int((data['line_item_id'] == i).sum()))
-
-        line_item_counts = {f'line_item_id_{i}': count for i, count in enumerate(num_customers_line_item_id, start=1)}
-        num_customers_1_line_item_id = int((data['line_item_id'] == 1).sum())
-        num_customers_more_line_item_id = int((data['line_item_id'] > 1).sum())
-        total_customers = int(data.shape[0])
-        percentage_1_line_item_id = float((num_customers_1_line_item_id / total_customers) * 100)
-        percentage_more_than_1_line_item_id = float((num_customers_more_line_item_id / total_customers) * 100)
-
-        result = {
-            "total_customers": total_customers,
-            "num_customers_1_line_item_id": num_customers_1_line_item_id,
-            "num_customers_more_line_item_id": num_customers_more_line_item_id,
-            "percentage_1_line_item_id": percentage_1_line_item_id,
-            "percentage_more_than_1_line_item_id": percentage_more_than_1_line_item_id
-        }
-        result.update(line_item_counts)
-        return result
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    num_customers_line_item_id = []
+    for i in range(1, 9):
+        num_customers_line_item_id.append(int((data['line_item_id'] == i).sum()))
+
+    line_item_counts = {f'line_item_id_{i}': count for i, count in enumerate(num_customers_line_item_id, start=1)}
+    num_customers_1_line_item_id = int((data['line_item_id'] == 1).sum())
+    num_customers_more_line_item_id = int((data['line_item_id'] > 1).sum())
+    total_customers = int(data.shape[0])
+    percentage_1_line_item_id = float((num_customers_1_line_item_id / total_customers) * 100)
+    percentage_more_than_1_line_item_id = float((num_customers_more_line_item_id / total_customers) * 100)
+
+    result = {
+        "total_customers": total_customers,
+        "num_customers_1_line_item_id": num_customers_1_line_item_id,
+        "num_customers_more_line_item_id": num_customers_more_line_item_id,
+        "percentage_1_line_item_id": percentage_1_line_item_id,
+        "percentage_more_than_1_line_item_id": percentage_more_than_1_line_item_id
+    }
+    result.update(line_item_counts)
+    return result
     
+@instrumented
 def get_line_item_statistics():
-    try:
-        # Fetch all data from MongoDB
-        data = list(sales_collection.find({}))
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            raise HTTPException(status_code=404, detail="No data found")
+    # Fetch all data from MongoDB
+    df = fetch_frame(sales_collection, ['line_item_id'])
+
+    if df.empty:
+        raise HTTPException(status_code=404, detail="No data found")
         
-        # Calculate line item statistics
-        result = calculate_line_item_statistics(df)
-        return {"line_item_statistics": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Calculate line item statistics
+    result = calculate_line_item_statistics(df)
+    return {"line_item_statistics": result}
 
 # Distribution of In-Store vs. Online Transactions
+@instrumented
 def get_transaction_distribution():
-    try:
-        # MongoDB aggregation pipeline to calculate distribution
-        pipeline = [
-            {"$group": {"_id": "$instore_yn", "count": {"$sum": 1}}}
-        ]
-        result = list(sales_collection.aggregate(pipeline))
-
-        distribution = {
-            "In-Store" if item['_id'] else "Online": item['count']
-            for item in result
-        }
-        return {"Distribution of In-Store vs. Online Transactions": distribution}
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # MongoDB aggregation pipeline to calculate distribution
+    pipeline = [
+        {"$group": {"_id": "$instore_yn", "count": {"$sum": 1}}}
+    ]
+    result = aggregate(sales_collection, pipeline)
+
+    # instore_yn is stored as a boolean, blank values as null
+    labels = {True: "In-Store", False: "Online", None: "Unknown"}
+    distribution = {
+        labels[item['_id']]: item['count']
+        for item in result
+    }
+    return {"Distribution of In-Store vs. Online Transactions": distribution}
 
 # Which generation buys the most
 def get_generation_counts(customer_df):
     try:
         generation_counts = customer_df['generation'].value_counts()
-        return generation_counts.to_dict()
+        with span('serialize'):
+            return generation_counts.to_dict()
     except Exception as e:
         raise e
 
+@instrumented
 def get_generation_counts_endpoint():
-    try:
-        # Fetch data from MongoDB
-        customer_collection = db['customer']
-        data = list(customer_collection.find({}))
-        if not data:
-            raise HTTPException(status_code=404, detail="No generation data found")
-
-        customer_df = pd.DataFrame(data)
-        if customer_df.empty:
-            raise HTTPException(status_code=404, detail="No generation data found")
-
-        # Calculate generation counts
-        generation_counts = get_generation_counts(customer_df)
-        return {"generation_counts": generation_counts}
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Fetch data from MongoDB
+    customer_collection = db['customer']
+    customer_df = fetch_frame(customer_collection, ['generation'])
+    if customer_df.empty or customer_df['generation'].isna().all():
+        raise HTTPException(status_code=404, detail="No generation data found")
+
+    # Calculate generation counts
+    generation_counts = get_generation_counts(customer_df)
+    return {"generation_counts": generation_counts}
 
 # Daily sales per transaction for each day of the month
 def get_daily_receipts(sales_df):
-    # Ensure the 'transaction_date' column is in datetime format
-    sales_df['transaction_date'] = pd.to_datetime(sales_df['transaction_date'])
-
     # Aggregate data to get daily receipts for each store
     daily_receipts = sales_df.groupby(['sales_outlet_id', sales_df['transaction_date'].dt.date]).size().reset_index(name='daily_receipts')
     
     return daily_receipts
 
-def get_daily_receipts_for_store(store_id: int):
-    try:
+@instrumented
+def get_daily_receipts_for_store(store_id: int, engine: str = None, limit: int = None, after: list = None):
+    after = date_cursor(after)
+    if use_pandas(engine):
         # Fetch data from MongoDB for the specific store
-        data = list(sales_collection.find({"sales_outlet_id": store_id}))
-        sales_df = pd.DataFrame(data)
-        
+        sales_df = fetch_frame(sales_collection, ['sales_outlet_id', 'transaction_date'], {"sales_outlet_id": store_id})
+
         if sales_df.empty:
             raise HTTPException(status_code=404, detail="No sales data found for the store")
 
         # Calculate daily receipts
         daily_receipts = get_daily_receipts(sales_df)
-        result = daily_receipts.to_dict(orient="records")
-        return {"store_id": store_id, "daily_receipts": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        # The days of this frame are dates, not datetimes
+        page_after = [after[0].date()] if after is not None else None
+        daily_receipts = page_frame(daily_receipts, ['transaction_date'], page_after, limit)
+        with span('serialize'):
+            result = daily_receipts.to_dict(orient="records")
+    else:
+        # Count the line items of each day on the server
+        rows = store_bucket_totals(store_id, DAILY_BUCKET, LINE_ITEM_COUNT, engine, after, limit)
+        result = [
+            {'sales_outlet_id': store_id, 'transaction_date': row['_id'].date(), 'daily_receipts': row['value']}
+            for row in rows
+        ]
+        if not result and after is None:
+            raise HTTPException(status_code=404, detail="No sales data found for the store")
+    return {"store_id": store_id, "daily_receipts": result}
 
 # Best performing store for the month
 def sales_for_month(df):
-    df['transaction_date'] = pd.to_datetime(df['transaction_date'])
     df['month'] = df['transaction_date'].dt.to_period('M').astype(str)
     column_name = 'month'
     monthly_sales = calculate_line_item_amount(df, column_name)
@@ -325,33 +761,53 @@ def sales_for_month(df):
 
 def best_performing_store_for_month(df):
     monthly_sales = sales_for_month(df)
-    best_store = monthly_sales.loc[monthly_sales.groupby('month')['monthly_sales'].idxmax()]
-    return best_store
+    return best_store_of_each_month(monthly_sales)
+
+def best_store_of_each_month(monthly_sales):
+    return monthly_sales.loc[monthly_sales.groupby('month')['monthly_sales'].idxmax()]
+
+def sales_for_month_from_rollups():
+    rows = aggregate(db[ROLLUP_STORE_MONTH], [
+        {"$project": {"_id": 0, "year": 1, "month": 1, "sales_outlet_id": 1, "amount": 1}},
+        {"$sort": {"year": 1, "month": 1, "sales_outlet_id": 1}},
+    ], ROLLUPS_VERSION_ID)
+    monthly_sales = pd.DataFrame({
+        'month': [f"{row['year']:04d}-{row['month']:02d}" for row in rows],
+        'sales_outlet_id': [str(row['sales_outlet_id']) for row in rows],
+        'monthly_sales': [row['amount'] for row in rows],
+    })
+    return monthly_sales
 
-def get_best_performing_store_for_month():
-    try:
-        # Fetch data from MongoDB
-        data = list(sales_collection.find({}))
-        df = pd.DataFrame(data)
-        
-        if df.empty:
+@instrumented
+def get_best_performing_store_for_month(engine: str = None):
+    if use_rollups(engine):
+        monthly_sales = sales_for_month_from_rollups()
+        if monthly_sales.empty:
             raise HTTPException(status_code=404, detail="No sales data found")
+        best_store = best_store_of_each_month(monthly_sales)
+        with span('serialize'):
+            return {"best_performing_store_for_month": best_store.to_dict(orient="records")}
 
-        # Calculate the best performing store for each month
-        best_store = best_performing_store_for_month(df)
+    # Fetch data from MongoDB
+    df = fetch_frame(sales_collection, STORE_SALES_FIELDS)
+
+    if df.empty:
+        raise HTTPException(status_code=404, detail="No sales data found")
+
+    # Calculate the best performing store for each month
+    best_store = best_performing_store_for_month(df)
+    with span('serialize'):
         result = best_store.to_dict(orient="records")
-        return {"best_performing_store_for_month": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"best_performing_store_for_month": result}
 
 # Most sales city
-def analyze_city_sales(df, outlet_city_df):
+def analyze_city_sales(df, outlets):
     try:
-        # Merge sales data with city information
-        merged_df = pd.merge(df, outlet_city_df, on='sales_outlet_id')
-        
-        # Group by city and calculate total sales amount
-        city_sales = merged_df.groupby('store_city')['line_item_amount'].sum().reset_index()
+        # Look up the city of each store and total the sales by city code
+        codes = outlets.codes('store_city', df['sales_outlet_id'])
+        amounts = df['line_item_amount'].to_numpy(dtype='float64', na_value=0.0)
+        totals = totals_by_code(codes, amounts, outlets.categories['store_city'])
+        city_sales = pd.DataFrame({'store_city': totals.index, 'line_item_amount': totals.to_numpy()})
 
         # Identify the city with the most sales
         most_sales_city = city_sales.loc[city_sales['line_item_amount'].idxmax()]
@@ -360,137 +816,121 @@ def analyze_city_sales(df, outlet_city_df):
     except Exception as e:
         raise e
 
-def get_most_sales_city():
-    try:
-        # Fetch data from MongoDB
-        sales_data = list(sales_collection.find({}))
-        sales_outlet_collection = db['sales_outlet']
-        outlet_city_data = list(sales_outlet_collection.find({}))
-
-        if not sales_data or not outlet_city_data:
-            raise HTTPException(status_code=404, detail="Required data not found")
-
-        sales_df = pd.DataFrame(sales_data)
-        outlet_city_df = pd.DataFrame(outlet_city_data)
-
-        if sales_df.empty or outlet_city_df.empty:
-            raise HTTPException(status_code=404, detail="Required data not found")
-
-        # Analyze city sales
-        most_sales_city = analyze_city_sales(sales_df, outlet_city_df)
+STORE_TOTALS_PIPELINE = [
+    {"$group": {"_id": "$sales_outlet_id", "line_item_amount": {"$sum": "$amount"}}},
+    {"$sort": {"_id": 1}},
+]
+
+def store_totals_frame(rows):
+    return pd.DataFrame({
+        'sales_outlet_id': [row['_id'] for row in rows],
+        'line_item_amount': [row['line_item_amount'] for row in rows],
+    })
+
+def store_totals_from_rollups():
+    return store_totals_frame(aggregate(db[ROLLUP_STORE_MONTH], STORE_TOTALS_PIPELINE, ROLLUPS_VERSION_ID))
+
+@instrumented
+def get_most_sales_city(engine: str = None):
+    # Fetch data from MongoDB, one total per store when the rollups are current
+    if use_rollups(engine):
+        sales_df = store_totals_from_rollups()
+    else:
+        sales_df = fetch_frame(sales_collection, ['sales_outlet_id', 'line_item_amount'])
+    outlets = dimension_table('sales_outlet')
+
+    if sales_df.empty or not len(outlets):
+        raise HTTPException(status_code=404, detail="Required data not found")
+
+    # Analyze city sales
+    most_sales_city = analyze_city_sales(sales_df, outlets)
+    with span('serialize'):
         result = most_sales_city.to_dict()
-        return {"most_sales_city": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"most_sales_city": result}
 
 # analyze tax status distribution
 def analyze_tax_status_distribution(product_df):
     try:
         # Proportion of tax-exempt and taxable products
         tax_status_counts = product_df['tax_exempt_yn'].value_counts(normalize=True)
-        return tax_status_counts
+        return tax_status_counts.rename({True: 'Tax-Exempt', False: 'Taxable'})
     except Exception as e:
         raise e
 
+@instrumented
 def get_tax_status_distribution():
-    try:
-        # Fetch data from MongoDB
-        product_collection = db['product']
-        product_data = list(product_collection.find({}))
+    # Fetch data from MongoDB
+    product_collection = db['product']
+    product_df = fetch_frame(product_collection, ['tax_exempt_yn'])
 
-        if not product_data:
-            raise HTTPException(status_code=404, detail="Product data not found")
+    if product_df.empty:
+        raise HTTPException(status_code=404, detail="Product data not found")
 
-        product_df = pd.DataFrame(product_data)
-
-        if product_df.empty:
-            raise HTTPException(status_code=404, detail="Product data not found")
-
-        # Analyze tax status distribution
-        tax_status_counts = analyze_tax_status_distribution(product_df)
+    # Analyze tax status distribution
+    tax_status_counts = analyze_tax_status_distribution(product_df)
+    with span('serialize'):
         result = tax_status_counts.to_dict()
-        return {"tax_status_distribution": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"tax_status_distribution": result}
 
 # Drink size distribution
-def analyze_drink_size_distribution(product_df, sales_df):
-    product_df['unit_of_measure'] = product_df['unit'].astype(str) + ' ' + product_df['measure']
-
-    merged_df = pd.merge(sales_df, product_df, on='product_id')
-    
-    drinks_df = merged_df[merged_df['product_group'].str.contains('Beverages|Whole Bean/Teas', case=False, na=False)]
+def analyze_drink_size_distribution(products, sales_df):
+    # Unit of measure of the drinks sold, looked up by product id, -1 for the other products
+    product_ids = sales_df['product_id']
+    codes = np.where(products.flag('is_drink', product_ids), products.codes('unit_of_measure', product_ids), -1)
+    quantities = sales_df['quantity'].to_numpy(dtype='int64', na_value=0)
 
-    drink_size_distribution = drinks_df.groupby('unit_of_measure')['quantity'].sum().sort_values(ascending=False)
-    
-    return drink_size_distribution
+    drink_size_distribution = totals_by_code(codes, quantities, products.categories['unit_of_measure'])
+    return drink_size_distribution.rename('quantity').rename_axis('unit_of_measure').sort_values(ascending=False)
 
+@instrumented
 def get_drink_size_distribution():
-    try:
-        # Fetch data from MongoDB
-        product_collection = db['product']
-        product_data = list(product_collection.find({}))
-        sales_data = list(sales_collection.find({}))
+    # Fetch data from MongoDB
+    products = dimension_table('product')
+    sales_df = fetch_frame(sales_collection, ['product_id', 'quantity'])
 
-        if not product_data or not sales_data:
-            raise HTTPException(status_code=404, detail="Required data not found")
+    if not len(products) or sales_df.empty:
+        raise HTTPException(status_code=404, detail="Required data not found")
 
-        product_df = pd.DataFrame(product_data)
-        sales_df = pd.DataFrame(sales_data)
-
-        if product_df.empty or sales_df.empty:
-            raise HTTPException(status_code=404, detail="Required data not found")
-
-        # Analyze drink size distribution
-        drink_size_distribution = analyze_drink_size_distribution(product_df, sales_df)
+    # Analyze drink size distribution
+    drink_size_distribution = analyze_drink_size_distribution(products, sales_df)
+    with span('serialize'):
         result = drink_size_distribution.to_dict()
-        return {"drink_size_distribution": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"drink_size_distribution": result}
 
 # Most sold products
-def most_sold_products(pastry_inventory_df, product_df, sales_df):
+def most_sold_products(pastry_inventory_df, products, sales_df):
     try:
-        common_product_ids = product_df[product_df['product_id'].isin(sales_df['product_id'])]['product_id']
-        filtered_inventory = pastry_inventory_df[pastry_inventory_df['product_id'].isin(common_product_ids)]
-        merged_df = filtered_inventory.merge(product_df, how='left', left_on='product_id', right_on='product_id')
+        # Products of the product table that were sold, flagged by product id
+        sold = np.zeros(products.size + 1, dtype=bool)
+        sold[products.positions(sales_df['product_id'])] = True
+        sold &= products.present
+        filtered_inventory = pastry_inventory_df[sold[products.positions(pastry_inventory_df['product_id'])]]
+        attributes = products.gather(filtered_inventory['product_id'])
+        merged_df = pd.concat([filtered_inventory.reset_index(drop=True), attributes], axis=1)
         sorted_df = merged_df.sort_values(by='quantity_sold', ascending=False)
         return sorted_df.head(5)
     except Exception as e:
         raise e
 
+@instrumented
 def get_most_sold_products():
-    try:
-        # Fetch data from MongoDB
-        pastry_inventory_collection = db['pastry_inventory']
-        product_collection = db['product']
-        pastry_inventory_data = list(pastry_inventory_collection.find({}))
-        product_data = list(product_collection.find({}))
-        sales_data = list(sales_collection.find({}))
-
-        if not pastry_inventory_data or not product_data or not sales_data:
-            raise HTTPException(status_code=404, detail="Required data not found")
-
-        pastry_inventory_df = pd.DataFrame(pastry_inventory_data)
-        product_df = pd.DataFrame(product_data)
-        sales_df = pd.DataFrame(sales_data)
-
-        if pastry_inventory_df.empty or product_df.empty or sales_df.empty:
-            raise HTTPException(status_code=404, detail="Required data not found")
-
-        # Calculate the most sold products
-        top_5_sold_products = most_sold_products(pastry_inventory_df, product_df, sales_df)
+    # Fetch data from MongoDB
+    pastry_inventory_collection = db['pastry_inventory']
+    pastry_inventory_df = fetch_frame(pastry_inventory_collection, PASTRY_INVENTORY_FIELDS)
+    products = dimension_table('product')
+    sales_df = fetch_frame(sales_collection, ['product_id'])
+
+    if pastry_inventory_df.empty or not len(products) or sales_df.empty:
+        raise HTTPException(status_code=404, detail="Required data not found")
+
+    # Calculate the most sold products
+    top_5_sold_products = most_sold_products(pastry_inventory_df, products, sales_df)
+    with span('serialize'):
         result = top_5_sold_products.to_dict(orient="records")
-        return {"most_sold_products": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"most_sold_products": result}
 
 # Average sales per transaction
 def plot_average_sales_per_transaction_by_day_of_month(df, month):
-    # Convert transaction_date to datetime if it is not already
-    if not pd.api.types.is_datetime64_any_dtype(df['transaction_date']):
-        df['transaction_date'] = pd.to_datetime(df['transaction_date'])
-    
     # Filter the DataFrame to include only the specified month
     df_filtered = df[df['transaction_date'].dt.month == month]
     
@@ -498,32 +938,40 @@ def plot_average_sales_per_transaction_by_day_of_month(df, month):
     daily_sales_per_transac_by_month = df_filtered.groupby('transaction_date')['line_item_amount'].mean()
     return daily_sales_per_transac_by_month
 
-def get_average_sales_per_transaction(month: int):
-    try:
-        # Fetch data from MongoDB
-        sales_data = list(sales_collection.find({}))
+def average_sales_per_transaction_pipeline(month):
+    return [
+        {"$match": {"$expr": {"$eq": [{"$month": "$transaction_date"}, month]}}},
+        {"$group": {"_id": "$transaction_date", "amount": {"$sum": "$amount"}, "line_items": {"$sum": "$line_items"}}},
+        {"$sort": {"_id": 1}},
+    ]
 
-        if not sales_data:
-            raise HTTPException(status_code=404, detail="Sales data not found")
+def average_sales_per_transaction_from_rows(rows):
+    return {pd.Timestamp(row['_id']): row['amount'] / row['line_items'] for row in rows}
 
-        sales_df = pd.DataFrame(sales_data)
+def average_sales_per_transaction_from_rollups(month):
+    rows = aggregate(db[ROLLUP_STORE_DAY_HOUR], average_sales_per_transaction_pipeline(month), ROLLUPS_VERSION_ID)
+    return average_sales_per_transaction_from_rows(rows)
 
-        if sales_df.empty:
-            raise HTTPException(status_code=404, detail="Sales data not found")
+@instrumented
+def get_average_sales_per_transaction(month: int, engine: str = None):
+    if use_rollups(engine):
+        result = average_sales_per_transaction_from_rollups(month)
+        return {"average_sales_per_transaction_by_day_of_month": result}
+
+    # Fetch data from MongoDB
+    sales_df = fetch_frame(sales_collection, ['transaction_date', 'line_item_amount'])
 
-        # Calculate average sales per transaction by day of month
-        average_sales = plot_average_sales_per_transaction_by_day_of_month(sales_df, month)
+    if sales_df.empty:
+        raise HTTPException(status_code=404, detail="Sales data not found")
+
+    # Calculate average sales per transaction by day of month
+    average_sales = plot_average_sales_per_transaction_by_day_of_month(sales_df, month)
+    with span('serialize'):
         result = average_sales.to_dict()
-        return {"average_sales_per_transaction_by_day_of_month": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"average_sales_per_transaction_by_day_of_month": result}
 
 # Daily sales per week
 def get_daily_sales_per_week(sales_df, month):
-    # Convert transaction_date to datetime if it is not already
-    if not pd.api.types.is_datetime64_any_dtype(sales_df['transaction_date']):
-        sales_df['transaction_date'] = pd.to_datetime(sales_df['transaction_date'])
-    
     # Filter the DataFrame to include only the specified month
     sales_df = sales_df[sales_df['transaction_date'].dt.month == month]
     
@@ -542,25 +990,344 @@ def get_daily_sales_per_week(sales_df, month):
  
     return daily_sales_per_week
 
-def get_daily_sales_per_week_endpoint(month: int):
-    try:
-        # Fetch data from MongoDB
-        sales_data = list(sales_collection.find({}))
-
-        if not sales_data:
-            raise HTTPException(status_code=404, detail="Sales data not found")
-
-        sales_df = pd.DataFrame(sales_data)
-
-        if sales_df.empty:
-            raise HTTPException(status_code=404, detail="Sales data not found")
-
-        # Calculate daily sales per week for the specified month
-        daily_sales_per_week = get_daily_sales_per_week(sales_df, month)
+def daily_sales_per_week_pipeline(month):
+    return [
+        {"$match": {"$expr": {"$eq": [{"$month": "$transaction_date"}, month]}}},
+        {"$group": {"_id": {"sales_outlet_id": "$sales_outlet_id", "weekday": "$weekday"},
+                    "daily_sales": {"$sum": "$line_items"}}},
+        {"$sort": {"_id.weekday": 1, "_id.sales_outlet_id": 1}},
+    ]
+
+def daily_sales_per_week_from_rollups(month):
+    rows = aggregate(db[ROLLUP_STORE_DAY_HOUR], daily_sales_per_week_pipeline(month), ROLLUPS_VERSION_ID)
+    return daily_sales_per_week_from_rows(rows)
+
+def daily_sales_per_week_from_rows(rows):
+    return [{
+        "sales_outlet_id": str(row['_id']['sales_outlet_id']),
+        "day_of_week": int(row['_id']['weekday']),
+        "day_name": calendar.day_name[int(row['_id']['weekday'])],
+        "daily_sales": row['daily_sales'],
+    } for row in rows]
+
+@instrumented
+def get_daily_sales_per_week_endpoint(month: int, engine: str = None):
+    if use_rollups(engine):
+        return {"daily_sales_per_week": daily_sales_per_week_from_rollups(month)}
+
+    # Fetch data from MongoDB
+    sales_df = fetch_frame(sales_collection, ['transaction_date', 'sales_outlet_id'])
+
+    if sales_df.empty:
+        raise HTTPException(status_code=404, detail="Sales data not found")
+
+    # Calculate daily sales per week for the specified month
+    daily_sales_per_week = get_daily_sales_per_week(sales_df, month)
+    with span('serialize'):
         result = daily_sales_per_week.to_dict(orient="records")
-        return {"daily_sales_per_week": result}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"daily_sales_per_week": result}
+
+# Sales of several stores at once, one query and one groupby for all of them
+def parse_store_ids(store_ids):
+    """
+    Parse the store_ids parameter of the multi-store endpoints.
 
+    Args:
+        store_ids : 'all', or store ids separated by commas, e.g. '3,5,8'.
 
-    
\ No newline at end of file
+    Returns:
+        list: Sorted store ids, or None for all the stores.
+    """
+    if store_ids is None or store_ids.strip().lower() == 'all':
+        return None
+    try:
+        ids = sorted({int(store_id) for store_id in store_ids.split(',') if store_id.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="store_ids must be 'all' or store ids separated by commas")
+    if not ids:
+        raise HTTPException(status_code=400, detail="store_ids must not be empty")
+    return ids
+
+def select_stores(df, store_ids):
+    # Rows of the given stores, all of them when store_ids is None
+    if store_ids is None:
+        return df.copy()
+    return df[df['sales_outlet_id'].isin(store_ids)].reset_index(drop=True)
+
+def records_by_store(df):
+    """
+    Split the rows of a frame computed for several stores by store.
+
+    Returns:
+        dict: Records of each store, keyed by store id in ascending order.
+    """
+    with span('serialize'):
+        return {int(store_id): rows.to_dict(orient="records")
+                for store_id, rows in df.groupby('sales_outlet_id', sort=True)}
+
+def rows_by_store(rows, to_record):
+    # Split the rows of a multi-store pipeline, grouped by {store, bucket}, by store
+    result = {}
+    for row in rows:
+        store_id = row['_id']['store']
+        result.setdefault(store_id, []).append(to_record(store_id, row['_id']['bucket'], row['value']))
+    return result
+
+def first_row_by_store(rows):
+    # First row of each store of rows sorted by store then by preference
+    result = {}
+    for row in rows:
+        result.setdefault(row['_id']['store'], row)
+    return result
+
+def fetch_stores_frame(fields, store_ids):
+    # All the stores are selected from the cached frame, not queried one by one
+    return select_stores(fetch_frame(sales_collection, fields), store_ids)
+
+@instrumented
+def get_daily_sales_for_stores(store_ids: str = 'all', engine: str = None):
+    store_ids = parse_store_ids(store_ids)
+    if use_pandas(engine):
+        df = fetch_stores_frame(STORE_SALES_FIELDS, store_ids)
+        result = records_by_store(daily_sales_by_store(df))
+    else:
+        rows = stores_bucket_totals(store_ids, DAILY_BUCKET, SALES_TOTAL, engine)
+        result = rows_by_store(rows, lambda store_id, bucket, value: {
+            'transaction_date': bucket, 'sales_outlet_id': store_id, 'daily_sales': value})
+    if not result:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {"store_ids": list(result), "daily_sales": result}
+
+@instrumented
+def get_weekly_sales_for_stores(store_ids: str = 'all', engine: str = None):
+    store_ids = parse_store_ids(store_ids)
+    if use_pandas(engine):
+        df = fetch_stores_frame(STORE_SALES_FIELDS, store_ids)
+        result = records_by_store(weekly_sales_by_store(df))
+    else:
+        rows = stores_bucket_totals(store_ids, WEEKLY_BUCKET, SALES_TOTAL, engine)
+        result = rows_by_store(rows, lambda store_id, bucket, value: {
+            'year': bucket['year'], 'week': bucket['week'], 'sales_outlet_id': store_id, 'weekly_sales': value})
+    if not result:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {"store_ids": list(result), "weekly_sales": result}
+
+@instrumented
+def get_monthly_sales_for_stores(store_ids: str = 'all', engine: str = None):
+    store_ids = parse_store_ids(store_ids)
+    if use_pandas(engine):
+        df = fetch_stores_frame(STORE_SALES_FIELDS, store_ids)
+        result = records_by_store(monthly_sales_by_store(df))
+    else:
+        rows = stores_bucket_totals(store_ids, MONTHLY_BUCKET, SALES_TOTAL, engine)
+        result = rows_by_store(rows, lambda store_id, bucket, value: {
+            'year': bucket['year'], 'month': bucket['month'], 'sales_outlet_id': store_id, 'monthly_sales': value})
+    if not result:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {"store_ids": list(result), "monthly_sales": result}
+
+def peak_hours_from_rollups(store_ids):
+    rows = aggregate(db[ROLLUP_STORE_HOUR_WEEKDAY], [
+        {"$match": stores_match(store_ids)},
+        {"$group": {"_id": {"store": "$sales_outlet_id", "hour": "$hour"}, "line_item_amount": {"$sum": "$amount"}}},
+        {"$sort": {"_id.store": 1, "line_item_amount": -1, "_id.hour": 1}},
+    ], ROLLUPS_VERSION_ID)
+    return {store_id: {"sales_outlet_id": store_id, "hour": row['_id']['hour'], "line_item_amount": row['line_item_amount']}
+            for store_id, row in first_row_by_store(rows).items()}
+
+@instrumented
+def get_peak_hours_for_stores(store_ids: str = 'all', engine: str = None):
+    store_ids = parse_store_ids(store_ids)
+    if use_rollups(engine):
+        result = peak_hours_from_rollups(store_ids)
+    else:
+        stores = traffic_profile().stores if store_ids is None else store_ids
+        peak_hours = {int(store_id): peak_hour_from_profile(int(store_id)) for store_id in stores}
+        result = {store_id: peak_hour for store_id, peak_hour in peak_hours.items() if peak_hour is not None}
+    if not result:
+        raise HTTPException(status_code=404, detail="Sales data not found for the stores")
+    return {"store_ids": list(result), "peak_hour": result}
+
+@instrumented
+def get_sales_by_customer_type_for_stores(store_ids: str = 'all'):
+    store_ids = parse_store_ids(store_ids)
+    df = fetch_stores_frame(['sales_outlet_id', 'customer_id', 'transaction_id', 'line_item_amount'], store_ids)
+
+    # Purchases without a loyalty customer are recorded with customer_id 0
+    df['Guest'] = df['customer_id'] == 0
+    result = records_by_store(sales_by_customer_type(df))
+    if not result:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {"store_ids": list(result), "sales_by_customer_type": result}
+
+def most_selling_items_from_rollups(store_ids):
+    rows = aggregate(db[ROLLUP_STORE_DAY_PRODUCT], [
+        {"$match": stores_match(store_ids)},
+        {"$group": {"_id": {"store": "$sales_outlet_id", "product_id": "$product_id"},
+                    "total_quantity": {"$sum": "$quantity"}}},
+        {"$sort": {"_id.store": 1, "total_quantity": -1, "_id.product_id": 1}},
+    ], ROLLUPS_VERSION_ID)
+    return {store_id: [{"sales_outlet_id": store_id, "product_id": row['_id']['product_id'],
+                        "total_quantity": row['total_quantity']}]
+            for store_id, row in first_row_by_store(rows).items()}
+
+@instrumented
+def get_most_selling_item_for_stores(store_ids: str = 'all', engine: str = None):
+    store_ids = parse_store_ids(store_ids)
+    if use_sketches(engine):
+        result = most_selling_items_from_sketches(store_ids)
+    elif use_rollups(engine):
+        result = most_selling_items_from_rollups(store_ids)
+    else:
+        df = fetch_stores_frame(['sales_outlet_id', 'product_id', 'quantity'], store_ids)
+        result = records_by_store(most_selling_item_by_store(df))
+    if not result:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {"store_ids": list(result), "most_selling_item": result}
+
+# Distinct receipts and loyalty customers, estimated from the sketches
+def distinct_counts_from_sketches(merged):
+    return {
+        "receipts": merged['receipts'].count(),
+        "customers": merged['customers'].count(),
+        "line_items": merged['line_items'],
+        "days": merged['days'],
+    }
+
+@instrumented
+def get_distinct_counts(store_ids: str = 'all', start=None, end=None):
+    store_ids = parse_store_ids(store_ids)
+    try:
+        start = parse_timestamp(start) if start is not None else None
+        end = parse_timestamp(end) if end is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not use_sketches('sketch'):
+        raise HTTPException(status_code=503, detail="The sketches are not up to date with the sales, retry after the next ETL run")
+    merged = merged_sketches(store_ids, start, end)
+    if not merged['stores']:
+        raise HTTPException(status_code=404, detail="No sales data found")
+    return {
+        "from": start, "to": end,
+        # 68% of the estimates are within this relative error of the true count, 95% within twice it
+        "relative_standard_error": merged['receipts'].relative_error,
+        "totals": distinct_counts_from_sketches(merged),
+        "stores": {store_id: distinct_counts_from_sketches(store) for store_id, store in sorted(merged['stores'].items())},
+    }
+
+# Traffic heatmap for staffing, every store at once
+@instrumented
+def get_traffic_heatmap(store_ids: str = 'all', slot_minutes: int = 60):
+    store_ids = parse_store_ids(store_ids)
+    if slot_minutes not in TRAFFIC_SLOT_MINUTES:
+        raise HTTPException(status_code=400,
+                            detail=f"slot_minutes must be one of: {', '.join(map(str, TRAFFIC_SLOT_MINUTES))}")
+    profile = traffic_profile(slot_minutes)
+    stores = profile.heatmap(store_ids)
+    if not stores:
+        raise HTTPException(status_code=404, detail="Stores not found")
+    return {
+        "slot_minutes": slot_minutes,
+        "weekdays": list(calendar.day_name),
+        "slots": profile.slot_labels(),
+        "stores": stores,
+    }
+
+# Sales totals over arbitrary time ranges
+RANGE_INDEX_FIELDS = [
+    'sales_outlet_id', 'transaction_date', 'transaction_time', 'transaction_id', 'quantity', 'line_item_amount',
+]
+
+def sales_range_index():
+    """
+    Return the prefix-sum index of the sales, built once per data version.
+    """
+    def build():
+        return SalesRangeIndex(fetch_frame(sales_collection, RANGE_INDEX_FIELDS))
+
+    if not CACHE_ENABLED:
+        return build()
+    return frame_cache.get(sales_collection.name, ('range_index', sales_collection.name), build)
+
+def parse_timestamp(value):
+    # Date or date-time query parameter as a naive UTC timestamp, like the stored dates
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp
+
+@instrumented
+def get_sales_range(start, end, store_id: int = None, granularity: str = None):
+    try:
+        start, end = parse_timestamp(start), parse_timestamp(end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if granularity is not None and granularity not in GRANULARITY_FREQ:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(GRANULARITY_FREQ)}")
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    if granularity is not None and bucket_count(start, end, granularity) > MAX_BUCKETS:
+        raise HTTPException(status_code=400,
+                            detail=f"The range holds more than {MAX_BUCKETS} {granularity} buckets, use a coarser granularity")
+    index = sales_range_index()
+    if store_id is not None and store_id not in index.stores:
+        raise HTTPException(status_code=404, detail="Store not found")
+
+    result = {"store_id": store_id, "from": start, "to": end, "totals": index.totals(start, end, store_id)}
+    if granularity is not None:
+        result["granularity"] = granularity
+        result["buckets"] = index.buckets(start, end, granularity, store_id)
+    return result
+
+# Online ingestion of the line items posted by the tills
+DATA_FILES_CONFIG = os.getenv(
+    'DATA_FILES_CONFIG',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data_files_config.json'),
+)
+_sales_schema = None
+
+def sales_schema():
+    # Ingestion schema of the sales line items, read once from the ETL configuration
+    global _sales_schema
+    if _sales_schema is None:
+        _sales_schema, _ = sales_file_config(DATA_FILES_CONFIG, sales_collection.name)
+    return _sales_schema
+
+def append_to_snapshot(collection_name, rows, versions):
+    """
+    Add ingested rows to the cached snapshot of a collection and move the
+    cache to the new data versions, so that the snapshot is not reloaded
+    from MongoDB. Values derived from the snapshot are rebuilt from memory
+    on their next access.
+    """
+    snapshot_fields = SNAPSHOT_FIELDS.get(collection_name)
+
+    def append(snapshot):
+        new_rows = compact_frame(rows.reindex(columns=snapshot_fields))
+        return compact_frame(pd.concat([snapshot, new_rows], ignore_index=True))
+
+    updates = {('snapshot', collection_name): append} if snapshot_fields else None
+    # The ingestion increments the version by one
+    frame_cache.advance(versions, collection_name, updates, versions[collection_name] - 1)
+
+@instrumented
+def post_receipts(line_items: List[dict]):
+    try:
+        df = prepare_line_items(line_items, sales_schema())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        result = ingest_line_items(db, sales_collection.name, df)
+        versions = result['versions']
+        if versions and CACHE_ENABLED:
+            append_to_snapshot(sales_collection.name, result['rows'], versions)
+        return {
+            "received": result['received'],
+            "inserted": result['inserted'],
+            "duplicates": result['duplicates'],
+            "rollups_current": use_rollups('rollup'),
+        }
+    except TimeoutError as e:
+        # The rollups are being written by another process, the till posts again later
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(INGEST_RETRY_AFTER_SECONDS)})
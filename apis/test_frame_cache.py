@@ -0,0 +1,117 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pytest
+import frame_cache
+from DB.manifest import bump_data_version, load_data_versions
+from frame_cache import FrameCache
+
+mongomock = pytest.importorskip('mongomock')
+
+class Loader:
+    # Loader returning a new frame on every call, counting the calls
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return pd.DataFrame({'value': [self.calls] * 3})
+
+def test_values_are_cached_until_the_collection_version_changes():
+    db = mongomock.MongoClient()['test']
+    bump_data_version(db, 'sales')
+    cache = FrameCache(db, max_bytes=10 ** 6, version_ttl=0)
+    loader = Loader()
+
+    assert cache.get('sales', 'frame', loader)['value'].iloc[0] == 1
+    assert cache.get('sales', 'frame', loader)['value'].iloc[0] == 1
+    assert loader.calls == 1
+
+    # Another collection changing leaves the entry alone
+    bump_data_version(db, 'products')
+    cache.get('sales', 'frame', loader)
+    assert loader.calls == 1
+
+    bump_data_version(db, 'sales')
+    assert cache.get('sales', 'frame', loader)['value'].iloc[0] == 2
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (2, 2, 1)
+
+def test_versions_are_reread_at_most_once_per_ttl():
+    db = mongomock.MongoClient()['test']
+    cache = FrameCache(db, max_bytes=10 ** 6, version_ttl=3600)
+    loader = Loader()
+    cache.get('sales', 'frame', loader)
+    bump_data_version(db, 'sales')
+    cache.get('sales', 'frame', loader)
+    assert loader.calls == 1
+
+def test_cached_frames_are_returned_as_copies():
+    cache = FrameCache(mongomock.MongoClient()['test'], max_bytes=10 ** 6)
+    frame = cache.get('sales', 'frame', Loader())
+    frame['other'] = 0
+    assert list(cache.get('sales', 'frame', Loader()).columns) == ['value']
+
+def test_least_recently_used_entries_are_evicted():
+    cache = FrameCache(mongomock.MongoClient()['test'], max_bytes=2 ** 20)
+    for key in range(3):
+        cache.get('sales', key, lambda: pd.DataFrame({'value': range(50000)}))
+    assert cache.stats()['evictions'] == 1
+    assert cache.bytes <= cache.max_bytes
+
+def test_concurrent_misses_wait_for_a_single_load():
+    cache = FrameCache(mongomock.MongoClient()['test'], max_bytes=10 ** 6)
+    loader, release = Loader(), threading.Event()
+
+    def slow_loader():
+        release.wait(5)
+        return loader()
+
+    with ThreadPoolExecutor(4) as pool:
+        results = [pool.submit(cache.get, 'sales', 'frame', slow_loader) for _ in range(4)]
+        deadline = time.monotonic() + 5
+        while cache.stats()['coalesced'] < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        frames = [result.result() for result in results]
+    assert loader.calls == 1
+    assert all(frame['value'].iloc[0] == 1 for frame in frames)
+    assert (cache.stats()['misses'], cache.stats()['coalesced']) == (1, 3)
+
+def test_concurrent_async_misses_wait_for_a_single_load():
+    cache = FrameCache(mongomock.MongoClient()['test'], max_bytes=10 ** 6)
+    loader = Loader()
+
+    async def load():
+        await asyncio.sleep(0.05)
+        return loader()
+
+    async def main():
+        return await asyncio.gather(*(cache.get_async('sales', 'frame', load) for _ in range(3)))
+
+    assert [frame['value'].iloc[0] for frame in asyncio.run(main())] == [1, 1, 1]
+    assert loader.calls == 1
+
+def test_a_failed_load_is_retried_by_the_next_miss():
+    cache = FrameCache(mongomock.MongoClient()['test'], max_bytes=10 ** 6)
+
+    def failing_loader():
+        raise RuntimeError('query failed')
+
+    with pytest.raises(RuntimeError):
+        cache.get('sales', 'frame', failing_loader)
+    assert cache.get('sales', 'frame', Loader())['value'].iloc[0] == 1
+
+def test_versions_are_read_without_holding_the_cache_lock(monkeypatch):
+    db = mongomock.MongoClient()['test']
+    cache = FrameCache(db, max_bytes=10 ** 6, version_ttl=0)
+
+    def read_versions(database):
+        assert not cache._lock.locked()
+        return load_data_versions(database)
+
+    monkeypatch.setattr(frame_cache, 'load_data_versions', read_versions)
+    cache.get('sales', 'frame', Loader())
+    assert cache.versions() == {}
@@ -0,0 +1,89 @@
+import numpy as np
+import orjson
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+from json_responses import decode_cursor, dumps, encode_cursor, iter_ndjson, page_frame, page_stages, paginate
+
+def daily_rows(days=10):
+    return [{'transaction_date': pd.Timestamp('2019-04-01') + pd.Timedelta(days=day),
+             'sales_outlet_id': np.int16(3 + day % 2), 'daily_sales': day * 1.5}
+            for day in reversed(range(days))]
+
+def test_cursor_round_trip():
+    key = ['2019-04-03T00:00:00', 5, 2.5]
+    cursor = encode_cursor(key)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == key
+
+@pytest.mark.parametrize('cursor', ['not a cursor', encode_cursor(5)[:-1], 'eyJhIjoxfQ'])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+def test_pages_follow_each_other_in_key_order():
+    rows = daily_rows()
+    pages, after = [], None
+    while True:
+        page, after = paginate(rows, ['transaction_date', 'sales_outlet_id'], limit=3, after=after)
+        pages.append(page)
+        if after is None:
+            break
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert [row for page in pages for row in page] == sorted(rows, key=lambda row: row['transaction_date'])
+
+def test_page_after_a_key_removed_since_the_previous_page():
+    rows = daily_rows()
+    page, after = paginate(rows, ['transaction_date', 'sales_outlet_id'], limit=4)
+    remaining = [row for row in rows if row not in page[2:]]
+    following, _ = paginate(remaining, ['transaction_date', 'sales_outlet_id'], limit=2, after=after)
+    assert [row['daily_sales'] for row in following] == [6.0, 7.5]
+
+@pytest.mark.parametrize('in_order', [True, False])
+@pytest.mark.parametrize('limit', [1, 4, 100])
+def test_pages_of_sorted_and_unsorted_rows_match(in_order, limit):
+    rng = np.random.default_rng(limit)
+    rows = [{'store': int(store), 'day': int(day), 'position': position}
+            for position, (store, day) in enumerate(rng.integers(0, 4, size=(30, 2)))]
+    if in_order:
+        rows.sort(key=lambda row: (row['store'], row['day']))
+    expected = sorted(rows, key=lambda row: (row['store'], row['day'], row['position']))
+    pages, after = [], None
+    while True:
+        page, after = paginate(rows, ['store', 'day'], limit=limit, after=after)
+        pages.extend(page)
+        if after is None:
+            break
+    # Rows with the same key as the last row of a page are on that page or skipped, as with any cursor
+    assert pages == [row for row in expected if row in pages]
+    assert {(row['store'], row['day']) for row in pages} == {(row['store'], row['day']) for row in rows}
+
+def test_ndjson_lines_hold_one_row_each():
+    rows = daily_rows(50)
+    chunks = list(iter_ndjson(rows, chunk_bytes=256))
+    assert len(chunks) > 1
+    lines = b''.join(chunks).splitlines()
+    assert [orjson.loads(line) for line in lines] == [orjson.loads(dumps(row)) for row in rows]
+
+def test_page_frame_matches_paginate():
+    rows = daily_rows()
+    df = pd.DataFrame(rows)
+    key_fields = ['sales_outlet_id', 'transaction_date']
+    page, after = paginate(rows, key_fields, limit=3)
+    store_id, date = decode_cursor(after)
+    after_key = [store_id, pd.Timestamp(date)]
+    pushed = page_frame(df, key_fields, after_key, limit=3)
+    expected, _ = paginate(rows, key_fields, limit=3, after=after)
+    # One row more than the limit tells whether there is a next page
+    assert len(pushed) == 4
+    assert pushed.head(3).to_dict('records') == expected
+
+def test_page_stages_select_the_rows_after_the_cursor():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient()['test']['buckets']
+    collection.insert_many([{'_id': {'year': year, 'month': month}} for year in (2019, 2020) for month in range(1, 13)])
+    pipeline = [{'$sort': {'_id.year': 1, '_id.month': 1}}]
+    pipeline += page_stages(['_id.year', '_id.month'], after=[2019, 11], limit=2)
+    assert [row['_id'] for row in collection.aggregate(pipeline)] == [
+        {'year': 2019, 'month': 12}, {'year': 2020, 'month': 1}, {'year': 2020, 'month': 2}]
@@ -0,0 +1,95 @@
+import os
+from functools import partial
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+
+mongomock = pytest.importorskip('mongomock')
+os.environ.setdefault('DB_NAME', 'test')
+os.environ.setdefault('COLLECTION_NAME', '201904_sales_reciepts')
+
+import services
+from frame_cache import FrameCache
+from DB.live_ingest import ingest_line_items
+from DB.locks import ROLLUPS_LOCK, acquire_lock
+from DB.manifest import bump_data_version
+from DB.rollups import ROLLUPS_VERSION_ID
+
+SALES = pd.DataFrame({
+    'sales_outlet_id': [3, 3, 5, 5, 8],
+    'transaction_date': pd.to_datetime(['2019-04-01', '2019-04-02', '2019-04-01', '2019-04-01', '2019-04-09']),
+    'line_item_amount': [3.5, 2.0, 4.0, 1.5, 9.0],
+})
+
+def find_columns(collection, columns, query=None):
+    # mongomock has no find_raw_batches
+    return pd.DataFrame(list(collection.find(query or {}, dict.fromkeys(columns, 1))), columns=list(columns))
+
+@pytest.fixture
+def sales_db(monkeypatch):
+    db = mongomock.MongoClient()['test']
+    collection = db[os.environ['COLLECTION_NAME']]
+    collection.insert_many(SALES.to_dict('records'))
+    monkeypatch.setattr(services, 'db', db)
+    monkeypatch.setattr(services, 'sales_collection', collection)
+    monkeypatch.setattr(services, 'frame_cache', FrameCache(db, max_bytes=10 ** 6))
+    monkeypatch.setattr(services, 'fetch_columns', find_columns)
+    return db
+
+@pytest.mark.parametrize('store_ids, expected', [
+    ('all', None), (' ALL ', None), (None, None), ('8,3,5', [3, 5, 8]), ('3, 3,', [3]),
+])
+def test_parse_store_ids(store_ids, expected):
+    assert services.parse_store_ids(store_ids) == expected
+
+@pytest.mark.parametrize('store_ids', ['3,x', ',', ' '])
+def test_parse_store_ids_rejects_invalid_lists(store_ids):
+    with pytest.raises(HTTPException) as error:
+        services.parse_store_ids(store_ids)
+    assert error.value.status_code == 400
+
+def test_daily_sales_of_several_stores_match_pandas(sales_db):
+    result = services.get_daily_sales_for_stores('5,3', engine='mongo')
+    assert result['store_ids'] == [3, 5]
+    expected = SALES[SALES['sales_outlet_id'].isin([3, 5])].groupby(
+        ['sales_outlet_id', 'transaction_date'])['line_item_amount'].sum()
+    assert {(row['sales_outlet_id'], row['transaction_date']): row['daily_sales']
+            for rows in result['daily_sales'].values() for row in rows} == expected.to_dict()
+
+@pytest.mark.parametrize('service', [
+    services.get_daily_sales_for_stores, services.get_weekly_sales_for_stores,
+    services.get_monthly_sales_for_stores, services.get_sales_by_customer_type_for_stores,
+    services.get_most_selling_item_for_stores, services.get_peak_hours_for_stores,
+])
+def test_unknown_stores_are_not_found(sales_db, service):
+    with pytest.raises(HTTPException) as error:
+        service('42,43')
+    assert error.value.status_code == 404
+
+def test_heatmap_of_unknown_stores_is_not_found(sales_db):
+    with pytest.raises(HTTPException) as error:
+        services.get_traffic_heatmap('42', slot_minutes=30)
+    assert error.value.status_code == 404
+
+def test_distinct_counts_without_sketches_are_not_found(sales_db):
+    # Sketches current with the sales, but none covers the stores
+    for collection_name in (os.environ['COLLECTION_NAME'], ROLLUPS_VERSION_ID):
+        bump_data_version(sales_db, collection_name)
+    with pytest.raises(HTTPException) as error:
+        services.get_distinct_counts('42')
+    assert error.value.status_code == 404
+
+def test_sales_range_with_too_many_buckets_is_refused(sales_db):
+    with pytest.raises(HTTPException) as error:
+        services.get_sales_range('2000-01-01', '2019-01-01', granularity='hour')
+    assert error.value.status_code == 400
+
+def test_post_is_turned_away_while_the_rollups_are_locked(sales_db, monkeypatch):
+    monkeypatch.setattr(services, 'ingest_line_items', partial(ingest_line_items, lock_wait=0))
+    assert acquire_lock(sales_db, ROLLUPS_LOCK, 'etl')
+    line_item = {'transaction_id': 9, 'transaction_date': '2019-04-03', 'transaction_time': '08:00:00',
+                 'sales_outlet_id': 3, 'line_item_id': 1, 'product_id': 27, 'quantity': 1, 'line_item_amount': 3.5}
+    with pytest.raises(HTTPException) as error:
+        services.post_receipts([line_item])
+    assert error.value.status_code == 503 and int(error.value.headers['Retry-After']) >= 1
+    assert sales_db[os.environ['COLLECTION_NAME']].count_documents({}) == len(SALES)
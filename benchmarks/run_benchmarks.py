@@ -0,0 +1,265 @@
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+import pandas as pd
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.append(project_root)
+sys.path.append(os.path.join(project_root, 'apis'))
+from DB.synthetic_data import generate_dataset
+
+# The peak RSS is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Scales benchmarked by default, as <stores>x<months>
+DEFAULT_SCALES = ['3x1', '9x3', '30x12']
+DEFAULT_RESULTS = os.path.join(current_dir, 'results.jsonl')
+DEFAULT_WORKDIR = os.path.join(project_root, 'bench_data')
+
+# Aggregation engines of the service functions taking an engine argument
+ENGINES = ['rollup', 'mongo', 'pandas']
+
+def parse_scale(scale):
+    stores, months = scale.lower().split('x')
+    return int(stores), int(months)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=project_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def max_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class Recorder:
+    """
+    Time stages and record their peak memory to a JSON lines results file.
+
+    The peak is the largest amount of memory allocated through Python's
+    allocators (pandas and NumPy buffers included) while the stage ran, on
+    top of what was allocated before it started.
+    """
+
+    def __init__(self, results_path, **context):
+        self.results_path = results_path
+        self.context = context
+
+    def measure(self, stage, fn, *args, **kwargs):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            result, error = None, str(e) or type(e).__name__
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        record = {
+            **self.context,
+            'stage': stage,
+            'seconds': round(seconds, 6),
+            'peak_bytes': peak,
+            'max_rss_bytes': max_rss_bytes(),
+            'error': error,
+        }
+        with open(self.results_path, 'a') as results_file:
+            results_file.write(json.dumps(record) + '\n')
+        status = f'ERROR {error}' if error else f'{peak / 2 ** 20:,.1f} MiB'
+        print(f"{self.context['scale']:>8} {stage:<52} {seconds:>9.3f}s  {status}")
+        return result
+
+def service_calls(services, store_id, month, first_day):
+    # (stage, function, arguments) of every service function behind the API
+    calls = []
+    for engine in ENGINES:
+        calls += [
+            (f'daily_sales[{engine}]', services.get_daily_sales, (store_id, engine)),
+            (f'weekly_sales[{engine}]', services.get_weekly_sales, (store_id, engine)),
+            (f'monthly_sales[{engine}]', services.get_monthly_sales, (store_id, engine)),
+            (f'peak_hours[{engine}]', services.get_peak_hours_for_store, (store_id, engine)),
+            (f'most_selling_item[{engine}]', services.get_most_selling_item, (store_id, engine)),
+            (f'daily_receipts[{engine}]', services.get_daily_receipts_for_store, (store_id, engine)),
+            (f'best_performing_store[{engine}]', services.get_best_performing_store_for_month, (engine,)),
+            (f'most_sales_city[{engine}]', services.get_most_sales_city, (engine,)),
+            (f'average_sales_per_transaction[{engine}]', services.get_average_sales_per_transaction,
+             (month, engine)),
+            (f'daily_sales_per_week[{engine}]', services.get_daily_sales_per_week_endpoint, (month, engine)),
+        ]
+    calls += [
+        ('sales_by_customer_type', services.get_sales_by_customer_type, (store_id,)),
+        ('sales_comparison', services.get_sales_comparison, ()),
+        ('line_item_statistics', services.get_line_item_statistics, ()),
+        ('transaction_distribution', services.get_transaction_distribution, ()),
+        ('generation_counts', services.get_generation_counts_endpoint, ()),
+        ('tax_status_distribution', services.get_tax_status_distribution, ()),
+        ('drink_size_distribution', services.get_drink_size_distribution, ()),
+        ('most_sold_products', services.get_most_sold_products, ()),
+        ('sales_range[day]', services.get_sales_range,
+         (first_day, first_day + pd.Timedelta(days=7), store_id, 'day')),
+    ]
+    return calls
+
+def async_service_calls(async_services, month):
+    return [
+        ('most_sales_city_async', async_services.get_most_sales_city_async, ()),
+        ('tax_status_distribution_async', async_services.get_tax_status_distribution_async, ()),
+        ('drink_size_distribution_async', async_services.get_drink_size_distribution_async, ()),
+        ('most_sold_products_async', async_services.get_most_sold_products_async, ()),
+        ('average_sales_per_transaction_async', async_services.get_average_sales_per_transaction_async, (month,)),
+        ('daily_sales_per_week_async', async_services.get_daily_sales_per_week_async, (month,)),
+    ]
+
+def run_scale(stores, months, backend, results_path, workdir, start_month='2019-04-01'):
+    """
+    Generate, ingest and benchmark one scale. Runs in a process of its own so
+    that the module-level connections and caches start empty and the peak RSS
+    belongs to this scale only.
+    """
+    scale = f'{stores}x{months}'
+    data_dir = os.path.join(workdir, scale)
+    os.environ['DB_NAME'] = f'pos_benchmark_{scale}'
+    os.environ.setdefault('COLLECTION_NAME', '201904_sales_reciepts')
+    os.environ['SNAPSHOT_DIR'] = os.path.join(data_dir, 'snapshots')
+    os.makedirs(os.environ['SNAPSHOT_DIR'], exist_ok=True)
+
+    recorder = Recorder(results_path, commit=git_commit(), timestamp=datetime.now(timezone.utc).isoformat(),
+                        backend=backend, scale=scale, stores=stores, months=months)
+    counts = recorder.measure('generate', generate_dataset, data_dir, stores, months,
+                              os.path.join(project_root, 'data'), start_month)
+    recorder.context['line_items'] = counts['201904 sales reciepts.csv']
+
+    # Ingestion, into an empty database
+    from DB.connect_db import get_connection_manager, get_database
+    get_connection_manager().client.drop_database(os.environ['DB_NAME'])
+    from DB.store_to_db import store_data_to_mongodb
+    recorder.measure('ingestion', store_data_to_mongodb, counts['config'])
+
+    # ETL stages, each run on its own
+    import sales_data_pipeline as pipeline
+    first_day = pd.Timestamp(start_month)
+    last_day = first_day + pd.offsets.MonthEnd(months)
+    store_ids = [None] + sorted(get_database()[os.environ['COLLECTION_NAME']].distinct('sales_outlet_id'))
+    comparisons = pipeline.week_over_week_comparisons(first_day + pd.Timedelta(days=7), last_day, store_ids)
+
+    recorder.measure('etl.refresh_rollups[full]', pipeline.refresh_rollup_collections.fn, True)
+    data = recorder.measure('etl.extract_data', pipeline.extract_data.fn, first_day, first_day + pd.Timedelta(days=7),
+                            'weekly')
+    recorder.measure('etl.spending_per_receipt', pipeline.calculate_spending_per_receipt.fn, data['totals'])
+    recorder.measure('etl.items_per_receipt', pipeline.calculate_items_per_receipt.fn, data['totals'])
+    recorder.measure('etl.sales_comparison', pipeline.calculate_sales_comparison.fn, data['sales'], first_day,
+                     first_day + pd.Timedelta(days=7), 'weekly')
+    batch = recorder.measure('etl.extract_data[batch]', pipeline.extract_data.fn, comparisons=comparisons)
+    recorder.measure(f'etl.sales_comparisons[batch of {len(comparisons)}]',
+                     pipeline.calculate_sales_comparisons.fn, batch['sales'], comparisons)
+    recorder.measure('etl.save_to_json', pipeline.save_to_json.fn, {'benchmark': True},
+                     os.path.join(data_dir, 'metrics.json'))
+    recorder.measure('etl.etl_flow', pipeline.etl_flow, first_day, first_day + pd.Timedelta(days=7), 'weekly')
+
+    # Service functions, on an empty cache and then again on a warm one
+    import services
+    import async_services
+    calls = service_calls(services, store_ids[1], first_day.month, first_day)
+    for label in ('cold', 'warm'):
+        for stage, fn, args in calls:
+            recorder.measure(f'api.{stage}[{label}]', fn, *args)
+        for stage, fn, args in async_service_calls(async_services, first_day.month):
+            recorder.measure(f'api.{stage}[{label}]', lambda: asyncio.run(fn(*args)))
+
+def run(scales, backend, results_path, workdir):
+    """
+    Benchmark every scale in a child process, against a local mongod or an in-memory one.
+    """
+    env = dict(os.environ)
+    mongod = None
+    if backend == 'inmemory':
+        # pymongo-inmemory downloads and runs a throwaway mongod on an in-memory storage engine
+        from pymongo_inmemory import Mongod
+        from pymongo_inmemory.context import Context
+        mongod = Mongod(Context())
+        mongod.start()
+        env['MONGODB_CONNECTION_STRING'] = mongod.connection_string
+    try:
+        for scale in scales:
+            stores, months = parse_scale(scale)
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'scale', str(stores), str(months),
+                            '--backend', backend, '--results', results_path, '--workdir', workdir],
+                           cwd=project_root, env=env, check=True)
+    finally:
+        if mongod is not None:
+            mongod.stop()
+
+def load_results(results_path):
+    with open(results_path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+def compare(results_path, base, head):
+    """
+    Print the time and peak memory of every stage of two commits side by side.
+
+    The latest run of each scale and stage is used for each commit.
+    """
+    latest = {}
+    for record in load_results(results_path):
+        if record.get('commit') in (base, head):
+            latest[(record['commit'], record['scale'], record['stage'])] = record
+
+    keys = sorted({(scale, stage) for _, scale, stage in latest}, key=lambda key: (parse_scale(key[0]), key[1]))
+    print(f"{'scale':>8} {'stage':<52} {base:>10} {head:>10} {'ratio':>7} {'peak MiB':>19}")
+    for scale, stage in keys:
+        before, after = latest.get((base, scale, stage)), latest.get((head, scale, stage))
+        if before is None or after is None or before['error'] or after['error']:
+            continue
+        ratio = after['seconds'] / before['seconds'] if before['seconds'] else float('nan')
+        peaks = f"{before['peak_bytes'] / 2 ** 20:,.1f} -> {after['peak_bytes'] / 2 ** 20:,.1f}"
+        print(f"{scale:>8} {stage:<52} {before['seconds']:>9.3f}s {after['seconds']:>9.3f}s {ratio:>6.2f}x "
+              f"{peaks:>19}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ingestion, the API services and the ETL stages.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Benchmark several scales.')
+    run_parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES, help='Scales as <stores>x<months>.')
+    run_parser.add_argument('--backend', choices=['mongod', 'inmemory'], default='mongod',
+                            help="'mongod' uses MONGODB_CONNECTION_STRING, 'inmemory' needs pymongo-inmemory.")
+    run_parser.add_argument('--results', default=DEFAULT_RESULTS)
+    run_parser.add_argument('--workdir', default=DEFAULT_WORKDIR)
+
+    scale_parser = commands.add_parser('scale', help='Benchmark one scale in this process.')
+    scale_parser.add_argument('stores', type=int)
+    scale_parser.add_argument('months', type=int)
+    scale_parser.add_argument('--backend', default='mongod')
+    scale_parser.add_argument('--results', default=DEFAULT_RESULTS)
+    scale_parser.add_argument('--workdir', default=DEFAULT_WORKDIR)
+
+    compare_parser = commands.add_parser('compare', help='Compare the results of two commits.')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--results', default=DEFAULT_RESULTS)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args.scales, args.backend, os.path.abspath(args.results), os.path.abspath(args.workdir))
+    elif args.command == 'scale':
+        run_scale(args.stores, args.months, args.backend, args.results, args.workdir)
+    else:
+        compare(args.results, args.base, args.head)
@@ -1,12 +1,21 @@
 import pandas as pd
 from DB.store_to_db import store_data_to_mongodb
-from sales_data_pipeline import etl_flow
+from DB.connect_db import get_collection
+from sales_data_pipeline import etl_flow, week_over_week_comparisons
 
 def main():
     # Call the function to store data into MongoDB
     store_data_to_mongodb('data_files_config.json')
     # Prompt the user for input
-    comparison_type = input("Enter the comparison type ('daily', 'weekly', or 'monthly'): ")
+    comparison_type = input("Enter the comparison type ('daily', 'weekly', 'monthly' or 'week_over_week'): ")
+    if comparison_type == 'week_over_week':
+        # Every day against the same day of the previous week, for all stores together and for each store
+        first_day = pd.to_datetime(input("Enter the first day to compare (e.g., '2019-04-08'): "))
+        last_day = pd.to_datetime(input("Enter the last day to compare (e.g., '2019-04-29'): "))
+        store_ids = [None] + sorted(get_collection('sales_outlet').distinct('sales_outlet_id'))
+        etl_flow(comparisons=week_over_week_comparisons(first_day, last_day, store_ids))
+        return
+
     start_date_1 = pd.to_datetime(input("Enter the first start date (e.g., '2019-04-01'): "))
     start_date_2 = pd.to_datetime(input("Enter the second start date (e.g., '2019-04-08'): "))
 
@@ -1,68 +1,280 @@
 import os
 import json
+import time
+import numpy as np
 import pandas as pd
 from prefect import task, flow
-from DB.connect_db import get_mongo_connection
+from prefect.task_runners import ConcurrentTaskRunner, SequentialTaskRunner
+from DB.connect_db import get_database, get_collection, get_sales_collection
+from DB.rollups import refresh_rollups, ROLLUPS_VERSION_ID
+from DB.sketches import merge_store_day_sketches
+from DB.range_index import SalesRangeIndex
+from DB.manifest import load_data_versions
+from DB.snapshots import load_snapshot_meta, read_snapshot
+from DB.instrumentation import timed_task, write_etl_metrics
+from DB.compact import compact_frame
+
+# prefect-dask runs the metric tasks in worker processes. Without it only the
+# thread and sequential task runners are available.
+try:
+    from prefect_dask import DaskTaskRunner
+except ImportError:
+    DaskTaskRunner = None
+
+# Task runner of the metric tasks: 'thread', 'process' or 'sequential'
+ETL_TASK_RUNNER = os.getenv('ETL_TASK_RUNNER', 'thread')
+
+# Estimate the full-history receipt totals from the store x day sketches
+# instead of grouping every line item by receipt
+ETL_APPROXIMATE_TOTALS = os.getenv('ETL_APPROXIMATE_TOTALS', '0') == '1'
+
+def make_task_runner(kind=ETL_TASK_RUNNER):
+    if kind == 'sequential':
+        return SequentialTaskRunner()
+    if kind == 'process':
+        if DaskTaskRunner is not None:
+            return DaskTaskRunner(cluster_kwargs={'processes': True})
+        print("prefect-dask is not installed, running the metric tasks in threads.")
+    return ConcurrentTaskRunner()
+
+# Metric tasks of the flow, registered with @metric: name -> (task, inputs, batch)
+METRICS = {}
+
+def metric(name, *inputs, batch=True):
+    """
+    Register a task as a metric computed by etl_flow.
+
+    The metric tasks are submitted together and run concurrently. They all
+    receive the same extracted objects, not copies, and must not modify them.
+
+    Args:
+        name : Key of the metric in the metrics document.
+        inputs : Names of the task arguments in the run context: 'sales',
+            'totals' or one of the flow parameters.
+        batch : Whether batch runs compute the metric too, once for all the
+            comparisons of the batch.
+    """
+    def register(metric_task):
+        METRICS[name] = (metric_task, inputs, batch)
+        return metric_task
+    return register
+
+def submit_metrics(context, batch=False):
+    # Submit all the metric tasks at once, then wait for the slowest one
+    futures = {
+        name: metric_task.submit(*[context[input_name] for input_name in inputs])
+        for name, (metric_task, inputs, in_batch) in METRICS.items()
+        if in_batch or not batch
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+# Length of the compared date ranges for each comparison type
+COMPARISON_OFFSETS = {
+    'daily': pd.DateOffset(days=1),
+    'weekly': pd.DateOffset(days=7),
+    'monthly': pd.DateOffset(months=1),
+}
+
+# Receipt totals over the whole sales history, computed on the server
+RECEIPT_TOTALS_PIPELINE = [
+    {"$group": {"_id": "$transaction_id", "total_sales": {"$sum": "$line_item_amount"}, "total_items": {"$sum": 1}}},
+    {"$group": {"_id": None, "total_sales": {"$sum": "$total_sales"}, "total_items": {"$sum": "$total_items"},
+                "total_receipts": {"$sum": 1}}},
+]
+
+def comparison_windows(start_date_st, start_date_nd, comparison_type='daily'):
+    """
+    Return the [start, end) date ranges compared by the flow.
+    """
+    if comparison_type not in COMPARISON_OFFSETS:
+        raise ValueError("Comparison type must be one of: daily, weekly, monthly")
+    offset = COMPARISON_OFFSETS[comparison_type]
+    return [(pd.Timestamp(start), pd.Timestamp(start) + offset) for start in (start_date_st, start_date_nd)]
+
+def comparison_frame(comparisons):
+    """
+    Normalize a list of comparisons into one row per comparison.
+
+    Args:
+        comparisons : List of dicts with start_date_st, start_date_nd, an
+            optional comparison_type (daily by default) and an optional
+            store_id (all stores by default).
+
+    Returns:
+        pd.DataFrame: The comparisons with the end of both date ranges.
+    """
+    specs = pd.DataFrame(list(comparisons))
+    specs['comparison_type'] = specs.get('comparison_type', pd.Series('daily', index=specs.index)).fillna('daily')
+    store_ids = specs['store_id'] if 'store_id' in specs.columns else pd.Series(None, index=specs.index)
+    specs['store_id'] = pd.Series([None if pd.isna(store_id) else int(store_id) for store_id in store_ids],
+                                  index=specs.index, dtype=object)
+    unknown = set(specs['comparison_type']) - set(COMPARISON_OFFSETS)
+    if unknown:
+        raise ValueError("Comparison type must be one of: daily, weekly, monthly")
+    for n in ('st', 'nd'):
+        specs[f'start_date_{n}'] = pd.to_datetime(specs[f'start_date_{n}'])
+        specs[f'end_date_{n}'] = specs[f'start_date_{n}']
+        for comparison_type, offset in COMPARISON_OFFSETS.items():
+            rows = specs['comparison_type'] == comparison_type
+            specs.loc[rows, f'end_date_{n}'] = specs.loc[rows, f'start_date_{n}'] + offset
+    return specs
+
+def week_over_week_comparisons(first_day, last_day, store_ids=(None,)):
+    """
+    Build the comparisons of every day against the same day of the previous week.
+
+    Args:
+        first_day : First compared day.
+        last_day : Last compared day, included.
+        store_ids : Stores to compare, None standing for all stores together.
+
+    Returns:
+        list: One comparison per day and store.
+    """
+    return [
+        {'start_date_st': day - pd.DateOffset(days=7), 'start_date_nd': day, 'comparison_type': 'daily',
+         'store_id': store_id}
+        for day in pd.date_range(first_day, last_day, freq='D')
+        for store_id in store_ids
+    ]
+
+def merge_windows(windows):
+    # Union of [start, end) date ranges as the fewest disjoint ranges
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def comparison_pipeline(windows):
+    # Line items of the compared date ranges, with only the fields the comparison reads
+    return [
+        {"$match": {"$or": [
+            {"transaction_date": {"$gte": start.to_pydatetime(), "$lt": end.to_pydatetime()}}
+            for start, end in merge_windows(windows)
+        ]}},
+        {"$project": {
+            "_id": 0,
+            "transaction_date": 1,
+            "sales_outlet_id": 1,
+            "line_item_amount": {"$ifNull": ["$line_item_amount", {"$multiply": ["$quantity", "$unit_price"]}]},
+        }},
+    ]
+
+def snapshot_window_rows(windows):
+    """
+    Select the line items of the compared date ranges from the sales snapshot.
+
+    The snapshot columns are memory-mapped, so only the pages of the selected
+    rows are read. Same rows and fields as comparison_pipeline.
+
+    Returns:
+        pd.DataFrame: The line items, or None when the snapshot is missing or
+        older than the sales collection.
+    """
+    collection_name = get_sales_collection().name
+    meta = load_snapshot_meta(collection_name)
+    if meta is None or meta['version'] != load_data_versions(get_database()).get(collection_name):
+        return None
+    columns = ['transaction_date', 'sales_outlet_id', 'line_item_amount', 'quantity', 'unit_price']
+    snapshot = read_snapshot(collection_name, columns, meta=meta)
+    if snapshot is None:
+        return None
+
+    dates = snapshot['transaction_date'].to_numpy()
+    mask = np.zeros(len(snapshot), dtype=bool)
+    for start, end in merge_windows(windows):
+        mask |= (dates >= start.to_datetime64()) & (dates < end.to_datetime64())
+    rows = snapshot.loc[mask]
+    return pd.DataFrame({
+        'transaction_date': rows['transaction_date'].to_numpy(),
+        'sales_outlet_id': rows['sales_outlet_id'].to_numpy(),
+        'line_item_amount': rows['line_item_amount'].fillna(rows['quantity'] * rows['unit_price']).to_numpy(),
+    })
+
+def approximate_receipt_totals():
+    """
+    Estimate the receipt totals of the whole sales history from the store x day sketches.
+
+    The sales and line item totals are exact, the number of distinct
+    receipts has a relative standard error of 1.6%.
+
+    Returns:
+        dict: Same fields as RECEIPT_TOTALS_PIPELINE, or None when the
+        sketches are older than the sales collection.
+    """
+    db = get_database()
+    versions = load_data_versions(db)
+    sales_version = versions.get(get_sales_collection().name)
+    if sales_version is None or versions.get(ROLLUPS_VERSION_ID) != sales_version:
+        return None
+    merged = merge_store_day_sketches(db, by_store=False)
+    return {'total_sales': merged['amount'], 'total_items': merged['line_items'],
+            'total_receipts': merged['receipts'].count()}
 
 @task
-def extract_data():
+@timed_task
+def extract_data(start_date_st=None, start_date_nd=None, comparison_type='daily', comparisons=None):
     try:
-        client, db, sales_collection = get_mongo_connection()
-
-        # Fetch all sales data
-        sales_data = sales_collection.find({})
-        df = pd.DataFrame(list(sales_data))
-        df['transaction_date'] = pd.to_datetime(df['transaction_date'])
-        client.close()
-        return df
-    
+        sales_collection = get_sales_collection()
+
+        # Fetch the sales of the compared date ranges only
+        if comparisons is None:
+            windows = comparison_windows(start_date_st, start_date_nd, comparison_type)
+        else:
+            specs = comparison_frame(comparisons)
+            windows = [(start, end) for n in ('st', 'nd')
+                       for start, end in set(zip(specs[f'start_date_{n}'], specs[f'end_date_{n}']))]
+        df = snapshot_window_rows(windows)
+        if df is None:
+            sales_data = sales_collection.aggregate(comparison_pipeline(windows))
+            df = pd.DataFrame(list(sales_data), columns=['transaction_date', 'sales_outlet_id', 'line_item_amount'])
+        df = compact_frame(df, 'extract_data')
+
+        # Full-history receipt totals, estimated from the sketches or grouped on the server
+        totals = approximate_receipt_totals() if ETL_APPROXIMATE_TOTALS else None
+        if totals is None:
+            totals = next(sales_collection.aggregate(RECEIPT_TOTALS_PIPELINE), {})
+        return {'sales': df, 'totals': totals}
+
     except Exception as e:
         print(f"An error occurred during extraction: {e}")
-        return pd.DataFrame()
+        return {'sales': pd.DataFrame(), 'totals': {}}
 
+@metric('spending_per_receipt', 'totals')
 @task
-def calculate_spending_per_receipt(df):
+@timed_task
+def calculate_spending_per_receipt(totals):
     # Calculate Spending_per_receipt
-    total_sales = df['line_item_amount'].sum()
-    total_receipts = df['transaction_id'].nunique()
+    total_sales = totals.get('total_sales', 0)
+    total_receipts = totals.get('total_receipts', 0)
     spending_per_receipt = total_sales / total_receipts if total_receipts else 0
-    return spending_per_receipt
+    return float(spending_per_receipt)
 
+@metric('items_per_receipt', 'totals')
 @task
-def calculate_items_per_receipt(df):
+@timed_task
+def calculate_items_per_receipt(totals):
     # Calculate Items_per_receipt
-    total_receipts = df['transaction_id'].nunique()
-    total_items = df['line_item_id'].count()
+    total_receipts = totals.get('total_receipts', 0)
+    total_items = totals.get('total_items', 0)
     items_per_receipt = total_items / total_receipts if total_receipts else 0
-    return items_per_receipt
+    return float(items_per_receipt)
 
+@metric('sales_comparison', 'sales', 'start_date_st', 'start_date_nd', 'comparison_type', batch=False)
 @task
+@timed_task
 def calculate_sales_comparison(df, start_date_st, start_date_nd, comparison_type='daily'):
     try:
-        # Check if 'line_item_amount' exist in df
-        if 'line_item_amount' not in df.columns:
-            df['line_item_amount'] = df['quantity'] * df['unit_price']
-        
-        df.set_index('transaction_date', inplace=True)
-
-        if comparison_type == 'daily':
-            end_date_1 = start_date_st + pd.DateOffset(days=1)
-            end_date_2 = start_date_nd + pd.DateOffset(days=1)
-        elif comparison_type == 'weekly':
-            end_date_1 = start_date_st + pd.DateOffset(days=7)
-            end_date_2 = start_date_nd + pd.DateOffset(days=7)
-        elif comparison_type == 'monthly':
-            end_date_1 = start_date_st + pd.DateOffset(months=1)
-            end_date_2 = start_date_nd + pd.DateOffset(months=1)
-        else:
-            raise ValueError("Comparison type must be one of: daily, weekly, monthly")
-
-        # Filter data for the specified date ranges
-        sales_range_1 = df[(df.index >= start_date_st) & (df.index < end_date_1)]
-        sales_range_2 = df[(df.index >= start_date_nd) & (df.index < end_date_2)]
+        (start_date_st, end_date_1), (start_date_nd, end_date_2) = comparison_windows(
+            start_date_st, start_date_nd, comparison_type)
 
-        sales_range_1_total = sales_range_1['line_item_amount'].sum()
-        sales_range_2_total = sales_range_2['line_item_amount'].sum()
+        # Total the specified date ranges on the prefix sums of the sales
+        index = SalesRangeIndex(df)
+        sales_range_1_total = index.totals(start_date_st, end_date_1)['sales']
+        sales_range_2_total = index.totals(start_date_nd, end_date_2)['sales']
 
         sales_comparison = {
             'sales_range_1_total': float(sales_range_1_total),
@@ -77,46 +289,123 @@ def calculate_sales_comparison(df, start_date_st, start_date_nd, comparison_type
         return {}
 
 @task
-def transform_data(df, start_date_st, start_date_nd, comparison_type='daily'):
-    try:
-        spending_per_receipt = calculate_spending_per_receipt(df)
-        items_per_receipt = calculate_items_per_receipt(df)
-        sales_comparison = calculate_sales_comparison(df, start_date_st, start_date_nd, comparison_type)
-
-        metrics = {
-            'spending_per_receipt': float(spending_per_receipt),
-            'items_per_receipt': float(items_per_receipt),
-            'sales_comparison': sales_comparison
-        }
+@timed_task
+def calculate_sales_comparisons(df, comparisons):
+    """
+    Evaluate many sales comparisons on one prefix-sum index of the sales.
+
+    The comparisons of each store are totalled together with vectorized
+    binary searches, so the cost grows with the number of stores rather
+    than the number of comparisons.
+
+    Args:
+        df : Line items covering the date ranges of all the comparisons.
+        comparisons : List of comparisons, see comparison_frame.
+
+    Returns:
+        list: One dict per comparison with its date ranges and sales totals.
+    """
+    start = time.perf_counter()
+    specs = comparison_frame(comparisons)
+    index = SalesRangeIndex(df)
+    specs['sales_range_1_total'] = 0.0
+    specs['sales_range_2_total'] = 0.0
+
+    for store_id, store_specs in specs.groupby(specs['store_id'].astype('Int64'), dropna=False, sort=False):
+        store_id = None if pd.isna(store_id) else int(store_id)
+        specs.loc[store_specs.index, 'sales_range_1_total'] = index.range_totals(
+            store_specs['start_date_st'], store_specs['end_date_st'], store_id)['sales']
+        specs.loc[store_specs.index, 'sales_range_2_total'] = index.range_totals(
+            store_specs['start_date_nd'], store_specs['end_date_nd'], store_id)['sales']
+
+    specs['sales_difference'] = specs['sales_range_2_total'] - specs['sales_range_1_total']
+    columns = ['store_id', 'comparison_type', 'start_date_st', 'start_date_nd',
+               'sales_range_1_total', 'sales_range_2_total', 'sales_difference']
+    results = specs[columns].to_dict(orient='records')
+
+    elapsed = time.perf_counter() - start
+    rate = len(results) / elapsed if elapsed else 0
+    print(f"Evaluated {len(results)} comparisons in {elapsed:.2f}s ({rate:,.0f} comparisons/sec).")
+    return results
 
+def transform_data(data, start_date_st, start_date_nd, comparison_type='daily'):
+    try:
+        context = {**data, 'start_date_st': start_date_st, 'start_date_nd': start_date_nd,
+                   'comparison_type': comparison_type}
+        metrics = submit_metrics(context)
         return metrics
     except Exception as e:
         print(f"An error occurred during transformation: {e}")
         return {}
-    
+
+def transform_batch(data, comparisons):
+    try:
+        sales_comparisons = calculate_sales_comparisons.submit(data['sales'], comparisons)
+        shared_metrics = submit_metrics({**data, 'comparisons': comparisons}, batch=True)
+
+        # One metrics document per comparison, shaped like the single comparison ones
+        return [
+            {**shared_metrics, 'sales_comparison': sales_comparison}
+            for sales_comparison in sales_comparisons.result()
+        ]
+    except Exception as e:
+        print(f"An error occurred during transformation: {e}")
+        return []
+
 @task
+@timed_task
 def load_data(metrics):
     try:
-        client, db = get_mongo_connection()
-        collection = db['sales_metrics']
-        collection.insert_one(metrics)
-        client.close()
+        collection = get_collection('sales_metrics')
+        if isinstance(metrics, list):
+            # All the comparisons of a batch in a single bulk write
+            collection.insert_many(metrics, ordered=False)
+        else:
+            collection.insert_one(metrics)
     except Exception as e:
         print(f"An error occurred while loading data: {e}")
 
 @task
+@timed_task
 def save_to_json(metrics, file_path='metrics.json'):
     # Convert ObjectIds to strings
-    if '_id' in metrics:
-        metrics['_id'] = str(metrics['_id'])
+    for document in metrics if isinstance(metrics, list) else [metrics]:
+        if '_id' in document:
+            document['_id'] = str(document['_id'])
 
     with open(file_path, 'w') as json_file:
-        json.dump(metrics, json_file, indent=4)
+        json.dump(metrics, json_file, indent=4, default=str)
+
+@task
+@timed_task
+def refresh_rollup_collections(full_refresh=False):
+    # Recompute the rollups served by the API for the dates ingested since the last run
+    try:
+        result = refresh_rollups(get_database(), get_sales_collection().name, full_refresh)
+        print(f"Refreshed rollups: {result}")
+        return result
+    except Exception as e:
+        print(f"An error occurred while refreshing the rollups: {e}")
+        return None
+
+@flow(task_runner=make_task_runner())
+def etl_flow(start_date_st=None, start_date_nd=None, comparison_type='daily', full_refresh=False, comparisons=None):
+    """
+    Compare the sales of two date ranges, or of every comparison in comparisons.
 
-@flow
-def etl_flow(start_date_st, start_date_nd, comparison_type='daily'):
-    data = extract_data()
-    metrics = transform_data(data, start_date_st, start_date_nd, comparison_type)
+    comparisons is a list of dicts with start_date_st, start_date_nd and
+    optionally comparison_type and store_id. They are all evaluated against
+    one extraction of the data and stored with one bulk write.
+    """
+    # The rollups served by the API are independent of the metrics, refresh them alongside
+    rollups = refresh_rollup_collections.submit(full_refresh)
+    data = extract_data(start_date_st, start_date_nd, comparison_type, comparisons)
+    if comparisons is None:
+        metrics = transform_data(data, start_date_st, start_date_nd, comparison_type)
+    else:
+        metrics = transform_batch(data, comparisons)
     if metrics:
         load_data(metrics)
         save_to_json(metrics)
+    rollups.wait()
+    write_etl_metrics()